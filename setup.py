@@ -25,6 +25,7 @@ requires = [
     'jsonschema_serialize_fork',
     'loremipsum',
     'netaddr',
+    'numpy',
     'passlib',
     'psutil',
     'pyramid',
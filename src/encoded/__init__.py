@@ -28,6 +28,7 @@ from snovault.elasticsearch import (
 )
 from snovault.json_renderer import json_renderer
 from elasticsearch import Elasticsearch
+from encoded.ontology_store import open_ontology
 STATIC_MAX_AGE = 0
 
 
@@ -136,7 +137,8 @@ def load_workbook(app, workbook_filename, docsdir, test=False):
         'REMOTE_USER': 'IMPORT',
     }
     testapp = TestApp(app, environ)
-    load_all(testapp, workbook_filename, docsdir, test=test)
+    workers = int(app.registry.settings.get('loadxl.workers', 1))
+    load_all(testapp, workbook_filename, docsdir, test=test, workers=workers)
 
 
 def json_from_path(path, default=None):
@@ -215,6 +217,7 @@ def main(global_config, **local_config):
 
     config.include(configure_dbsession)
     config.include('snovault')
+    config.include('.object_cache')
     config.commit()  # commit so search can override listing
 
     # Render an HTML page to browsers and a JSON document for API clients
@@ -246,7 +249,7 @@ def main(global_config, **local_config):
         config.include('.region_indexer')
     config.include(static_resources)
     config.include(changelogs)
-    config.registry['ontology'] = json_from_path(settings.get('ontology_path'), {})
+    config.registry['ontology'] = open_ontology(settings)
     aws_ip_ranges = json_from_path(settings.get('aws_ip_ranges_path'), {'prefixes': []})
     config.registry['aws_ipset'] = netaddr.IPSet(
         record['ip_prefix'] for record in aws_ip_ranges['prefixes'] if record['service'] == 'AMAZON')
@@ -0,0 +1,116 @@
+"""\
+Cache of elasticsearch results for the matrix, summary and audit views.
+
+Those views send nested terms aggregations (size 999999) to elasticsearch on
+every page load, and the front page matrix asks the same thing for every
+anonymous user.  Responses are kept here as json, keyed by the view, its
+query params, the user's principals and the primary indexer's last completed
+xmin, so they are dropped as soon as the primary indexer finishes a cycle.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+from .object_cache import count
+
+
+AGGREGATION_CACHE = 'aggregation_cache'
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_TTL = 300  # seconds
+
+# Params that never reach elasticsearch
+IGNORED_PARAMS = frozenset(['format', 'frame', 'referrer', 'x.limit', 'y.limit'])
+
+
+def includeme(config):
+    settings = config.registry.settings
+    max_bytes = int(settings.get('aggregation_cache.size', DEFAULT_MAX_BYTES))
+    if max_bytes > 0:
+        ttl = int(settings.get('aggregation_cache.ttl', DEFAULT_TTL))
+        config.registry[AGGREGATION_CACHE] = AggregationCache(max_bytes, ttl)
+
+
+class AggregationCache(object):
+    '''Elasticsearch responses by key, each for ttl seconds, least recently used dropped once past max_bytes.'''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns a fresh copy of the results stored for key, or None.'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < time.time():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+        # Views rework the aggregations in place, so every hit gets its own
+        return json.loads(entry[0])
+
+    def set(self, key, es_results):
+        body = json.dumps(es_results)
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (body, time.time() + self.ttl)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        (body, _) = self.entries.pop(key)
+        self.size -= len(body)
+
+
+def primary_indexer_xmin(request):
+    '''Returns the xmin of the primary indexer's last completed cycle, or None if there isn't one.'''
+    es = request.registry.get(ELASTIC_SEARCH)
+    if es is None:
+        return None
+    try:
+        state = es.get(
+            index=request.registry.settings['snovault.elasticsearch.index'],
+            doc_type='meta',
+            id='primary_indexer',
+        )['_source']
+    except Exception:
+        return None
+    xmin = state.get('xmin') if state.get('status') == 'done' else state.get('last_xmin')
+    if xmin is None or int(xmin) <= 0:
+        return None
+    return xmin
+
+
+def aggregation_key(request, view_name, xmin):
+    params = tuple(sorted(
+        (name, value) for (name, value) in request.params.items() if name not in IGNORED_PARAMS
+    ))
+    return (view_name, request.path, params, tuple(sorted(request.effective_principals)), xmin)
+
+
+def cached_search(request, view_name, search):
+    '''Returns search() (elasticsearch results) for this request, from the cache when possible.
+       Nothing is cached before the primary indexer has completed a cycle.'''
+    cache = request.registry.get(AGGREGATION_CACHE)
+    xmin = primary_indexer_xmin(request) if cache is not None else None
+    if xmin is None:
+        return search()
+    key = aggregation_key(request, view_name, xmin)
+    es_results = cache.get(key)
+    if es_results is None:
+        count(request, 'aggregation_cache_miss_count')
+        es_results = search()
+        cache.set(key, es_results)
+    else:
+        count(request, 'aggregation_cache_hit_count')
+    return es_results
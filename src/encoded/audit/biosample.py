@@ -2,6 +2,10 @@ from snovault import (
     AuditFailure,
     audit_checker,
 )
+from encoded.ontology_store import (
+    OntologyStore,
+    part_of_closure,
+)
 
 
 # flag biosamples that contain GM that is different from the GM in donor. It could be legitimate case, but we would like to see it.
@@ -197,14 +201,13 @@ def audit_biosample_depleted_in_term_name(value, system):
 
 # utility functions
 
-def is_part_of(term_id, part_of_term_id, ontology, parent_term_id=None):
+def is_part_of(term_id, part_of_term_id, ontology):
     """
     Given the term_ids for a child and parent biosample pair as obtained from the
     portal, check that the part_of relationship is reflected in the ontology as
     well. While the portal model insinuates a direct parent-child relation, in
     the ontology the relationship may traverse several levels of inheritance.
-    As such, this function traverses up the ontology tree until it has found the
-    ancestor node with the matching term_id.
+    As such, this function checks the ancestors of term_id for part_of_term_id.
 
     Parameters
     ----------
@@ -213,19 +216,16 @@ def is_part_of(term_id, part_of_term_id, ontology, parent_term_id=None):
     part_of_term_id : str
         The biosample_term_id of the biosample specified by the child biosample's
         "part_of" property, i.e. the biosample_term_id of the parent biosample
-    ontology : dict
-        The ontology generated by ontology.py, from system['registry']['ontology']
-    parent_term_id : str, optional
-        The term id of the previous node in the traversal. This argument is passed
-        for recursive is_part_of calls to ensure that the search does not bounce
-        between two ontology terms pointing to each other.
+    ontology : OntologyStore or dict
+        The ontology from system['registry']['ontology']. An OntologyStore has
+        the part_of ancestors of every term precomputed; for a dict they are
+        found here.
 
     Returns
     -------
     bool
         Returns True if the ontology term of any ancestor of the term_id in the
-        ontology, or the term_id itself, matches part_of_term_id. Otherwise,
-        returns False after the search over all ancestor nodes has been exhausted.
+        ontology matches part_of_term_id. Otherwise, returns False.
 
     Examples
     --------
@@ -235,18 +235,9 @@ def is_part_of(term_id, part_of_term_id, ontology, parent_term_id=None):
     >>> is_part_of('CL:0000121', 'UBERON:0002037', ontology)
     True
     """
-    if 'part_of' not in ontology[term_id] or ontology[term_id]['part_of'] == []:
-        return False
-    if part_of_term_id in ontology[term_id]['part_of']:
-        return True
-    else:
-        parents = []
-        for x in ontology[term_id]['part_of']:
-            if not parent_term_id == x:
-                parents.append(
-                    is_part_of(x, part_of_term_id, ontology, parent_term_id=term_id)
-                )
-        return any(parents)
+    if isinstance(ontology, OntologyStore):
+        return ontology.is_part_of(term_id, part_of_term_id)
+    return part_of_term_id in part_of_closure(ontology, term_id)
 
 
 def audit_biosample_post_differentiation_time(value, system):
@@ -1,3 +1,4 @@
+from pyramid.decorator import reify
 from snovault import (
     AuditFailure,
     audit_checker,
@@ -111,9 +112,8 @@ def audit_experiment_chipseq_control_read_depth(value, system, files_structure):
         control_objects = {}
         for control_experiment in controls:
             control_objects[control_experiment.get('@id')] = control_experiment
-            controls_files_structures[control_experiment.get('@id')] = create_files_mapping(
-                control_experiment.get('original_files'),
-                files_structure.get('excluded_types'))
+            controls_files_structures[control_experiment.get('@id')] = \
+                files_structure['graph'].control_files_structure(control_experiment)
         awards_to_be_checked = [
                         'ENCODE3',
                         'ENCODE4',
@@ -134,10 +134,7 @@ def audit_experiment_chipseq_control_read_depth(value, system, files_structure):
         analysis_steps_to_check = ['Alignment pooling and subsampling step',
                                    'Control alignment subsampling step']
         for peaks_file in peaks_file_gen:
-            derived_from_files = get_derived_from_files_set([peaks_file],
-                                                            files_structure,
-                                                            'bam',
-                                                            True)
+            derived_from_files = files_structure['graph'].derived_from_files(peaks_file, 'bam')
             derived_from_external_bams_gen = (
                 derived_from for derived_from in
                 derived_from_files
@@ -366,7 +363,7 @@ def audit_experiment_mixed_libraries(value, system, excluded_types):
 
 
 def audit_experiment_pipeline_assay_details(value, system, files_structure):
-    for pipeline in get_pipeline_objects(files_structure.get('original_files').values()):
+    for pipeline in files_structure['graph'].pipelines('original_files'):
         if value.get('assay_term_name') not in pipeline['assay_term_names']:
             detail = 'This experiment ' + \
                 'contains file(s) associated with ' + \
@@ -387,13 +384,12 @@ def audit_experiment_missing_unfiltered_bams(value, system, files_structure):
     if len(files_structure.get('alignments').values()) == 0:
         return
 
-    if 'ChIP-seq read mapping' in get_pipeline_titles(
-            get_pipeline_objects(files_structure.get('alignments').values())):
+    graph = files_structure['graph']
+    if 'ChIP-seq read mapping' in get_pipeline_titles(graph.pipelines('alignments')):
         for filtered_file in files_structure.get('alignments').values():
             if has_only_raw_files_in_derived_from(filtered_file, files_structure) and \
                filtered_file.get('lab') == '/labs/encode-processing-pipeline/' and \
-               has_no_unfiltered(filtered_file,
-                                 files_structure.get('unfiltered_alignments').values()):
+               has_no_unfiltered(filtered_file, graph.unfiltered_alignments_like(filtered_file)):
                 detail = ('Experiment {} contains biological replicate '
                          '{} with a filtered {} file {}, mapped to '
                          'a {} assembly, but has no unfiltered '
@@ -598,12 +594,11 @@ def check_experiment_dnase_seq_standards(experiment,
             pipeline_title,
             link_to_standards)
 
-    pipelines = get_pipeline_objects(alignment_files)
+    pipelines = files_structure['graph'].pipelines('alignments')
 
     if pipelines is not None and len(pipelines) > 0:
-        samtools_flagstat_metrics = get_metrics(alignment_files,
-                                                'SamtoolsFlagstatsQualityMetric',
-                                                desired_assembly)
+        samtools_flagstat_metrics = files_structure['graph'].metrics(
+            'alignments', 'SamtoolsFlagstatsQualityMetric', desired_assembly)
 
         if samtools_flagstat_metrics is not None and \
                 len(samtools_flagstat_metrics) > 0:
@@ -664,9 +659,8 @@ def check_experiment_dnase_seq_standards(experiment,
                 signal_assemblies[signal_file['accession']
                                   ] = signal_file['assembly']
 
-        hotspot_quality_metrics = get_metrics(alignment_files,
-                                              'HotspotQualityMetric',
-                                              desired_assembly)
+        hotspot_quality_metrics = files_structure['graph'].metrics(
+            'alignments', 'HotspotQualityMetric', desired_assembly)
         if hotspot_quality_metrics is not None and \
            len(hotspot_quality_metrics) > 0:
             for metric in hotspot_quality_metrics:
@@ -699,9 +693,8 @@ def check_experiment_dnase_seq_standards(experiment,
         if 'replication_type' not in experiment or experiment['replication_type'] == 'unreplicated':
             return
 
-        signal_quality_metrics = get_metrics(signal_files,
-                                             'CorrelationQualityMetric',
-                                             desired_assembly)
+        signal_quality_metrics = files_structure['graph'].metrics(
+            'signal_files', 'CorrelationQualityMetric', desired_assembly)
         if signal_quality_metrics is not None and \
            len(signal_quality_metrics) > 0:
             threshold = 0.9
@@ -771,9 +764,8 @@ def check_experiment_rna_seq_standards(value,
                           'RNA-seq of long RNAs (single-end, unstranded)',
                           'Small RNA-seq single-end pipeline',
                           'RAMPAGE (paired-end, stranded)']:
-        star_metrics = get_metrics(alignment_files,
-                                   'StarQualityMetric',
-                                   desired_assembly)
+        star_metrics = files_structure['graph'].metrics(
+            'alignments', 'StarQualityMetric', desired_assembly)
 
         if len(star_metrics) < 1:
             detail = 'ENCODE experiment {} '.format(value['@id']) + \
@@ -845,7 +837,6 @@ def check_experiment_wgbs_encode3_standards(experiment,
 
     alignment_files = files_structure.get('alignments').values()
     fastq_files = files_structure.get('fastq_files').values()
-    cpg_quantifications = files_structure.get('cpg_quantifications').values()
 
     if fastq_files == []:
         return
@@ -866,21 +857,21 @@ def check_experiment_wgbs_encode3_standards(experiment,
     if 'replication_type' not in experiment or experiment['replication_type'] == 'unreplicated':
         return
 
-    bismark_metrics = get_metrics(
-        cpg_quantifications, 'BismarkQualityMetric', desired_assembly)
-    cpg_metrics = get_metrics(
-        cpg_quantifications, 'CpgCorrelationQualityMetric', desired_assembly)
+    graph = files_structure['graph']
+    bismark_metrics = graph.metrics(
+        'cpg_quantifications', 'BismarkQualityMetric', desired_assembly)
+    cpg_metrics = graph.metrics(
+        'cpg_quantifications', 'CpgCorrelationQualityMetric', desired_assembly)
 
-    samtools_metrics = get_metrics(cpg_quantifications,
-                                   'SamtoolsFlagstatsQualityMetric',
-                                   desired_assembly)
+    samtools_metrics = graph.metrics(
+        'cpg_quantifications', 'SamtoolsFlagstatsQualityMetric', desired_assembly)
 
     yield from check_wgbs_coverage(
         samtools_metrics,
         pipeline_title,
         min(read_lengths),
         organism_name,
-        get_pipeline_objects(alignment_files))
+        files_structure['graph'].pipelines('alignments'))
 
     yield from check_wgbs_pearson(cpg_metrics, 0.8, pipeline_title)
 
@@ -920,7 +911,6 @@ def check_experiment_chip_seq_standards(
 
     fastq_files = files_structure.get('fastq_files').values()
     alignment_files = files_structure.get('alignments').values()
-    idr_peaks_files = files_structure.get('optimal_idr_peaks').values()
 
     upper_limit_read_length = 50
     medium_limit_read_length = 36
@@ -952,7 +942,7 @@ def check_experiment_chip_seq_standards(
     if 'replication_type' not in experiment or experiment['replication_type'] == 'unreplicated':
         return
 
-    idr_metrics = get_metrics(idr_peaks_files, 'IDRQualityMetric')
+    idr_metrics = files_structure['graph'].metrics('optimal_idr_peaks', 'IDRQualityMetric')
     yield from check_idr(idr_metrics, 2, 2)
     return
 
@@ -2167,12 +2157,10 @@ def audit_experiment_replicate_with_no_files(value, system, files_structure):
         rep_numbers[rep['@id']] = (rep['biological_replicate_number'],
                                    rep['technical_replicate_number'])
 
-    for file_object in files_structure.get('original_files').values():
-        file_replicate = file_object.get('replicate')
-        if file_replicate:
-            if file_replicate['@id'] in rep_dictionary:
-                rep_dictionary[file_replicate['@id']].append(
-                    file_object['output_category'])
+    files_by_replicate = files_structure['graph'].by_replicate
+    for replicate_id in rep_dictionary:
+        for file_object in files_by_replicate.get(replicate_id, []):
+            rep_dictionary[replicate_id].append(file_object['output_category'])
 
     audit_level = 'ERROR'
 
@@ -2668,7 +2656,7 @@ def audit_experiment_platforms_mismatches(value, system, files_structure):
             for control in value['possible_controls']:
                 if control.get('original_files'):
                     control_platforms = get_platforms_used_in_experiment(
-                        create_files_mapping(control.get('original_files'), files_structure.get('excluded_types')))
+                        files_structure['graph'].control_files_structure(control))
                     if len(control_platforms) > 1:
                         control_platforms_string = str(
                             list(control_platforms)).replace('\'', '')
@@ -3108,9 +3096,7 @@ def audit_experiment_mapped_read_length(value, system, files_structure):
         return
     for peaks_file in files_structure.get('peaks_files').values():
         if peaks_file.get('lab') == '/labs/encode-processing-pipeline/':
-            derived_from_bams = get_derived_from_files_set(
-                [peaks_file], files_structure, 'bam', True)
-            #derived_from_bams = get_derived_from_files_set([peaks_file], 'bam', True)
+            derived_from_bams = files_structure['graph'].derived_from_files(peaks_file, 'bam')
             read_lengths_set = set()
             for bam_file in derived_from_bams:
                 if bam_file.get('lab') == '/labs/encode-processing-pipeline/':
@@ -3190,8 +3176,7 @@ def get_mapped_length(bam_file, files_structure):
     mapped_length = bam_file.get('mapped_read_length')
     if mapped_length:
         return mapped_length
-    derived_from_fastqs = get_derived_from_files_set(
-        [bam_file], files_structure, 'fastq', True)
+    derived_from_fastqs = files_structure['graph'].derived_from_files(bam_file, 'fastq')
     for f in derived_from_fastqs:
         length = f.get('read_length')
         if length:
@@ -3462,6 +3447,97 @@ def get_chip_seq_bam_read_depth(bam_file):
     return read_depth
 
 
+class ExperimentFileGraph(object):
+    '''
+    Indexes over the files of a files_structure, for checks that would otherwise
+    rescan every file for every file they look at.  Built once per structure (on
+    first use of each index) and shared by all the checks of an audit.
+    '''
+
+    def __init__(self, files_structure):
+        self.files_structure = files_structure
+        self._derived_from_files = {}
+        self._pipelines = {}
+        self._replicate_fastqs = {}
+        self._control_structures = {}
+        self._metrics_by_type = {}
+
+    def derived_from_files(self, file_object, file_format):
+        # Same as get_derived_from_files_set([file_object], files_structure, file_format, True)
+        key = (file_object.get('@id'), file_format)
+        if key not in self._derived_from_files:
+            self._derived_from_files[key] = get_derived_from_files_set(
+                [file_object], self.files_structure, file_format, True)
+        return self._derived_from_files[key]
+
+    def metrics(self, file_type, metric_type, desired_assembly=None, desired_annotation=None):
+        ''' Same as get_metrics(files_structure[file_type].values(), metric_type, ...) '''
+        if file_type not in self._metrics_by_type:
+            by_type = {}
+            for f in self.files_structure.get(file_type).values():
+                for qm in f.get('quality_metrics') or []:
+                    for qm_type in qm['@type']:
+                        by_type.setdefault(qm_type, []).append((f, qm))
+            self._metrics_by_type[file_type] = by_type
+        metrics = {}
+        for (f, qm) in self._metrics_by_type[file_type].get(metric_type, []):
+            if (desired_assembly is None or f.get('assembly') == desired_assembly) and \
+               (desired_annotation is None or f.get('genome_annotation') == desired_annotation):
+                metrics.setdefault(qm['uuid'], qm)
+        return list(metrics.values())
+
+    @reify
+    def by_replicate(self):
+        ''' replicate @id => original files of the replicate '''
+        by_replicate = {}
+        for f in self.files_structure.get('original_files').values():
+            if f.get('replicate'):
+                by_replicate.setdefault(f['replicate']['@id'], []).append(f)
+        return by_replicate
+
+    def replicate_fastqs(self, replicate_type, replicates):
+        ''' fastq_files in any of the replicates (numbers in the replicate_type list) '''
+        if replicate_type not in self._replicate_fastqs:
+            by_replicate = {}
+            for f in self.files_structure.get('fastq_files').values():
+                for replicate in set(f.get(replicate_type, [])):
+                    by_replicate.setdefault(replicate, []).append(f)
+            self._replicate_fastqs[replicate_type] = by_replicate
+        by_replicate = self._replicate_fastqs[replicate_type]
+        found = {}
+        for replicate in replicates:
+            for f in by_replicate.get(replicate, []):
+                found[f['@id']] = f
+        return list(found.values())
+
+    @reify
+    def unfiltered_alignments_by_assembly(self):
+        by_assembly = {}
+        for f in self.files_structure.get('unfiltered_alignments').values():
+            if 'assembly' in f:
+                by_assembly.setdefault(f['assembly'], []).append(f)
+        return by_assembly
+
+    def unfiltered_alignments_like(self, filtered_bam):
+        ''' The unfiltered alignments has_no_unfiltered() could match filtered_bam with '''
+        return self.unfiltered_alignments_by_assembly.get(filtered_bam.get('assembly'), [])
+
+    def pipelines(self, file_type):
+        ''' get_pipeline_objects() of all the files_structure[file_type] files '''
+        if file_type not in self._pipelines:
+            self._pipelines[file_type] = get_pipeline_objects(
+                self.files_structure.get(file_type).values())
+        return self._pipelines[file_type]
+
+    def control_files_structure(self, control):
+        # Checks may add to excluded_types as they go, so structures are kept per excluded_types
+        excluded = self.files_structure.get('excluded_types')
+        key = (control.get('@id'), tuple(excluded))
+        if key not in self._control_structures:
+            self._control_structures[key] = create_files_mapping(control.get('original_files'), excluded)
+        return self._control_structures[key]
+
+
 def create_files_mapping(files_list, excluded):
     to_return = {'original_files': {},
                  'fastq_files': {},
@@ -3524,6 +3600,7 @@ def create_files_mapping(files_list, excluded):
                 if file_output and file_output == 'methylation state at CpG':
                     to_return['cpg_quantifications'][file_object['@id']
                                                      ] = file_object
+    to_return['graph'] = ExperimentFileGraph(to_return)
     return to_return
 
 
@@ -3588,8 +3665,8 @@ def is_outdated_bams_replicate(bam_file, files_structure, assay_name):
            file_id not in files_structure.get('contributing_files'):
             return True
 
-    derived_from_fastqs = get_derived_from_files_set(
-        [bam_file], files_structure, 'fastq', True)
+    graph = files_structure['graph']
+    derived_from_fastqs = graph.derived_from_files(bam_file, 'fastq')
 
     # if there are no FASTQs we can not find our the replicate
     if len(derived_from_fastqs) == 0:
@@ -3612,15 +3689,7 @@ def is_outdated_bams_replicate(bam_file, files_structure, assay_name):
         return True
 
 
-    rep_type_fastqs = [
-        f for f in files_structure.get('fastq_files').values()
-        if replicate_type in f
-    ]
-    rep_set = set(rep)
-    rep_fastqs = [
-        f for f in rep_type_fastqs
-        if any(e in rep_set for e in set(f[replicate_type]))
-    ]
+    rep_fastqs = graph.replicate_fastqs(replicate_type, set(rep))
 
     replicate_fastq_accessions = get_file_accessions(rep_fastqs)
     for file_object in rep_fastqs:
@@ -1,12 +1,75 @@
+from pyramid.settings import asbool
+from pyramid.traversal import find_resource
 from snovault import (
     AuditFailure,
     audit_checker,
 )
 from snovault import (
+    CONNECTION,
     UPGRADER,
+    Item,
+)
+from snovault.cache import ManagerLRUCache
+from snovault.schema_utils import (
+    IgnoreUnchanged,
+    NoRemoteResolver,
+    SchemaValidator,
+    format_checker,
 )
-from snovault.schema_utils import validate
 from snovault.util import simple_path_ids
+from sqlalchemy.util import LRUCache
+import threading
+from ..object_cache import count
+
+
+# Compiled validators by (type name, schema_version). SchemaValidator keeps
+# state while it validates, so each thread has its own.
+schema_validators = threading.local()
+
+# The (schema_version, tid) each item last validated without errors at, by uuid
+validated_revisions = LRUCache(100000)
+
+
+def schema_validator(context):
+    '''
+    The compiled SchemaValidator for the schema of context's type.
+    '''
+    validators = schema_validators.__dict__.setdefault('validators', {})
+    key = (context.type_info.name, context.type_info.schema_version)
+    validator = validators.get(key)
+    if validator is None or validator.schema is not context.schema:
+        schema = context.schema
+        validator = SchemaValidator(
+            schema, resolver=NoRemoteResolver.from_schema(schema),
+            serialize=True, format_checker=format_checker)
+        validators[key] = validator
+    return validator
+
+
+def validate_properties(context, properties):
+    '''
+    snovault.schema_utils.validate(context.schema, properties, properties),
+    with the cached validator.
+    '''
+    validated, errors = schema_validator(context).serialize(properties)
+    filtered_errors = []
+    for error in errors:
+        # Possibly ignore validation if it results in no change to data
+        if isinstance(error, IgnoreUnchanged):
+            current_value = properties
+            try:
+                for key in error.path:
+                    current_value = current_value[key]
+            except Exception:
+                pass
+            else:
+                validated_value = validated
+                for key in error.path:
+                    validated_value = validated_value[key]
+                if validated_value == current_value:
+                    continue
+        filtered_errors.append(error)
+    return validated, filtered_errors
 
 
 @audit_checker('Item', frame='object')
@@ -19,7 +82,17 @@ def audit_item_schema(value, system):
     properties = context.properties.copy()
     current_version = properties.get('schema_version', '')
     target_version = context.type_info.schema_version
-    if target_version is not None and current_version != target_version:
+    revision = None
+    if target_version is None or current_version == target_version:
+        # Up to date, so unless it was written since it last validated there
+        # is nothing to do
+        if asbool(registry.settings.get('audit.skip_unchanged_validation', False)):
+            tid = getattr(context.model, 'tid', None)
+            if tid is not None:
+                revision = (target_version, tid)
+                if validated_revisions.get(str(context.uuid)) == revision:
+                    return
+    else:
         upgrader = registry[UPGRADER]
         try:
             properties = upgrader.upgrade(
@@ -36,7 +109,9 @@ def audit_item_schema(value, system):
         properties['schema_version'] = target_version
 
     properties['uuid'] = str(context.uuid)
-    validated, errors = validate(context.schema, properties, properties)
+    validated, errors = validate_properties(context, properties)
+    if not errors and revision is not None:
+        validated_revisions[str(context.uuid)] = revision
     for error in errors:
         category = 'validation error'
         path = list(error.path)
@@ -78,6 +153,88 @@ STATUS_LEVEL = {
 }
 
 
+# status/@type/@id of linked items by path, for the current transaction (an
+# indexing batch, or a single request)
+linked_status_cache = ManagerLRUCache('encoded.audit.linked_status', 10000)
+
+
+def _linked_status(request, path):
+    '''
+    The status, @type and @id of the item at path, as its @@object frame
+    would have them. Returns whether request.embed was needed too.
+    '''
+    cached = request.registry[CONNECTION].embed_cache.get(path + '@@object')
+    if cached is not None:
+        linked_value = cached[0]
+    else:
+        try:
+            item = find_resource(request.root, path)
+        except KeyError:
+            item = None
+        if isinstance(item, Item):
+            properties = item.upgrade_properties()
+            linked = {
+                '@id': request.resource_path(item),
+                '@type': item.jsonld_type(),
+                'uuid': str(item.uuid),
+            }
+            if 'status' in properties:
+                linked['status'] = properties['status']
+            return linked, False
+        linked_value = request.embed(path + '@@object')
+    linked = {
+        key: linked_value[key]
+        for key in ['@id', '@type', 'uuid', 'status']
+        if key in linked_value
+    }
+    return linked, cached is None
+
+
+def linked_statuses(request, paths):
+    '''
+    Resolve the status, @type and @id of the items at paths, without rendering
+    each one's @@object frame in a subrequest.
+
+    Each path is looked up once per transaction and memoized in
+    linked_status_cache. The number of embeds avoided is
+    added to the root request's stats (X-Stats audit_embed_avoided_count).
+    '''
+    cache = linked_status_cache.cache
+    if cache is None:
+        cache = {}
+    paths = set(paths)
+    results = {}
+    avoided = 0
+    for path in paths:
+        linked = cache.get(path)
+        if linked is None:
+            linked, embedded = _linked_status(request, path)
+            cache[path] = linked
+            avoided += not embedded
+        else:
+            avoided += 1
+        # The audit depends on the linked item, so reindex when it changes
+        if 'uuid' in linked:
+            request._embedded_uuids.add(linked['uuid'])
+        results[path] = linked
+
+    count(request, 'audit_embed_avoided_count', avoided)
+    return results
+
+
+def item_linked_statuses(value, context, request):
+    '''
+    linked_statuses for the links of value checked by either status audit, so
+    that the two share one batch.
+    '''
+    paths = set()
+    for schema_path in context.type_info.schema_links:
+        if schema_path in ['step_run', 'elements']:
+            continue
+        paths.update(simple_path_ids(value, schema_path))
+    return linked_statuses(request, paths)
+
+
 @audit_checker('Item', frame='object')
 def audit_item_relations_status(value, system):
     if 'status' not in value:
@@ -87,11 +244,12 @@ def audit_item_relations_status(value, system):
 
     context = system['context']
     request = system['request']
+    linked_values = item_linked_statuses(value, context, request)
 
     for schema_path in context.type_info.schema_links:
         if schema_path in ['supersedes']:
             for path in simple_path_ids(value, schema_path):
-                linked_value = request.embed(path + '@@object')
+                linked_value = linked_values[path]
                 if 'status' not in linked_value:
                     continue
                 else:
@@ -129,7 +287,7 @@ def audit_item_relations_status(value, system):
             elif schema_path == 'controlled_by':
                 message = 'is controlled by'
             for path in simple_path_ids(value, schema_path):
-                linked_value = request.embed(path + '@@object')
+                linked_value = linked_values[path]
                 if 'status' not in linked_value:
                     continue
                 else:
@@ -178,8 +336,9 @@ def audit_item_status(value, system):
         else:
             linked.update(simple_path_ids(value, schema_path))
 
+    linked_values = item_linked_statuses(value, context, request)
     for path in linked:
-        linked_value = request.embed(path + '@@object')
+        linked_value = linked_values[path]
         if 'status' not in linked_value:
             continue
         if linked_value['status'] == 'disabled':
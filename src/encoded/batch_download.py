@@ -1,23 +1,39 @@
-from collections import OrderedDict
-from pyramid.compat import bytes_
+from collections import (
+    OrderedDict,
+    deque,
+)
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from elasticsearch.exceptions import ElasticsearchException
 from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.view import view_config
-from pyramid.response import Response
 from snovault import TYPES
+from snovault.elasticsearch.interfaces import (
+    ELASTIC_SEARCH,
+    RESOURCES_INDEX,
+)
 from snovault.util import simple_path_ids
 from urllib.parse import (
     parse_qs,
     urlencode,
 )
 from encoded.viewconfigs.views import search
+from encoded.region_indexer import region_doc_uuid
 from snovault.helpers.helper import list_visible_columns_for_schemas
 import csv
 import io
 import json
 import datetime
+import logging
 import re
 
+log = logging.getLogger(__name__)
+
 ELEMENT_CHUNK_SIZE = 1000
+CART_SEARCH_WORKERS = 4  # Cart chunks whose hits are read from elasticsearch ahead of the response
+REPORT_ROWS_PER_CHUNK = 500
+TSV_CHUNK_SIZE = 65536
 currenttime = datetime.datetime.now()
 
 
@@ -210,31 +226,71 @@ def make_audit_cell(header_column, experiment_json, file_json):
     return ', '.join(list(set(data)))
 
 
-def _get_annotation_metadata(request, search_path, param_list):
+def _search_results(context, request, search_path, param_list):
+    """
+    Iterate over the results of a search with limit=all.
+
+    /search/ is run on this request as a generator, so results stream from
+    elasticsearch as they are read. Other referrers are embedded up front.
+    """
+    if search_path != '/search/':
+        path = '{}?{}'.format(search_path, urlencode(param_list, True))
+        return iter(request.embed(path, as_user=True)['@graph'])
+    request.query_string = urlencode(param_list, True)
+
+    def results():
+        for result in search(context, request, return_generator=True):
+            yield result
+    return results()
+
+
+def _tsv_chunks(header, row_groups):
+    """
+    Yield tab separated bytes: the header, then the rows of each group.
+
+    Groups are buffered until at least TSV_CHUNK_SIZE characters are waiting,
+    so memory stays bounded while chunks stay a reasonable size.
+    """
+    fout = io.StringIO()
+    writer = csv.writer(fout, delimiter='\t')
+    writer.writerow(header)
+    for rows in row_groups:
+        writer.writerows(rows)
+        if fout.tell() >= TSV_CHUNK_SIZE:
+            yield fout.getvalue().encode('utf-8')
+            fout.seek(0)
+            fout.truncate()
+    yield fout.getvalue().encode('utf-8')
+
+
+def _stream_tsv(request, header, row_groups, filename):
+    # Stream response using chunked encoding.
+    request.response.content_type = 'text/tsv'
+    request.response.content_disposition = 'attachment;filename="%s"' % filename
+    request.response.app_iter = _tsv_chunks(header, row_groups)
+    return request.response
+
+
+def _get_annotation_metadata(context, request, search_path, param_list):
     """
     Get anotation data.
 
+        :param context: Pyramid context
         :param request: Pyramid request
         :param search_path: Search url
         :param param_list: Initial param_list
     """
     header = [header for header in _tsv_mapping_annotation if header not in _excluded_columns]
     header.extend([prop for prop in _audit_mapping])
-    fout = io.StringIO()
-    writer = csv.writer(fout, delimiter='\t')
-    writer.writerow(header)
     param_list['limit'] = ['all']
-    fields = [''.join(['&field=', str(value[0])]) for _, value in _tsv_mapping_annotation.items()]
-    path = '{}?{}{}'.format(
-        search_path,
-        urlencode(param_list, True),
-        ''.join(fields)
-    )
-    results = request.embed(path, as_user=True)
-    for result_graph in results['@graph']:
+    param_list['field'] = [value[0] for _, value in _tsv_mapping_annotation.items()]
+    file_types = param_list.get('files.file_type')
+
+    def annotation_rows(result_graph):
+        rows = []
         result_files = result_graph.get('files', {})
         if not result_files:
-            continue
+            return rows
         software = [s for s in result_graph.get('software_used', {})]
         software_set = ', '.join([s['software']['title'] for s in software])
         for result_file in result_files:
@@ -242,7 +298,7 @@ def _get_annotation_metadata(request, search_path, param_list):
                 continue
             if is_no_file_available(result_file):
                 continue
-            if param_list.get('files.file_type') and result_file['file_type'] not in param_list['files.file_type']:
+            if file_types and result_file['file_type'] not in file_types:
                 continue
             row = [
                 result_file.get('title', ''),
@@ -277,12 +333,85 @@ def _get_annotation_metadata(request, search_path, param_list):
             row.extend(
                 [make_audit_cell(audit_type, result_graph, result_file) for audit_type in _audit_mapping]
             )
-            writer.writerow(row)
-    return Response(
-        content_type='text/tsv',
-        body=fout.getvalue(),
-        content_disposition='attachment;filename="%s"' % 'metadata.tsv'
+            rows.append(row)
+        return rows
+
+    results = _search_results(context, request, search_path, param_list)
+    return _stream_tsv(request, header, (annotation_rows(result) for result in results), 'metadata.tsv')
+
+
+def _embedded_items(request, field, values, memo):
+    """
+    Resolve items by a field of their embedded frame, in batches.
+
+    Items are looked up in the elasticsearch resources index ELEMENT_CHUNK_SIZE
+    at a time rather than with one subrequest each. Anything es doesn't have
+    (e.g. not yet indexed) falls back to request.embed. Results are kept in
+    memo, so each item is fetched once per request.
+
+        :param request: Pyramid request
+        :param field: Embedded field to match, e.g. 'uuid' or '@id'
+        :param values: Values of that field to resolve
+        :param memo: Dict of value to embedded item, updated in place
+    """
+    missing = [value for value in set(values) if value not in memo]
+    if not missing:
+        return memo
+    es = request.registry.get(ELASTIC_SEARCH)
+    if es is not None:
+        for start in range(0, len(missing), ELEMENT_CHUNK_SIZE):
+            chunk = missing[start:start + ELEMENT_CHUNK_SIZE]
+            query = {
+                'query': {'terms': {'embedded.' + field: chunk}},
+                '_source': ['embedded'],
+            }
+            try:
+                res = es.search(index=RESOURCES_INDEX, body=query, size=len(chunk))
+            except ElasticsearchException:
+                log.warning('Falling back to embed for %d items', len(chunk), exc_info=True)
+                break
+            for hit in res['hits']['hits']:
+                item = hit['_source']['embedded']
+                memo[item[field]] = item
+    for value in missing:
+        if value not in memo:
+            memo[value] = request.embed(value)
+    return memo
+
+
+def _peak_metadata_rows(request, results):
+    """
+    One [assay, coordinates, target, biosamples, file, experiment] row per
+    peak of the region search results.
+
+    Files and experiments are resolved here, on the request's thread, since
+    the embed fallback needs its transaction. The returned generator only
+    formats rows, so it is safe to consume from app_iter.
+    """
+    uuids_in_results = set(get_file_uuids(results))
+    peaks = [
+        (region_doc_uuid(row['_id']), row) for row in results['peaks']
+    ]
+    peaks = [(file_uuid, row) for file_uuid, row in peaks if file_uuid in uuids_in_results]
+    files = _embedded_items(request, 'uuid', [file_uuid for file_uuid, _ in peaks], {})
+    experiments = _embedded_items(
+        request, '@id', [file_json['dataset'] for file_json in files.values()], {}
     )
+    return _format_peak_metadata_rows(peaks, files, experiments)
+
+
+def _format_peak_metadata_rows(peaks, files, experiments):
+    for file_uuid, row in peaks:
+        file_json = files[file_uuid]
+        experiment_json = experiments[file_json['dataset']]
+        file_accession = file_json['accession']
+        experiment_accession = experiment_json['accession']
+        assay_name = experiment_json['assay_term_name']
+        target_name = experiment_json.get('target', {}).get('label') # not all experiments have targets
+        biosample_accession = get_biosample_accessions(file_json, experiment_json)
+        for hit in row['inner_hits']['positions']['hits']['hits']:
+            coordinates = '{}:{}-{}'.format(row['_index'], hit['_source']['start'], hit['_source']['end'])
+            yield [assay_name, coordinates, target_name, biosample_accession, file_accession, experiment_accession]
 
 
 @view_config(route_name='peak_metadata', request_method='GET')
@@ -293,48 +422,24 @@ def peak_metadata(context, request):
     param_list['limit'] = ['all']
     path = '/region-search/?{}&{}'.format(urlencode(param_list, True),'referrer=peak_metadata')
     results = request.embed(path, as_user=True)
-    uuids_in_results = get_file_uuids(results)
-    rows = []
-    json_doc = {}
-    for row in results['peaks']:
-        if row['_id'] in uuids_in_results:
-            file_json = request.embed(row['_id'])
-            experiment_json = request.embed(file_json['dataset'])
-            for hit in row['inner_hits']['positions']['hits']['hits']:
-                data_row = []
-                coordinates = '{}:{}-{}'.format(row['_index'], hit['_source']['start'], hit['_source']['end'])
-                file_accession = file_json['accession']
-                experiment_accession = experiment_json['accession']
-                assay_name = experiment_json['assay_term_name']
-                target_name = experiment_json.get('target', {}).get('label') # not all experiments have targets
-                biosample_accession = get_biosample_accessions(file_json, experiment_json)
-                data_row.extend([assay_name, coordinates, target_name, biosample_accession, file_accession, experiment_accession])
-                rows.append(data_row)
-                if assay_name not in json_doc:
-                    json_doc[assay_name] = []
-                else:
-                    json_doc[assay_name].append({
-                        'coordinates': coordinates,
-                        'target.name': target_name,
-                        'biosample.accession': list(biosample_accession.split(', ')),
-                        'file.accession': file_accession,
-                        'experiment.accession': experiment_accession
-                    })
+    rows = _peak_metadata_rows(request, results)
     if 'peak_metadata.json' in request.url:
-        return Response(
-            content_type='text/plain',
-            body=json.dumps(json_doc),
-            content_disposition='attachment;filename="%s"' % 'peak_metadata.json'
+        json_doc = {}
+        for assay_name, coordinates, target_name, biosample_accession, file_accession, experiment_accession in rows:
+            json_doc.setdefault(assay_name, []).append({
+                'coordinates': coordinates,
+                'target.name': target_name,
+                'biosample.accession': list(biosample_accession.split(', ')),
+                'file.accession': file_accession,
+                'experiment.accession': experiment_accession
+            })
+        request.response.content_type = 'text/plain'
+        request.response.content_disposition = 'attachment;filename="%s"' % 'peak_metadata.json'
+        request.response.app_iter = (
+            chunk.encode('utf-8') for chunk in json.JSONEncoder().iterencode(json_doc)
         )
-    fout = io.StringIO()
-    writer = csv.writer(fout, delimiter='\t')
-    writer.writerow(header)
-    writer.writerows(rows)
-    return Response(
-        content_type='text/tsv',
-        body=fout.getvalue(),
-        content_disposition='attachment;filename="%s"' % 'peak_metadata.tsv'
-    )
+        return request.response
+    return _stream_tsv(request, header, ([row] for row in rows), 'peak_metadata.tsv')
 
 
 @view_config(route_name='metadata', request_method='GET')
@@ -346,7 +451,7 @@ def metadata_tsv(context, request):
         search_path = '/search/'
     type_param = param_list.get('type', [''])[0]
     if type_param and type_param.lower() == 'annotation':
-        return _get_annotation_metadata(request, search_path, param_list)
+        return _get_annotation_metadata(context, request, search_path, param_list)
     param_list['field'] = []
     header = []
     file_attributes = []
@@ -382,10 +487,10 @@ def metadata_tsv(context, request):
             param_list['@id'] = elements
 
     param_list['limit'] = ['all']
-    path = '{}?{}'.format(search_path, urlencode(param_list, True))
-    results = request.embed(path, as_user=True)
-    rows = []
-    for experiment_json in results['@graph']:
+    file_types = param_list.get('files.file_type')
+
+    def experiment_rows(experiment_json):
+        rows = []
         if experiment_json.get('files', []):
             exp_data_row = []
             for column in header:
@@ -396,8 +501,8 @@ def metadata_tsv(context, request):
                             'files.output_type']
 
             for f in experiment_json['files']:
-                if 'files.file_type' in param_list:
-                    if f['file_type'] not in param_list['files.file_type']:
+                if file_types:
+                    if f['file_type'] not in file_types:
                         continue
                 if restricted_files_present(f):
                     continue
@@ -429,16 +534,45 @@ def metadata_tsv(context, request):
                 audit_info = [make_audit_cell(audit_type, experiment_json, f) for audit_type in _audit_mapping]
                 data_row.extend(audit_info)
                 rows.append(data_row)
-    fout = io.StringIO()
-    writer = csv.writer(fout, delimiter='\t')
-    header.extend([prop for prop in _audit_mapping])
-    writer.writerow(header)
-    writer.writerows(rows)
-    return Response(
-        content_type='text/tsv',
-        body=fout.getvalue(),
-        content_disposition='attachment;filename="%s"' % 'metadata.tsv'
-    )
+        return rows
+
+    results = _search_results(context, request, search_path, param_list)
+    tsv_header = header + [prop for prop in _audit_mapping]
+    return _stream_tsv(request, tsv_header, (experiment_rows(result) for result in results), 'metadata.tsv')
+
+
+def _cart_search_results(context, request, param_list, elements):
+    """
+    Iterate over the search results for a cart's elements, in cart order.
+
+    Because of potential number of datasets in the cart, the search is broken
+    into multiple searches of ELEMENT_CHUNK_SIZE datasets each. Like
+    _search_results, each is run on this request as a generator, so nothing
+    needs a subrequest. Their hits are read from elasticsearch on a pool of
+    CART_SEARCH_WORKERS, at most that many chunks ahead of the response.
+    """
+    def start_search(start):
+        chunk_params = dict(param_list, **{'@id': elements[start:start + ELEMENT_CHUNK_SIZE]})
+        request.query_string = urlencode(chunk_params, True)
+        return search(context, request, return_generator=True)
+
+    def results():
+        starts = iter(range(0, len(elements), ELEMENT_CHUNK_SIZE))
+        with ThreadPoolExecutor(max_workers=CART_SEARCH_WORKERS) as pool:
+            pending = deque(
+                pool.submit(list, start_search(start)) for start in islice(starts, CART_SEARCH_WORKERS)
+            )
+            try:
+                while pending:
+                    chunk = pending.popleft().result()
+                    for start in islice(starts, 1):
+                        pending.append(pool.submit(list, start_search(start)))
+                    for result in chunk:
+                        yield result
+            finally:
+                for future in pending:
+                    future.cancel()
+    return results()
 
 
 @view_config(route_name='batch_download', request_method=('GET', 'POST'))
@@ -448,8 +582,6 @@ def batch_download(context, request):
     param_list['field'] = ['files.href', 'files.file_type', 'files.restricted']
     param_list['limit'] = ['all']
 
-    experiments = []
-    error_message = None
     if request.method == 'POST':
         metadata_link = ''
         cart_uuid = None
@@ -476,23 +608,14 @@ def batch_download(context, request):
                 search_params=request.matchdict['search_params'],
                 elements_json=','.join('"{0}"'.format(element) for element in elements)
             )
-
-        # Because of potential number of datasets in the cart, break search
-        # into multiple searches of ELEMENT_CHUNK_SIZE datasets each.
-        for i in range(0, len(elements), ELEMENT_CHUNK_SIZE):
-            param_list['@id'] = elements[i:i + ELEMENT_CHUNK_SIZE]
-            path = '/search/?%s' % urlencode(param_list, True)
-            results = request.embed(path, as_user=True)
-            experiments.extend(results['@graph'])
+        experiments = _cart_search_results(context, request, param_list, elements)
     else:
-        # Regular batch download has single simple call to request.embed
+        # Regular batch download streams a single search
         metadata_link = '{host_url}/metadata/{search_params}/metadata.tsv'.format(
             host_url=request.host_url,
             search_params=request.matchdict['search_params']
         )
-        path = '/search/?%s' % urlencode(param_list, True)
-        results = request.embed(path, as_user=True)
-        experiments = results['@graph']
+        experiments = _search_results(context, request, '/search/', param_list)
 
     exp_files = (
             exp_file
@@ -500,24 +623,23 @@ def batch_download(context, request):
             for exp_file in exp.get('files', [])
     )
 
-    files = [metadata_link]
-    for exp_file in exp_files:
-        if not file_type_param_list(exp_file, param_list):
-            continue
-        elif restricted_files_present(exp_file):
-            continue
-        files.append(
-            '{host_url}{href}'.format(
+    def generate_lines():
+        yield metadata_link.encode('utf-8')
+        for exp_file in exp_files:
+            if not file_type_param_list(exp_file, param_list):
+                continue
+            elif restricted_files_present(exp_file):
+                continue
+            yield '\n{host_url}{href}'.format(
                 host_url=request.host_url,
                 href=exp_file['href'],
-            )
-        )
+            ).encode('utf-8')
 
-    return Response(
-        content_type='text/plain',
-        body='\n'.join(files),
-        content_disposition='attachment; filename="%s"' % 'files.txt'
-    )
+    # Stream response using chunked encoding.
+    request.response.content_type = 'text/plain'
+    request.response.content_disposition = 'attachment; filename="%s"' % 'files.txt'
+    request.response.app_iter = generate_lines()
+    return request.response
 
 
 def file_type_param_list(exp_file, param_list):
@@ -537,37 +659,101 @@ def is_no_file_available(exp_file):
     return exp_file.get('no_file_available', False)
     
 
-def lookup_column_value(value, path):
-    nodes = [value]
-    names = path.split('.')
-    for name in names:
-        nextnodes = []
-        for node in nodes:
-            if name not in node:
-                continue
-            value = node[name]
-            if isinstance(value, list):
-                nextnodes.extend(value)
-            else:
-                nextnodes.append(value)
-        nodes = nextnodes
-        if not nodes:
-            return ''
-    # if we ended with an embedded object, show the @id
-    if nodes and hasattr(nodes[0], '__contains__') and '@id' in nodes[0]:
-        nodes = [node['@id'] for node in nodes]
+def _dedupe(nodes):
+    """Order-preserving dedupe of column values; dicts compare as their str()."""
+    if isinstance(nodes[0], dict):
+        nodes = [str(n) if isinstance(n, dict) else n for n in nodes]
+    try:
+        return list(dict.fromkeys(nodes))
+    except TypeError:
+        pass
+    # Unhashable values (e.g. lists of lists) have to be compared one by one
     deduped_nodes = []
     for n in nodes:
         if isinstance(n, dict):
             n = str(n)
         if n not in deduped_nodes:
             deduped_nodes.append(n)
-    return u','.join(u'{}'.format(n) for n in deduped_nodes)
+    return deduped_nodes
+
+
+def _format_nodes(nodes):
+    first = nodes[0]
+    if type(first) is str:
+        if len(nodes) == 1:
+            return first
+        try:
+            return u','.join(dict.fromkeys(nodes))
+        except TypeError:
+            pass
+    # if we ended with an embedded object, show the @id
+    elif hasattr(first, '__contains__') and '@id' in first:
+        nodes = [node['@id'] for node in nodes]
+    return u','.join(map(u'{}'.format, _dedupe(nodes)))
+
+
+def compile_column(path):
+    """
+    Parse a dotted column path once into a function of an item returning the
+    column's text, as lookup_column_value would.
+    """
+    names = tuple(path.split('.'))
+    depth = len(names)
+
+    def collect(node, i, nodes):
+        # Depth first gives the same order as walking the path level by level
+        while i < depth:
+            name = names[i]
+            if name not in node:
+                return
+            node = node[name]
+            i += 1
+            if isinstance(node, list):
+                if i == depth:
+                    nodes.extend(node)
+                else:
+                    for child in node:
+                        collect(child, i, nodes)
+                return
+        nodes.append(node)
+
+    def extract(item):
+        nodes = []
+        collect(item, 0, nodes)
+        if not nodes:
+            return ''
+        if len(nodes) == 1:
+            node = nodes[0]
+            if type(node) is str:
+                return node
+            if isinstance(node, dict):
+                # an embedded object shows as its @id
+                return u'{}'.format(node['@id']) if '@id' in node else str(node)
+        return _format_nodes(nodes)
+
+    return extract
+
+
+@lru_cache(maxsize=1024)
+def column_extractor(path):
+    return compile_column(path)
+
+
+def lookup_column_value(value, path):
+    return column_extractor(path)(value)
 
 
 def format_row(columns):
     """Format a list of text columns as a tab-separated byte string."""
-    return b'\t'.join([bytes_(" ".join(c.strip('\t\n\r').split()), 'utf-8') for c in columns]) + b'\r\n'
+    return format_rows([columns])
+
+
+def format_rows(rows):
+    """Format lists of text columns as tab-separated lines, encoded once."""
+    return u''.join(
+        u'\t'.join([u' '.join(c.strip('\t\n\r').split()) for c in columns]) + u'\r\n'
+        for columns in rows
+    ).encode('utf-8')
 
 
 def _convert_camel_to_snake(type_str):
@@ -602,12 +788,19 @@ def report_download(context, request):
 
     header = [column.get('title') or field for field, column in columns.items()]
 
+    extractors = [column_extractor(path) for path in columns]
+
     def generate_rows():
         yield format_header(header)
         yield format_row(header)
+        rows = []
         for item in search(context, request, return_generator=True):
-            values = [lookup_column_value(item, path) for path in columns]
-            yield format_row(values)
+            rows.append([extract(item) for extract in extractors])
+            if len(rows) >= REPORT_ROWS_PER_CHUNK:
+                yield format_rows(rows)
+                rows = []
+        if rows:
+            yield format_rows(rows)
 
     
     # Stream response using chunked encoding.
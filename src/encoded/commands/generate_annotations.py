@@ -1,8 +1,22 @@
+"""\
+Generate the annotations file that index-annotations loads, for region search autocomplete.
+
+Gene lists are streamed row by row, coordinates are looked up with a bounded
+number of concurrent requests, and documents are written as newline delimited
+JSON (a bulk action line, then the document) as soon as they are ready.
+Lookups are kept in a sqlite cache (--cache), so a rerun only asks Ensembl
+and mygene.info about genes it hasn't seen before.
+"""
 import requests
 import json
+import os
 import re
 import time
-import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from encoded.coordinate_cache import CoordinateCache
 
 
 EPILOG = __doc__
@@ -14,6 +28,10 @@ _CE_FILE = 'https://www.encodeproject.org/files/ENCFF324UJT/@@download/ENCFF324U
 _ENSEMBL_URL = 'http://rest.ensembl.org/'
 _GENEINFO_URL = 'http://mygene.info/v2/gene/'
 
+_CACHE_FILE = 'annotations_cache.sqlite'
+_CACHE_TTL = 90 * 24 * 60 * 60
+# Too many concurrent requests and the remote responds with errors
+_WORKERS = 4
 
 
 def get_annotation():
@@ -26,33 +44,82 @@ def get_annotation():
 
 def rate_limited_request(url):
     response = requests.get(url)
-    if int(response.headers.get('X-RateLimit-Remaining')) < 2:
+    remaining = response.headers.get('X-RateLimit-Remaining')
+    if remaining is not None and int(remaining) < 2:
         print('spleeping for about {} seconds'.format(response.headers.get('X-RateLimit-Reset')))
         time.sleep(int(float(response.headers.get('X-RateLimit-Reset'))) + 1)
     return response.json()
 
 
+class AnnotationLookups(object):
+    '''Ensembl and mygene.info lookups, answered from a CoordinateCache when possible.
+       Failed lookups are not cached, so they are tried again by the next run.'''
 
-def assembly_mapper(location, species, input_assembly, output_assembly):
-    # All others
-    new_url = _ENSEMBL_URL + 'map/' + species + '/' \
-        + input_assembly + '/' + location + '/' + output_assembly \
-        + '/?content-type=application/json'
-    try:
-        new_response = rate_limited_request(new_url)
-    except:
-        return('', '', '')
-    else:
-        if not len(new_response['mappings']):
+    def __init__(self, cache, ensembl_url=_ENSEMBL_URL, geneinfo_url=_GENEINFO_URL):
+        self.cache = cache
+        self.ensembl_url = ensembl_url
+        self.geneinfo_url = geneinfo_url
+
+    def ensembl_gene(self, id):
+        key = 'annotations:lookup:{}'.format(id)
+        return self.cache.lookup(key, lambda: self._ensembl_gene(id))
+
+    def _ensembl_gene(self, id):
+        url = '{ensembl}lookup/id/{id}?content-type=application/json'.format(
+            ensembl=self.ensembl_url,
+            id=id)
+        try:
+            response = rate_limited_request(url)
+        except:
+            return None
+        if 'assembly_name' not in response:
+            return None
+        fields = ['assembly_name', 'seq_region_name', 'start', 'end', 'species']
+        return {field: response.get(field) for field in fields}
+
+    def assembly_mapper(self, location, species, input_assembly, output_assembly):
+        key = 'annotations:map:{}:{}:{}:{}'.format(species, input_assembly, location, output_assembly)
+        return tuple(self.cache.lookup(
+            key, lambda: self._assembly_mapper(location, species, input_assembly, output_assembly)))
+
+    def _assembly_mapper(self, location, species, input_assembly, output_assembly):
+        # All others
+        new_url = self.ensembl_url + 'map/' + species + '/' \
+            + input_assembly + '/' + location + '/' + output_assembly \
+            + '/?content-type=application/json'
+        try:
+            new_response = rate_limited_request(new_url)
+        except:
             return('', '', '')
-        data = new_response['mappings'][0]['mapped']
-        chromosome = data['seq_region_name']
-        start = data['start']
-        end = data['end']
-        return(chromosome, start, end)
+        else:
+            if not len(new_response.get('mappings', [])):
+                return('', '', '')
+            data = new_response['mappings'][0]['mapped']
+            chromosome = data['seq_region_name']
+            start = data['start']
+            end = data['end']
+            return(chromosome, start, end)
+
+    def mm9_position(self, id):
+        key = 'annotations:mm9:{}'.format(id)
+        return self.cache.lookup(key, lambda: self._mm9_position(id))
+
+    def _mm9_position(self, id):
+        mm9_url = '{geneinfo}{ensembl}?fields=genomic_pos_mm9'.format(
+            geneinfo=self.geneinfo_url,
+            ensembl=id
+        )
+        try:
+            response = requests.get(mm9_url).json()
+        except:
+            return None
+        if 'genomic_pos_mm9' in response and isinstance(response['genomic_pos_mm9'], dict):
+            position = response['genomic_pos_mm9']
+            return {'chr': position['chr'], 'start': position['start'], 'end': position['end']}
+        return None
 
 
-def human_single_annotation(r):
+def human_single_annotation(r, lookups):
         annotations = []
         species = ' (homo sapiens)'
         species_for_payload = re.split('[(|)]', species)[1]
@@ -88,34 +155,26 @@ def human_single_annotation(r):
             synonyms = [x.strip(' ') + species for x in r['Synonyms'].split(',')]
             doc['suggest']['input'] = doc['suggest']['input'] + synonyms
 
-        url = '{ensembl}lookup/id/{id}?content-type=application/json'.format(
-            ensembl=_ENSEMBL_URL,
-            id=r['Ensembl Gene ID'])
-
-        try:
-            response = rate_limited_request(url)
-        except:
+        response = lookups.ensembl_gene(r['Ensembl Gene ID'])
+        if response is None:
             return
-        else:
-            annotation = get_annotation()
-            if 'assembly_name' not in response:
-                return
-            annotation['assembly_name'] = response['assembly_name']
-            annotation['chromosome'] = response['seq_region_name']
-            annotation['start'] = response['start']
-            annotation['end'] = response['end']
-            doc['annotations'].append(annotation)
-
-            # Get GRcH37 annotation
-            location = response['seq_region_name'] \
-                + ':' + str(response['start']) \
-                + '-' + str(response['end'])
-            ann = get_annotation()
-            ann['assembly_name'] = 'GRCh37'
-            ann['chromosome'], ann['start'], ann['end'] = \
-                assembly_mapper(location, response['species'],
-                                'GRCh38', 'GRCh37')
-            doc['annotations'].append(ann)
+        annotation = get_annotation()
+        annotation['assembly_name'] = response['assembly_name']
+        annotation['chromosome'] = response['seq_region_name']
+        annotation['start'] = response['start']
+        annotation['end'] = response['end']
+        doc['annotations'].append(annotation)
+
+        # Get GRcH37 annotation
+        location = response['seq_region_name'] \
+            + ':' + str(response['start']) \
+            + '-' + str(response['end'])
+        ann = get_annotation()
+        ann['assembly_name'] = 'GRCh37'
+        ann['chromosome'], ann['start'], ann['end'] = \
+            lookups.assembly_mapper(location, response['species'],
+                                    'GRCh38', 'GRCh37')
+        doc['annotations'].append(ann)
         annotations.append({
             "index": {
                 "_index": "annotations",
@@ -124,11 +183,10 @@ def human_single_annotation(r):
             }
         })
         annotations.append(doc)
-        print('human {}'.format(time.time()))
         return annotations
 
 
-def mouse_single_annotation(r):
+def mouse_single_annotation(r, lookups):
     annotations = []
 
     if 'Chromosome Name' not in r:
@@ -157,22 +215,14 @@ def mouse_single_annotation(r):
         'end': r['Gene End (bp)']
     })
 
-    mm9_url = '{geneinfo}{ensembl}?fields=genomic_pos_mm9'.format(
-        geneinfo=_GENEINFO_URL,
-        ensembl=r['Ensembl Gene ID']
-    )
-    try:
-        response = requests.get(mm9_url).json()
-    except:
-        return
-    else:
-        if 'genomic_pos_mm9' in response and isinstance(response['genomic_pos_mm9'], dict):
-                ann = get_annotation()
-                ann['assembly_name'] = 'GRCm37'
-                ann['chromosome'] = response['genomic_pos_mm9']['chr']
-                ann['start'] = response['genomic_pos_mm9']['start']
-                ann['end'] = response['genomic_pos_mm9']['end']
-                doc['annotations'].append(ann)
+    position = lookups.mm9_position(r['Ensembl Gene ID'])
+    if position is not None:
+        ann = get_annotation()
+        ann['assembly_name'] = 'GRCm37'
+        ann['chromosome'] = position['chr']
+        ann['start'] = position['start']
+        ann['end'] = position['end']
+        doc['annotations'].append(ann)
     annotations.append({
         "index": {
             "_index": "annotations",
@@ -181,47 +231,58 @@ def mouse_single_annotation(r):
         }
     })
     annotations.append(doc)
-    print('mouse {}'.format(time.time()))
     return annotations
 
 
 def get_rows_from_file(file_name, row_delimiter):
-    response = requests.get(file_name)
-    rows = response.content.decode('utf-8').split(row_delimiter)
-    header = rows[0].split('\t')
-    zipped_rows = [dict(zip(header, row.split('\t'))) for row in rows[1:]]
-    return zipped_rows
-
-
-def prepare_for_bulk_indexing(annotations):
-    flattened_annotations = []
-    for annotation in annotations:
-        if annotation:
-            for item in annotation:
-                flattened_annotations.append(item)
-    return flattened_annotations
-
-
-def human_annotations(human_file):
+    '''Yields the rows of a remote TSV as dicts keyed by its header, as they are downloaded.'''
+    response = requests.get(file_name, stream=True)
+    response.encoding = 'utf-8'
+    try:
+        lines = response.iter_lines(decode_unicode=True, delimiter=row_delimiter)
+        header = None
+        for line in lines:
+            if not line:
+                continue
+            if header is None:
+                header = line.split('\t')
+                continue
+            yield dict(zip(header, line.split('\t')))
+    finally:
+        response.close()
+
+
+def bounded_map(function, items, workers):
+    '''Like map(), calling function in a pool of worker threads, with no more than a few
+       items per worker read ahead.  Results are yielded in order.'''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def human_annotations(human_file, lookups, workers=_WORKERS):
     """
-    Generates JSON from TSV files
+    Yields bulk action and document pairs for human genes
     """
-    zipped_rows = get_rows_from_file(human_file, '\r')
-    # Too many processes causes the http requests causes the remote to respond with error
-    pool = mp.Pool(processes=1)
-    annotations = pool.map(human_single_annotation, zipped_rows)
-    return prepare_for_bulk_indexing(annotations)
+    rows = get_rows_from_file(human_file, '\r')
+    for annotation in bounded_map(partial(human_single_annotation, lookups=lookups), rows, workers):
+        if annotation:
+            yield annotation
 
 
-def mouse_annotations(mouse_file):
+def mouse_annotations(mouse_file, lookups, workers=_WORKERS):
     """
-    Updates and get JSON file for mouse annotations
+    Yields bulk action and document pairs for mouse genes
     """
-    zipped_rows = get_rows_from_file(mouse_file, '\n')
-    # Too many processes causes the http requests causes the remote to respond with error
-    pool = mp.Pool(processes=1)
-    annotations = pool.map(mouse_single_annotation, zipped_rows)
-    return prepare_for_bulk_indexing(annotations)
+    rows = get_rows_from_file(mouse_file, '\n')
+    for annotation in bounded_map(partial(mouse_single_annotation, lookups=lookups), rows, workers):
+        if annotation:
+            yield annotation
 
 
 def other_annotations(file, species, assembly):
@@ -265,6 +326,22 @@ def other_annotations(file, species, assembly):
     return annotations
 
 
+def write_annotations(path, *sources):
+    '''Writes the (action, document) pairs of every source to path as newline delimited JSON.
+       The file is only replaced once it is complete.  Returns the number of documents.'''
+    count = 0
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as outfile:
+        for source in sources:
+            for annotation in source:
+                for item in annotation:
+                    outfile.write(json.dumps(item))
+                    outfile.write('\n')
+                count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
 def main():
     '''
     Get annotations from multiple sources
@@ -276,13 +353,25 @@ def main():
         epilog=EPILOG,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    human = human_annotations(_HGNC_FILE)
-    mouse = mouse_annotations(_MOUSE_FILE)
-    annotations = human + mouse
-
-    # Create annotations JSON file
-    with open('annotations_local.json', 'w') as outfile:
-        json.dump(annotations, outfile)
+    parser.add_argument('--output', default='annotations_local.json',
+                        help="Annotations file to write (newline delimited JSON)")
+    parser.add_argument('--cache', default=_CACHE_FILE, help="sqlite file of lookups kept between runs")
+    parser.add_argument('--workers', type=int, default=_WORKERS, help="Concurrent lookups")
+    parser.add_argument('--ensembl-url', default=_ENSEMBL_URL, help="Ensembl REST API")
+    parser.add_argument('--geneinfo-url', default=_GENEINFO_URL, help="mygene.info API")
+    parser.add_argument('--human-file', default=_HGNC_FILE, help="HGNC gene list")
+    parser.add_argument('--mouse-file', default=_MOUSE_FILE, help="Ensembl mouse gene list")
+    args = parser.parse_args()
+
+    cache = CoordinateCache(args.cache, ttl=_CACHE_TTL)
+    lookups = AnnotationLookups(cache, args.ensembl_url, args.geneinfo_url)
+    count = write_annotations(
+        args.output,
+        human_annotations(args.human_file, lookups, args.workers),
+        mouse_annotations(args.mouse_file, lookups, args.workers),
+    )
+    print('Wrote {} annotations to {} ({} cached lookups, {} new)'.format(
+        count, args.output, cache.hits, cache.misses))
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 from rdflib import ConjunctiveGraph, exceptions, Namespace
 from rdflib import RDFS, RDF, BNode
 from rdflib.collection import Collection
+from concurrent.futures import ProcessPoolExecutor
 import json
 
 EPILOG = __doc__
@@ -812,63 +813,131 @@ def splitNameFromNamespace(aUri):
     return (name, ns)
 
 
-def iterativeChildren(nodes, terms, closure):
-    if closure == 'data':
-        data = 'data'
-    else:
-        data = 'data_with_develops_from'
-    results = []
-    while 1:
-        newNodes = []
-        if len(nodes) == 0:
-            break
-        for node in nodes:
-            results.append(node)
-            if terms[node][data]:
-                for child in terms[node][data]:
-                    if child not in results:
-                        newNodes.append(child)
-        nodes = list(set(newNodes))
-    return list(set(results))
-
-
-def getSlims(goid, terms, slimType):
-    ''' Get Slims '''
-
-    slims = []
-    slimTerms = {}
+SLIM_TYPES = [
+    # (term field, slim type)
+    ('systems', 'system'),
+    ('organs', 'organ'),
+    ('cells', 'cell'),
+    ('developmental', 'developmental'),
+    ('assay', 'assay'),
+    ('category', 'category'),
+    ('objectives', 'objective'),
+    ('types', 'type'),
+]
+
+
+def getSlimTerms(slimType):
     if slimType == 'developmental':
-        slimTerms = developental_slims
+        return developental_slims
     elif slimType == 'organ':
-        slimTerms = organ_slims
+        return organ_slims
     elif slimType == 'cell':
-        slimTerms = cell_slims
+        return cell_slims
     elif slimType == 'system':
-        slimTerms = system_slims
+        return system_slims
     elif slimType == 'assay':
-        slimTerms = assay_slims
+        return assay_slims
     elif slimType == 'category':
-        slimTerms = category_slims
+        return category_slims
     elif slimType == 'objective':
-        slimTerms = objective_slims
+        return objective_slims
     elif slimType == 'type':
-        slimTerms = type_slims
-    for slimTerm in slimTerms:
-        if slimType == 'developmental':
-            if slimTerm in terms[goid]['closure_with_develops_from']:
-                slims.append(slimTerms[slimTerm])
-        else:
-            if slimTerm in terms[goid]['closure']:
-                slims.append(slimTerms[slimTerm])
-
-    if slim_shims.get(slimType, {}):
-        # Overrides all Ontology based-slims
-        shim = slim_shims[slimType].get(goid, '')
-        if shim:
-            slims = []
-            for i in shim:
-                slims.append(i)
-    return slims
+        return type_slims
+    return {}
+
+
+def stronglyConnected(nodes, edges):
+    ''' Yields the strongly connected components of a graph, each one after every
+        component it has edges to (Tarjan's algorithm, without recursion) '''
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(edges(root)))]
+        while work:
+            (node, children) = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(edges(child))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    yield component
+
+
+def closureBits(terms, data, bits):
+    ''' For every term, ORs together the bits of all terms in its closure over the
+        `data` edges (itself included).  Each closure is computed once, from those
+        of its parents, so the whole graph takes one pass. '''
+    def edges(node):
+        return terms[node][data] if node in terms else ()
+
+    closures = {}
+    for component in stronglyConnected(terms, edges):
+        closure = 0
+        for member in component:
+            closure |= bits.get(member, 0)
+            for parent in edges(member):
+                closure |= closures.get(parent, 0)  # 0 for members, which are ORed in themselves
+        for member in component:
+            closures[member] = closure
+    return closures
+
+
+def assignSlims(terms):
+    ''' Sets the slims of every term, from its closure over 'data' edges (or over
+        'data_with_develops_from' edges for developmental slims).  Only membership
+        of slim terms matters, so closures are bitsets over the slim terms. '''
+    closure_types = {
+        'data': [slimType for (_, slimType) in SLIM_TYPES if slimType != 'developmental'],
+        'data_with_develops_from': ['developmental'],
+    }
+    for (data, slimTypes) in closure_types.items():
+        bits = {}
+        for slimType in slimTypes:
+            for slimTerm in getSlimTerms(slimType):
+                bits.setdefault(slimTerm, 1 << len(bits))
+        closures = closureBits(terms, data, bits)
+        for (field, slimType) in SLIM_TYPES:
+            if slimType not in slimTypes:
+                continue
+            slimTerms = getSlimTerms(slimType)
+            shims = slim_shims.get(slimType, {})
+            mask = 0
+            for slimTerm in slimTerms:
+                mask |= bits[slimTerm]
+            slimsByClosure = {0: []}  # many terms have the same slims
+            for term in terms:
+                closure = closures[term] & mask
+                if closure not in slimsByClosure:
+                    slimsByClosure[closure] = [slimTerms[slimTerm] for slimTerm in slimTerms if closure & bits[slimTerm]]
+                slims = list(slimsByClosure[closure])
+                if shims.get(term, ''):
+                    # Overrides all Ontology based-slims
+                    slims = list(shims[term])
+                terms[term][field] = slims
 
 
 def getTermStructure():
@@ -884,10 +953,8 @@ def getTermStructure():
         'achieves_planned_objective': [],
         'organs': [],
         'cells': [],
-        'closure': [],
         'slims': [],
         'data': [],
-        'closure_with_develops_from': [],
         'data_with_develops_from': [],
         'synonyms': [],
         'category': [],
@@ -897,6 +964,112 @@ def getTermStructure():
     }
 
 
+def parseOntology(url):
+    ''' Returns the terms (getTermStructure) found in one ontology '''
+    terms = {}
+    data = Inspector(url)
+    for c in data.allclasses:
+        if isBlankNode(c):
+            for o in data.rdfGraph.objects(c, RDFS.subClassOf):
+                if isBlankNode(o):
+                    pass
+                else:
+                    for o1 in data.rdfGraph.objects(c, IntersectionOf):
+                        collection = Collection(data.rdfGraph, o1)
+                        col_list = []
+                        for col in data.rdfGraph.objects(collection[1]):
+                            col_list.append(col.__str__())
+                        if HUMAN_TAXON in col_list:
+                            if PART_OF in col_list:
+                                for subC in data.rdfGraph.objects(c, RDFS.subClassOf):
+                                    term_id = splitNameFromNamespace(collection[0])[0].replace('_', ':')
+                                    if term_id not in terms:
+                                        terms[term_id] = getTermStructure()
+                                    terms[term_id]['part_of'].append(splitNameFromNamespace(subC)[0].replace('_', ':'))
+                            elif DEVELOPS_FROM in col_list:
+                                for subC in data.rdfGraph.objects(c, RDFS.subClassOf):
+                                    term_id = splitNameFromNamespace(collection[0])[0].replace('_', ':')
+                                    if term_id not in terms:
+                                        terms[term_id] = getTermStructure()
+                                    terms[term_id]['develops_from'].append(splitNameFromNamespace(subC)[0].replace('_', ':'))
+        else:
+            term_id = splitNameFromNamespace(c)[0].replace('_', ':')
+            if term_id not in terms:
+                terms[term_id] = getTermStructure()
+            terms[term_id]['id'] = term_id
+            
+            try:
+                terms[term_id]['name'] = data.rdfGraph.label(c).__str__()
+            except:
+                terms[term_id]['name'] = ''
+
+            terms[term_id]['preferred_name'] = preferred_name.get(term_id, '')
+            # Get all parents
+            for parent in data.get_classDirectSupers(c, excludeBnodes=False):
+                if isBlankNode(parent):
+                    for s, v, o in data.rdfGraph.triples((parent, OnProperty, None)):
+                        if o.__str__() == PART_OF:
+                            for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
+                                if not isBlankNode(o1):
+                                    terms[term_id]['part_of'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
+                        elif o.__str__() == DEVELOPS_FROM:
+                            for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
+                                if not isBlankNode(o1):
+                                    terms[term_id]['develops_from'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
+                        elif o.__str__() == HAS_PART:
+                            for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
+                                if not isBlankNode(o1):
+                                    terms[term_id]['has_part'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
+                        elif o.__str__() == DERIVES_FROM:
+                            for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
+                                if not isBlankNode(o1):
+                                    terms[term_id]['derives_from'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
+                                else:
+                                    for o2 in data.rdfGraph.objects(o1, IntersectionOf):
+                                        for o3 in data.rdfGraph.objects(o2, RDF.first):
+                                            if not isBlankNode(o3):
+                                                terms[term_id]['derives_from'].append(splitNameFromNamespace(o3)[0].replace('_', ':'))
+                                        for o3 in data.rdfGraph.objects(o2, RDF.rest):
+                                            for o4 in data.rdfGraph.objects(o3, RDF.first):
+                                                for o5 in data.rdfGraph.objects(o4, SomeValuesFrom):
+                                                    for o6 in data.rdfGraph.objects(o5, IntersectionOf):
+                                                        for o7 in data.rdfGraph.objects(o6, RDF.first):
+                                                            if not isBlankNode(o7):
+                                                                terms[term_id]['derives_from'].append(splitNameFromNamespace(o7)[0].replace('_', ':'))
+                                                                for o8 in data.rdfGraph.objects(o6, RDF.rest):
+                                                                    for o9 in data.rdfGraph.objects(o8, RDF.first):
+                                                                        if not isBlankNode(o9):
+                                                                            terms[term_id]['derives_from'].append(splitNameFromNamespace(o9)[0].replace('_', ':'))
+                        elif o.__str__() == ACHIEVES_PLANNED_OBJECTIVE:
+                            for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
+                                if not isBlankNode(o1):
+                                    terms[term_id]['achieves_planned_objective'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
+                else:
+                    terms[term_id]['parents'].append(splitNameFromNamespace(parent)[0].replace('_', ':'))
+            
+            for syn in data.entitySynonyms(c):
+                try:
+                    terms[term_id]['synonyms'].append(syn.__str__())
+                except:
+                    pass
+    return terms
+
+
+def mergeTerms(terms, more):
+    ''' Adds terms of a later ontology, as if parsed into the same dict '''
+    for (term_id, term) in more.items():
+        if term_id not in terms:
+            terms[term_id] = term
+            continue
+        merged = terms[term_id]
+        for (field, value) in term.items():
+            if isinstance(value, list):
+                merged[field].extend(value)
+            elif term['id']:  # Only set for the ontology's own (not blank node) classes
+                merged[field] = value
+    return terms
+
+
 def main():
     ''' Downloads UBERON, EFO and OBI ontologies and create a JSON file '''
 
@@ -908,6 +1081,7 @@ def main():
     parser.add_argument('--uberon-url', help="Uberon version URL")
     parser.add_argument('--efo-url', help="EFO version URL")
     parser.add_argument('--obi-url', help="OBI version URL")
+    parser.add_argument('--parallel', action='store_true', help="Parse the ontologies in parallel processes")
     args = parser.parse_args()
 
     uberon_url = args.uberon_url
@@ -916,119 +1090,19 @@ def main():
     urls = [obi_url, uberon_url, efo_url]
 
     terms = {}
-    for url in urls:
-        data = Inspector(url)
-        for c in data.allclasses:
-            if isBlankNode(c):
-                for o in data.rdfGraph.objects(c, RDFS.subClassOf):
-                    if isBlankNode(o):
-                        pass
-                    else:
-                        for o1 in data.rdfGraph.objects(c, IntersectionOf):
-                            collection = Collection(data.rdfGraph, o1)
-                            col_list = []
-                            for col in data.rdfGraph.objects(collection[1]):
-                                col_list.append(col.__str__())
-                            if HUMAN_TAXON in col_list:
-                                if PART_OF in col_list:
-                                    for subC in data.rdfGraph.objects(c, RDFS.subClassOf):
-                                        term_id = splitNameFromNamespace(collection[0])[0].replace('_', ':')
-                                        if term_id not in terms:
-                                            terms[term_id] = getTermStructure()
-                                        terms[term_id]['part_of'].append(splitNameFromNamespace(subC)[0].replace('_', ':'))
-                                elif DEVELOPS_FROM in col_list:
-                                    for subC in data.rdfGraph.objects(c, RDFS.subClassOf):
-                                        term_id = splitNameFromNamespace(collection[0])[0].replace('_', ':')
-                                        if term_id not in terms:
-                                            terms[term_id] = getTermStructure()
-                                        terms[term_id]['develops_from'].append(splitNameFromNamespace(subC)[0].replace('_', ':'))
-            else:
-                term_id = splitNameFromNamespace(c)[0].replace('_', ':')
-                if term_id not in terms:
-                    terms[term_id] = getTermStructure()
-                terms[term_id]['id'] = term_id
-                
-                try:
-                    terms[term_id]['name'] = data.rdfGraph.label(c).__str__()
-                except:
-                    terms[term_id]['name'] = ''
-
-                terms[term_id]['preferred_name'] = preferred_name.get(term_id, '')
-                # Get all parents
-                for parent in data.get_classDirectSupers(c, excludeBnodes=False):
-                    if isBlankNode(parent):
-                        for s, v, o in data.rdfGraph.triples((parent, OnProperty, None)):
-                            if o.__str__() == PART_OF:
-                                for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
-                                    if not isBlankNode(o1):
-                                        terms[term_id]['part_of'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
-                            elif o.__str__() == DEVELOPS_FROM:
-                                for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
-                                    if not isBlankNode(o1):
-                                        terms[term_id]['develops_from'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
-                            elif o.__str__() == HAS_PART:
-                                for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
-                                    if not isBlankNode(o1):
-                                        terms[term_id]['has_part'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
-                            elif o.__str__() == DERIVES_FROM:
-                                for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
-                                    if not isBlankNode(o1):
-                                        terms[term_id]['derives_from'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
-                                    else:
-                                        for o2 in data.rdfGraph.objects(o1, IntersectionOf):
-                                            for o3 in data.rdfGraph.objects(o2, RDF.first):
-                                                if not isBlankNode(o3):
-                                                    terms[term_id]['derives_from'].append(splitNameFromNamespace(o3)[0].replace('_', ':'))
-                                            for o3 in data.rdfGraph.objects(o2, RDF.rest):
-                                                for o4 in data.rdfGraph.objects(o3, RDF.first):
-                                                    for o5 in data.rdfGraph.objects(o4, SomeValuesFrom):
-                                                        for o6 in data.rdfGraph.objects(o5, IntersectionOf):
-                                                            for o7 in data.rdfGraph.objects(o6, RDF.first):
-                                                                if not isBlankNode(o7):
-                                                                    terms[term_id]['derives_from'].append(splitNameFromNamespace(o7)[0].replace('_', ':'))
-                                                                    for o8 in data.rdfGraph.objects(o6, RDF.rest):
-                                                                        for o9 in data.rdfGraph.objects(o8, RDF.first):
-                                                                            if not isBlankNode(o9):
-                                                                                terms[term_id]['derives_from'].append(splitNameFromNamespace(o9)[0].replace('_', ':'))
-                            elif o.__str__() == ACHIEVES_PLANNED_OBJECTIVE:
-                                for o1 in data.rdfGraph.objects(parent, SomeValuesFrom):
-                                    if not isBlankNode(o1):
-                                        terms[term_id]['achieves_planned_objective'].append(splitNameFromNamespace(o1)[0].replace('_', ':'))
-                    else:
-                        terms[term_id]['parents'].append(splitNameFromNamespace(parent)[0].replace('_', ':'))
-                
-                for syn in data.entitySynonyms(c):
-                    try:
-                        terms[term_id]['synonyms'].append(syn.__str__())
-                    except:
-                        pass
+    if args.parallel:
+        with ProcessPoolExecutor(max_workers=len(urls)) as executor:
+            for more in executor.map(parseOntology, urls):
+                mergeTerms(terms, more)
+    else:
+        for url in urls:
+            mergeTerms(terms, parseOntology(url))
     for term in terms:
         terms[term]['data'] = list(set(terms[term]['parents']) | set(terms[term]['part_of']) | set(terms[term]['derives_from']) | set(terms[term]['achieves_planned_objective']))
         terms[term]['data_with_develops_from'] = list(set(terms[term]['data']) | set(terms[term]['develops_from']))
 
-    for term in terms:
-        words = iterativeChildren(terms[term]['data'], terms, 'data')
-        for word in words:
-            terms[term]['closure'].append(word)
-
-        d = iterativeChildren(terms[term]['data_with_develops_from'], terms, 'data_with_develops_from')
-        for dd in d:
-            terms[term]['closure_with_develops_from'].append(dd)
-       
-        terms[term]['closure'].append(term)
-        terms[term]['closure_with_develops_from'].append(term)
-
-        terms[term]['systems'] = getSlims(term, terms, 'system')
-        terms[term]['organs'] = getSlims(term, terms, 'organ')
-        terms[term]['cells'] = getSlims(term, terms, 'cell')
-        terms[term]['developmental'] = getSlims(term, terms, 'developmental')
-        terms[term]['assay'] = getSlims(term, terms, 'assay')
-        terms[term]['category'] = getSlims(term, terms, 'category')
-        terms[term]['objectives'] = getSlims(term, terms, 'objective')
-        terms[term]['types'] = getSlims(term, terms, 'type')
-
-        del terms[term]['closure'], terms[term]['closure_with_develops_from']
-    
+    assignSlims(terms)
+
     for term in terms:
         del terms[term]['parents'], terms[term]['develops_from']
         del terms[term]['has_part'], terms[term]['achieves_planned_objective']
@@ -91,6 +91,8 @@ def main():
     parser.add_argument('--attach', '-a', action='append', default=[],
         help="Directory to search for attachments")
     parser.add_argument('--app-name', help="Pyramid app name in configfile")
+    parser.add_argument('--workers', type=int, default=1,
+        help="Rows of an item type to send concurrently when loading everything")
     parser.add_argument('inpath',
         help="input zip file/directory of excel/csv/tsv sheets.")
     parser.add_argument('url',
@@ -122,7 +124,7 @@ def main():
     if args.method:
         run(testapp, args.inpath, args.attach, args.method, args.item_type, args.test_only)
     else:
-        loadxl.load_all(testapp, args.inpath, args.attach, args.test_only)
+        loadxl.load_all(testapp, args.inpath, args.attach, test=args.test_only, workers=args.workers)
 
 
 if __name__ == '__main__':
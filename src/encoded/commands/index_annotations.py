@@ -1,9 +1,11 @@
 from pyramid.paster import get_app
 from elasticsearch import RequestError
+from elasticsearch.helpers import streaming_bulk
 import logging
 import json
 
 from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+from encoded.region_search import coordinate_resolver
 
 
 EPILOG = __doc__
@@ -13,11 +15,67 @@ log = logging.getLogger(__name__)
 index = 'annotations'
 doc_type = 'default'
 
+BULK_CHUNK_SIZE = 1000  # documents
+BULK_CHUNK_BYTES = 10 * 1024 * 1024
+BULK_MAX_RETRIES = 5  # of documents es rejected as too busy
+SEED_BATCH_SIZE = 5000
+
+
+def read_annotations(path):
+    '''Yields the documents of an annotations file, one at a time.  The file is either
+       newline delimited JSON from generate-annotations or an older single JSON list,
+       either way alternating bulk action lines and documents.'''
+    with open(path) as annotations_file:
+        first = annotations_file.read(1)
+        while first.isspace():
+            first = annotations_file.read(1)
+        annotations_file.seek(0)
+        if first == '[':
+            lines = json.load(annotations_file)
+        else:
+            lines = (json.loads(line) for line in annotations_file if line.strip())
+        for line in lines:
+            if 'index' in line and len(line) == 1:
+                continue  # bulk action lines
+            yield line
+
+
+def bulk_actions(docs):
+    for doc in docs:
+        yield {
+            '_index': index,
+            '_type': doc_type,
+            '_id': doc['id'],
+            '_source': doc,
+        }
 
-def json_from_path(path, default=None):
-    if path is None:
-        return default
-    return json.load(open(path))
+
+def seeding(docs, resolver, batch_size=SEED_BATCH_SIZE):
+    '''Passes docs through, seeding resolver's coordinate cache with them along the way.'''
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            resolver.seed_annotations(batch)
+            batch = []
+        yield doc
+    resolver.seed_annotations(batch)
+
+
+def index_annotations(es, docs, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_CHUNK_BYTES,
+                      max_retries=BULK_MAX_RETRIES):
+    '''Streams docs into the annotations index in bounded bulk requests.
+       Returns the number of documents indexed and a list of the errors for those that were not.'''
+    indexed = 0
+    errors = []
+    for ok, item in streaming_bulk(es, bulk_actions(docs), chunk_size=chunk_size,
+                                   max_chunk_bytes=max_chunk_bytes, max_retries=max_retries,
+                                   raise_on_error=False, request_timeout=30):
+        if ok:
+            indexed += 1
+        else:
+            errors.append(item)
+    return indexed, errors
 
 def index_settings():
     return {
@@ -56,12 +114,26 @@ def run(app):
     else:
         es.indices.refresh(index=index)
 
+    path = registry.settings.get('annotations_path')
+    if path is None:
+        return
+    docs = read_annotations(path)
+    # Pre-seed region search's coordinate cache so these genes never need a lookup
+    if registry.settings.get('region_search.coordinate_cache'):
+        docs = seeding(docs, coordinate_resolver(registry.settings))
+
     # bulk index of annotations
-    annotations = json_from_path(registry.settings.get('annotations_path'), {})
     try:
-        es.bulk(index=index, body=annotations, refresh=True, request_timeout=30)
-    except:
-        print("Unable index the annotations")
+        indexed, errors = index_annotations(es, docs)
+    except Exception:
+        log.error("Unable index the annotations", exc_info=True)
+        return
+    es.indices.refresh(index=index)
+    print("Indexed %d annotations" % indexed)
+    if errors:
+        print("Unable to index %d annotations, the first: %r" % (len(errors), errors[0]))
+    if registry.settings.get('region_search.coordinate_cache'):
+        print("Seeded coordinates into %s" % registry.settings['region_search.coordinate_cache'])
 
 
 def main():
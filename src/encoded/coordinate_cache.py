@@ -0,0 +1,110 @@
+"""\
+Cache of resolved genomic coordinates.
+
+Looking up where an rsID or gene lives, or lifting a location over to
+another assembly, means a round trip to the Ensembl REST API.  Answers
+hardly ever change, so they are kept in a bounded in-process LRU with a
+TTL and, when a path is given, in a sqlite file that every process on the
+machine (and later runs of generate-annotations) can share.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 10000
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+
+class CoordinateCache(object):
+    '''Maps string keys to JSON-able values, in memory and optionally on disk.'''
+
+    def __init__(self, path=None, capacity=DEFAULT_CAPACITY, ttl=DEFAULT_TTL):
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key => (expires, value), least recently used first
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with self._db() as db:
+                db.execute('CREATE TABLE IF NOT EXISTS coordinates '
+                           '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)')
+
+    def _db(self):
+        '''sqlite connections can't be shared between threads, so each thread gets its own.'''
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=10)
+        return db
+
+    def _remember(self, key, expires, value):
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def get(self, key):
+        '''Returns the cached value for key, or None if it is unknown or has expired.'''
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+        if self.path:
+            try:
+                row = self._db().execute(
+                    'SELECT value, expires FROM coordinates WHERE key = ?', (key,)).fetchone()
+            except sqlite3.Error:
+                log.warn('Coordinate cache %s could not be read', self.path, exc_info=True)
+                row = None
+            if row is not None and row[1] > now:
+                value = json.loads(row[0])
+                self._remember(key, row[1], value)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        '''Caches (key, value) pairs, writing them to disk in a single transaction.'''
+        expires = time.time() + self.ttl
+        rows = []
+        for key, value in items:
+            self._remember(key, expires, value)
+            rows.append((key, json.dumps(value), expires))
+        if self.path and rows:
+            try:
+                with self._db() as db:
+                    db.executemany('INSERT OR REPLACE INTO coordinates VALUES (?, ?, ?)', rows)
+            except sqlite3.Error:
+                log.warn('Coordinate cache %s could not be written', self.path, exc_info=True)
+
+    def lookup(self, key, resolve):
+        '''Returns the cached value for key, calling resolve() and caching its answer on a miss.
+           Falsy answers (nothing found, or Ensembl was unreachable) are not cached.'''
+        value = self.get(key)
+        if value is None:
+            value = resolve()
+            if value and any(value):
+                self.set(key, value)
+        return value
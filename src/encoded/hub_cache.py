@@ -0,0 +1,63 @@
+"""\
+Cache of rendered track hub text.
+
+UCSC fetches hub files (trackDb.txt in particular) with dozens of byte-range
+requests per hub load.  Rendering a batch trackDb means a limit=all search,
+a vis cache lookup and remodelling every vis_dataset, so the rendered bytes
+are kept here, keyed by what was asked for and the vis indexer's last
+completed xmin, and ranges are sliced from them.
+"""
+import hashlib
+import threading
+import time
+from collections import (
+    OrderedDict,
+    namedtuple,
+)
+
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+HubText = namedtuple('HubText', ['body', 'content_type', 'etag', 'last_modified'])
+
+
+def hub_text(text, content_type):
+    '''Renders text to the bytes served, with a strong etag of their content.'''
+    body = text.encode('utf-8')
+    return HubText(body, content_type, hashlib.sha1(body).hexdigest(), time.time())
+
+
+class HubCache(object):
+    '''HubText by key, least recently used dropped once past max_bytes.'''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        if len(entry.body) > self.max_bytes:
+            return entry
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.body)
+            self.entries[key] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes:
+                (_, dropped) = self.entries.popitem(last=False)
+                self.size -= len(dropped.body)
+        return entry
@@ -1,9 +1,15 @@
 from past.builtins import basestring
 from .typedsheets import cast_row_values
+from collections import (
+    OrderedDict,
+    deque,
+)
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 import io
 import logging
 import os.path
+import time
 
 text = type(u'')
 
@@ -342,26 +348,94 @@ def request_url(item_type, method):
     return component
 
 
-def make_request(testapp, item_type, method):
+def link_key(value):
+    """ The last part of a path, which is all a link and its target share
+    """
+    return value.strip('/').rsplit('/', 1)[-1]
+
+
+def row_keys(row):
+    """ Values other rows of the type might link to this row by
+    """
+    keys = set()
+    for key in ('uuid', 'accession', 'external_accession', 'name', '@id'):
+        if isinstance(row.get(key), basestring):
+            keys.add(link_key(row[key]))
+    keys.update(alias for alias in row.get('aliases') or [] if isinstance(alias, basestring))
+    return keys
+
+
+def value_links(value):
+    """ Every string in a row value, as the key it might link to
+    """
+    if isinstance(value, basestring):
+        yield link_key(value)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from value_links(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from value_links(item)
+
+
+def make_request(testapp, item_type, method, workers=1):
+    """ Send each row to the app
+
+    With more than one worker, rows of the type are sent concurrently and
+    yielded in their original order.  A row that may link to another row of
+    the type still in flight (a page's parent, a file it is paired with) waits
+    for that row's response first.
+    """
     json_method = getattr(testapp, method.lower() + '_json')
 
+    def request_value(row):
+        # Keys with leading underscores are for communicating between
+        # sections
+        row['_value'] = {
+            k: v for k, v in row.items() if not k.startswith('_') and not k.startswith('@')
+        }
+        return row
+
     def component(rows):
         for row in rows:
             if row.get('_skip') or row.get('_errors') or not row.get('_url'):
                 continue
 
-            # Keys with leading underscores are for communicating between
-            # sections
-            value = row['_value'] = {
-                k: v for k, v in row.items() if not k.startswith('_') and not k.startswith('@')
-            }
-
+            value = request_value(row)['_value']
             url = row['_url']
             row['_response'] = json_method(url, value, status='*')
 
             yield row
 
-    return component
+    def concurrent_component(rows):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for row in rows:
+                if row.get('_skip') or row.get('_errors') or not row.get('_url'):
+                    continue
+
+                value = request_value(row)['_value']
+                links = set(value_links(value))
+                # Wait for rows this one may link to
+                while pending and any(keys & links for (_row, _future, keys) in pending):
+                    done, future, keys = pending.popleft()
+                    done['_response'] = future.result()
+                    yield done
+
+                future = executor.submit(json_method, row['_url'], value, status='*')
+                pending.append((row, future, row_keys(row)))
+                # Only read a few rows ahead of the responses
+                if len(pending) >= workers * 4:
+                    done, future, keys = pending.popleft()
+                    done['_response'] = future.result()
+                    yield done
+
+            while pending:
+                done, future, keys = pending.popleft()
+                done['_response'] = future.result()
+                yield done
+
+    return component if workers <= 1 else concurrent_component
 
 
 ##############################################################################
@@ -380,8 +454,9 @@ def trim(value):
     return value
 
 
-def pipeline_logger(item_type, phase):
+def pipeline_logger(item_type, phase, stats=None):
     def component(rows):
+        start = time.time()
         created = 0
         updated = 0
         errors = 0
@@ -427,8 +502,14 @@ def pipeline_logger(item_type, phase):
             yield row
 
         loaded = created + updated
-        logger.info('Loaded %d of %d %s (phase %s). CREATED: %d, UPDATED: %d, SKIPPED: %d, ERRORS: %d' % (
-            loaded, count, item_type, phase, created, updated, skipped, errors))
+        seconds = time.time() - start
+        logger.info('Loaded %d of %d %s (phase %s) in %.1fs. CREATED: %d, UPDATED: %d, SKIPPED: %d, ERRORS: %d' % (
+            loaded, count, item_type, phase, seconds, created, updated, skipped, errors))
+        if stats is not None:
+            type_stats = stats.setdefault(item_type, {'loaded': 0, 'errors': 0, 'seconds': 0.0})
+            type_stats['loaded'] += loaded
+            type_stats['errors'] += errors
+            type_stats['seconds'] += seconds
 
     return component
 
@@ -515,7 +596,7 @@ def process(rows):
         pass
 
 
-def get_pipeline(testapp, docsdir, test_only, item_type, phase=None, method=None):
+def get_pipeline(testapp, docsdir, test_only, item_type, phase=None, method=None, workers=1, stats=None):
     pipeline = [
         skip_rows_with_all_key_value(test='skip'),
         skip_rows_with_all_key_value(_test='skip'),
@@ -545,8 +626,8 @@ def get_pipeline(testapp, docsdir, test_only, item_type, phase=None, method=None
     pipeline.extend([
         request_url(item_type, method),
         remove_keys('uuid') if method in ('PUT', 'PATCH') else noop,
-        make_request(testapp, item_type, method),
-        pipeline_logger(item_type, phase),
+        make_request(testapp, item_type, method, workers),
+        pipeline_logger(item_type, phase, stats),
     ])
     return pipeline
 
@@ -713,28 +794,46 @@ PHASE2_PIPELINES = {
 }
 
 
-def load_all(testapp, filename, docsdir, log_level=None, test=False):
+def load_all(testapp, filename, docsdir, log_level=None, test=False, workers=1):
+    """ Load every sheet of a workbook, in ORDER
+
+    Each sheet is read once, and kept for the second phase if its type has
+    one.  Every type is loaded before the next one is started; within a type,
+    up to `workers` rows are sent concurrently.  Returns loaded and error
+    counts and seconds taken for each item type.
+    """
     if log_level is not None:
         _reset_log_level(log_level)
+    stats = OrderedDict()
+    sheets = {}
     for item_type in ORDER:
         try:
-            source = read_single_sheet(filename, item_type)
+            rows = list(read_single_sheet(filename, item_type))
         except ValueError:
             logger.error('Opening %s %s failed.', filename, item_type)
             continue
-        pipeline = get_pipeline(testapp, docsdir, test, item_type, phase=1)
+        if item_type in PHASE2_PIPELINES:
+            sheets[item_type] = rows
+        # Pipelines change rows as they go, so each phase gets its own copies
+        source = (dict(row) for row in rows)
+        pipeline = get_pipeline(testapp, docsdir, test, item_type, phase=1, workers=workers, stats=stats)
         process(combine(source, pipeline))
 
     for item_type in ORDER:
-        if item_type not in PHASE2_PIPELINES:
-            continue
-        try:
-            source = read_single_sheet(filename, item_type)
-        except ValueError:
+        if item_type not in sheets:
             continue
-        pipeline = get_pipeline(testapp, docsdir, test, item_type, phase=2)
+        source = (dict(row) for row in sheets.pop(item_type))
+        pipeline = get_pipeline(testapp, docsdir, test, item_type, phase=2, workers=workers, stats=stats)
         process(combine(source, pipeline))
 
+    for item_type, type_stats in stats.items():
+        if not type_stats['loaded'] and not type_stats['errors']:
+            continue
+        logger.info('%s: %d loaded, %d errors in %.1fs (%.1f per second)' % (
+            item_type, type_stats['loaded'], type_stats['errors'], type_stats['seconds'],
+            type_stats['loaded'] / type_stats['seconds'] if type_stats['seconds'] else 0.0))
+    return stats
+
 
 def load_test_data(app):
     from webtest import TestApp
@@ -747,4 +846,4 @@ def load_test_data(app):
     from pkg_resources import resource_filename
     inserts = resource_filename('encoded', 'tests/data/inserts/')
     docsdir = [resource_filename('encoded', 'tests/data/documents/')]
-    load_all(testapp, inserts, docsdir)
+    load_all(testapp, inserts, docsdir, workers=int(app.registry.settings.get('loadxl.workers', 1)))
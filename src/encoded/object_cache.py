@@ -0,0 +1,101 @@
+"""\
+Counters and per-transaction memos for calculated properties.
+
+Calculated properties like Biosample.summary or Experiment.biosample_summary
+embed the @@object frames of the same donors, organisms, treatments and
+biosample types over and over while an item (or an indexing batch) renders.
+snovault's embed_cache already renders each frame once per transaction, so
+this only counts, in the root request's X-Stats, how often a frame was
+already there (object_cache_hit_count and object_cache_miss_count).
+
+paths_filtered_by_status, and dataset properties like files,
+contributing_files and assembly, only need the status, assembly and
+derived_from of each linked item (files, replicates, documents, datasets and
+so on), so item_properties keeps just those for the transaction.  They are
+shared between callers, so treat them as read-only.
+"""
+from pyramid.traversal import traverse
+from snovault import (
+    CONNECTION,
+    Item,
+)
+from snovault.cache import ManagerLRUCache
+from snovault.util import get_root_request
+
+
+# status, assembly and derived_from (as paths) of items by path, for the
+# current transaction
+item_properties_cache = ManagerLRUCache('encoded.item_properties', 100000)
+
+
+def count(request, name, value=1):
+    '''Add value to a counter in the root (or else the given) request's X-Stats.'''
+    root_request = get_root_request() or request
+    stats = getattr(root_request, '_stats', None)
+    if stats is not None:
+        stats[name] = stats.get(name, 0) + value
+
+
+class FrameCountingCache(ManagerLRUCache):
+    '''ManagerLRUCache that counts lookups of @@object frames as hits or misses.'''
+
+    def get(self, key, default=None):
+        value = super(FrameCountingCache, self).get(key)
+        if '@@object' in key:
+            count(None, 'object_cache_miss_count' if value is None else 'object_cache_hit_count')
+        return default if value is None else value
+
+
+def includeme(config):
+    connection = config.registry[CONNECTION]
+    embed_cache = connection.embed_cache
+    connection.embed_cache = FrameCountingCache(embed_cache.name, embed_cache.default_capacity)
+
+
+def _item_properties(request, path):
+    context = traverse(request.root, path)['context']
+    if not isinstance(context, Item):
+        return {}, []
+    properties = context.upgrade_properties()
+    snapshot = {
+        key: properties[key]
+        for key in ['status', 'assembly']
+        if key in properties
+    }
+    snapshot['uuid'] = str(context.uuid)
+    return snapshot, properties.get('derived_from', [])
+
+
+def item_properties(request, paths):
+    '''
+    The status, assembly and derived_from of the items at paths, by path, with
+    derived_from as paths like the @@object frame has them.
+
+    Each item is looked up once per transaction. As with traversing to each
+    item and calling __json__, the item's uuid is recorded as embedded.
+    '''
+    cache = item_properties_cache.cache
+    if cache is None:
+        cache = {}
+    paths = list(paths)
+    missing = [path for path in set(paths) if path not in cache]
+    if missing:
+        connection = request.registry[CONNECTION]
+        for path in missing:
+            snapshot, derived_from = _item_properties(request, path)
+            if 'uuid' in snapshot:
+                derived_paths = []
+                for uuid in derived_from:
+                    item = connection.get_by_uuid(uuid)
+                    if item is not None:
+                        derived_paths.append(request.resource_path(item))
+                snapshot['derived_from'] = derived_paths
+            cache[path] = snapshot
+
+    results = {}
+    for path in paths:
+        snapshot = cache[path]
+        if 'uuid' in snapshot:
+            request._embedded_uuids.add(snapshot['uuid'])
+        results[path] = snapshot
+    return results
@@ -0,0 +1,138 @@
+"""\
+Read-only ontology store shared by every process on a machine.
+
+ontology.json is tens of megabytes and used to be loaded into a dict by every
+web worker and indexer process.  The same terms are written once to a sqlite
+file (one JSON document per term, along with each term's part_of ancestors),
+which processes memory-map read-only, so the operating system keeps a single
+copy in its page cache.  OntologyStore has the mapping interface of the old
+dict, with the terms' precomputed slims as before, and is_part_of() is one
+indexed lookup instead of a recursive walk.
+"""
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import deque
+from collections.abc import Mapping
+from functools import lru_cache
+from urllib.parse import quote
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TERM_CACHE = 10000  # decoded terms kept per process
+MMAP_SIZE = 1024 * 1024 * 1024
+
+
+def part_of_closure(ontology, term_id):
+    '''Returns the set of terms term_id is part of, directly or not.
+       Cycles are fine, and terms missing from the ontology are ancestors with no ancestors of their own.'''
+    ancestors = set()
+    queue = deque(ontology.get(term_id, {}).get('part_of', []))
+    while queue:
+        ancestor_id = queue.popleft()
+        if ancestor_id in ancestors:
+            continue
+        ancestors.add(ancestor_id)
+        queue.extend(ontology.get(ancestor_id, {}).get('part_of', []))
+    return ancestors
+
+
+def build_ontology_store(ontology, path):
+    '''Writes ontology (as loaded from ontology.json) to a sqlite file at path, replacing any there.'''
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    try:
+        with db:
+            db.execute('CREATE TABLE terms (term_id TEXT PRIMARY KEY, term TEXT NOT NULL) WITHOUT ROWID')
+            db.execute('CREATE TABLE part_of (term_id TEXT NOT NULL, ancestor_id TEXT NOT NULL, '
+                       'PRIMARY KEY (term_id, ancestor_id)) WITHOUT ROWID')
+            db.executemany('INSERT INTO terms VALUES (?, ?)', (
+                (term_id, json.dumps(term, separators=(',', ':'))) for (term_id, term) in ontology.items()
+            ))
+            db.executemany('INSERT INTO part_of VALUES (?, ?)', (
+                (term_id, ancestor_id)
+                for term_id in ontology
+                for ancestor_id in part_of_closure(ontology, term_id)
+            ))
+    finally:
+        db.close()
+    os.replace(tmp_path, path)
+    log.info('Wrote %d ontology terms to %s', len(ontology), path)
+
+
+class OntologyStore(Mapping):
+    '''Maps term_id to term, read from a file written by build_ontology_store().'''
+
+    def __init__(self, path, cache_size=DEFAULT_TERM_CACHE):
+        self.path = path
+        self.uri = 'file:%s?mode=ro' % quote(os.path.abspath(path))
+        self.local = threading.local()
+        self.term = lru_cache(maxsize=cache_size)(self._term)
+        self._len = None
+
+    def _db(self):
+        '''sqlite connections can't be shared between threads or forked processes, so each gets its own.'''
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = self.local.db = sqlite3.connect(self.uri, uri=True)
+            db.execute('PRAGMA mmap_size = %d' % MMAP_SIZE)
+            self.local.pid = os.getpid()
+        return db
+
+    def _term(self, term_id):
+        row = self._db().execute('SELECT term FROM terms WHERE term_id = ?', (term_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def __getitem__(self, term_id):
+        term = self.term(term_id)
+        if term is None:
+            raise KeyError(term_id)
+        return term
+
+    def __contains__(self, term_id):
+        return self.term(term_id) is not None
+
+    def __iter__(self):
+        return (row[0] for row in self._db().execute('SELECT term_id FROM terms ORDER BY term_id'))
+
+    def __len__(self):
+        if self._len is None:
+            self._len = self._db().execute('SELECT count(*) FROM terms').fetchone()[0]
+        return self._len
+
+    def ancestors(self, term_id):
+        '''Returns the set of terms term_id is part of, directly or not.'''
+        rows = self._db().execute('SELECT ancestor_id FROM part_of WHERE term_id = ?', (term_id,))
+        return {row[0] for row in rows}
+
+    def is_part_of(self, term_id, part_of_term_id):
+        row = self._db().execute(
+            'SELECT 1 FROM part_of WHERE term_id = ? AND ancestor_id = ?', (term_id, part_of_term_id)
+        ).fetchone()
+        return row is not None
+
+
+def open_ontology(settings):
+    '''Returns the ontology for the app: an OntologyStore if ontology_store_path is set, else a dict.
+       The store is (re)built from ontology_path when it is missing or older than that file.'''
+    json_path = settings.get('ontology_path')
+    store_path = settings.get('ontology_store_path')
+    if not store_path:
+        if json_path is None:
+            return {}
+        with open(json_path) as json_file:
+            return json.load(json_file)
+    if json_path is not None and os.path.exists(json_path):
+        # Workers start together, only one of them builds the store
+        with open(store_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(store_path) or os.path.getmtime(store_path) < os.path.getmtime(json_path):
+                with open(json_path) as json_file:
+                    build_ontology_store(json.load(json_file), store_path)
+    return OntologyStore(store_path)
@@ -1,18 +1,27 @@
 import urllib3
 import io
+import datetime
 import gzip
+from array import array
 import csv
 import logging
 import collections
 import json
+import queue
 import requests
+import threading
 import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pyramid.view import view_config
 from sqlalchemy.sql import text
 from elasticsearch.exceptions import (
     NotFoundError
 )
-from elasticsearch.helpers import scan
+from elasticsearch.helpers import (
+    bulk,
+    scan
+)
 from snovault import DBSESSION, COLLECTIONS
 #from snovault.storage import (
 #    TransactionRecord,
@@ -31,6 +40,12 @@ from snovault.elasticsearch.interfaces import (
     SNP_SEARCH_ES,
     INDEXER,
 )
+from .region_intervals import (
+    CURRENT,
+    INTERVAL_INDEX_SETTING,
+    IntervalIndexWriter,
+    load_interval_index,
+)
 
 log = logging.getLogger(__name__)
 
@@ -73,6 +88,16 @@ TESTABLE_FILES = ['ENCFF002COS']  # '/static/test/peak_indexer/ENCFF002COS.bed.g
                                   # '/static/test/peak_indexer/ENCFF296FFD.tsv',     # tsv's some day?
                                   # '/static/test/peak_indexer/ENCFF000PAR.bed.gz']
 
+# Peaks per chromosome held in memory (and sent in one regions es doc) before flushing
+REGIONS_BATCH_SIZE = 50000
+# Peaks (across docs and files) queued before a regions es bulk request is sent
+REGIONS_BULK_POSITIONS = 250000
+# Cycles of at least this many datasets scroll through all residency ids up front
+# rather than asking about each dataset's files as they come
+RESIDENTS_SCAN_MIN = 100
+# Region docs fetched per mget while writing the interval index (each may hold REGIONS_BATCH_SIZE peaks)
+INTERVAL_INDEX_MGET_SIZE = 10
+
 
 def includeme(config):
     config.add_route('index_region', '/index_region')
@@ -88,6 +113,40 @@ def tsvreader(file):
     for row in reader:
         yield row
 
+
+def read_bed_regions(file, batch_size=REGIONS_BATCH_SIZE):
+    '''Streams a bed file, yielding (chrom, starts, ends) batches of at most batch_size peaks.
+       Positions are kept in compact integer arrays so memory is bounded by the batch size,
+       not the file size.'''
+    batches = {}
+    for row in tsvreader(file):
+        if not row or row[0].startswith(('#', 'track', 'browser')):
+            continue
+        chrom = row[0].lower()
+        batch = batches.get(chrom)
+        if batch is None:
+            batch = batches[chrom] = (array('l'), array('l'))
+        batch[0].append(int(row[1]) + 1)
+        batch[1].append(int(row[2]) + 1)
+        if len(batch[0]) >= batch_size:
+            yield (chrom, batch[0], batch[1])
+            del batches[chrom]
+    for chrom, (starts, ends) in batches.items():
+        yield (chrom, starts, ends)
+
+
+def region_doc_id(uuid, chunk):
+    '''Returns the regions es id for one batch of a file's peaks on a chromosome.
+       The first batch is keyed on the bare uuid so single batch files look as they always have.'''
+    if chunk == 0:
+        return str(uuid)
+    return '%s:%d' % (uuid, chunk)
+
+
+def region_doc_uuid(doc_id):
+    '''Returns the file uuid that a regions es doc id belongs to.'''
+    return doc_id.split(':', 1)[0]
+
 # Mapping should be generated dynamically for each assembly type
 
 
@@ -367,6 +426,8 @@ def index_regions(request):
         result = state.start_cycle(uuids, result)
         errors = indexer.update_objects(request, uuids, force)
         result = state.finish_cycle(result, errors)
+        if indexer.interval_files or not indexer.interval_index_built():
+            indexer.write_interval_index()
         if result['indexed'] == 0:
             log.info("Region indexer added %d file(s) from %d dataset uuids" % (result['indexed'], uuid_count))
 
@@ -385,6 +446,30 @@ class RegionIndexer(Indexer):
         self.residents_index = RESIDENT_REGIONSET_KEY
         self.state = RegionIndexerState(self.encoded_es,self.encoded_INDEX)  # WARNING, race condition is avoided because there is only one worker
         self.test_instance = registry.settings.get('testing',False)
+        # (index, doc_type) pairs known to exist in regions es, kept for the life of the process
+        self.known_mappings = set()
+        self.bulk_actions = []
+        self.bulk_positions = 0
+        # Residency docs wait for their file's region docs to be written, by uuid
+        self.pending_residents = {}
+        self.failed_regions = set()
+        self.cycle_errors = []
+        # Files may be downloaded and parsed by a pool of workers while this thread embeds datasets
+        self.workers = int(registry.settings.get('regionindexer.workers', 1))
+        self.pool = None
+        self.loading = {}
+        self.loaded = None
+        self.cancelled = None
+        # Residency of file uuids, looked up in bulk once per cycle rather than per file
+        self.residents = set()
+        self.residents_checked = set()
+        self.residents_complete = False
+        self.interval_index_path = registry.settings.get(INTERVAL_INDEX_SETTING)
+        # Files added (residency doc) or dropped (None) by uuid, and their (assembly, chrom)s, since the
+        # interval index was last written.  The first write in a process reads everything from regions es.
+        self.interval_files = {}
+        self.interval_chroms = set()
+        self.interval_index_full = True
 
     def get_from_es(request, comp_id):
         '''Returns composite json blob from elastic-search, or None if not found.'''
@@ -394,12 +479,35 @@ class RegionIndexer(Indexer):
         # pylint: disable=too-many-arguments, unused-argument
         '''Run indexing process on uuids'''
         errors = []
-        for i, uuid in enumerate(uuids):
-            error = self.update_object(request, uuid, force)
-            if error is not None:
-                errors.append(error)
-            if (i + 1) % 1000 == 0:
-                log.info('Indexing %d', i + 1)
+        self.cycle_errors = []
+        self.failed_regions = set()
+        self.residents = set()
+        self.residents_checked = set()
+        self.residents_complete = False
+        if len(uuids) >= RESIDENTS_SCAN_MIN:
+            self.prefetch_residents()
+        if self.workers > 1:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            self.loading = {}
+            # Bounds parsed peaks waiting to be written, so slow es pushes back on the workers
+            self.loaded = queue.Queue(maxsize=self.workers * 4)
+            self.cancelled = threading.Event()
+        try:
+            for i, uuid in enumerate(uuids):
+                error = self.update_object(request, uuid, force)
+                if error is not None:
+                    errors.append(error)
+                if (i + 1) % 1000 == 0:
+                    log.info('Indexing %d', i + 1)
+            if self.pool is not None:
+                self.drain_loaded_files(block=True)
+        finally:
+            if self.pool is not None:
+                self.cancelled.set()
+                self.pool.shutdown(wait=False)
+                self.pool = None
+        self.flush_regions_es()
+        errors.extend(self.cycle_errors)
         return errors
 
     def update_object(self, request, dataset_uuid, force):
@@ -423,15 +531,17 @@ class RegionIndexer(Indexer):
             return
 
         files = dataset.get('files',[])
+        self.prefetch_residents([afile['uuid'] for afile in files
+                                 if afile.get('file_format') in ENCODED_ALLOWED_FILE_FORMATS])
         for afile in files:
             if afile.get('file_format') not in ENCODED_ALLOWED_FILE_FORMATS:
                 continue  # Note: if file_format changed to not allowed but file already in regions es, it doesn't get removed.
 
             file_uuid = afile['uuid']
+            using = ""
 
             if self.encoded_candidate_file(afile, assay_term_name):
 
-                using = ""
                 if force:
                     using = "with FORCE"
                     #log.debug("file is a candidate: %s %s", afile['accession'], using)
@@ -441,9 +551,11 @@ class RegionIndexer(Indexer):
                     if self.in_regions_es(file_uuid):
                         continue
 
-                if self.add_encoded_file_to_regions_es(request, assay_term_name, afile):
-                    log.info("added file: %s %s %s", dataset['accession'], afile['href'], using)
-                    self.state.file_added(file_uuid)
+                if self.pool is not None:
+                    self.submit_encoded_file(request, dataset['accession'], assay_term_name, afile, using)
+                else:
+                    self.add_encoded_file_to_regions_es(request, assay_term_name, afile,
+                                                        added=(dataset['accession'], afile['href'], using))
 
             else:
                 if self.remove_from_regions_es(file_uuid):
@@ -495,9 +607,44 @@ class RegionIndexer(Indexer):
             return False
         return True
 
+    def prefetch_residents(self, ids=None):
+        '''Looks up which of ids (or, when None, which of all ids) are resident in regions es in one mget
+           or scroll, so that in_regions_es and remove_from_regions_es can answer locally.'''
+        if self.residents_complete:
+            return
+        if ids is None:
+            query = {'query': {'match_all': {}}, '_source': False}
+            try:
+                residents = set(hit['_id'] for hit in scan(self.regions_es, query=query, index=self.residents_index,
+                                                           doc_type='default', size=10000))
+            except NotFoundError:
+                residents = set()  # No index means nothing is resident yet
+            except:
+                log.error("Region indexer failed to prefetch %s" % (self.residents_index), exc_info=True)
+                return  # Fall back to looking each id up
+            self.residents = residents
+            self.residents_complete = True
+            return
+
+        ids = [str(id) for id in ids if str(id) not in self.residents_checked]
+        if not ids:
+            return
+        try:
+            result = self.regions_es.mget(index=self.residents_index, doc_type='default',
+                                          body={'ids': ids}, _source=False)
+        except NotFoundError:
+            result = {'docs': []}
+        except:
+            log.error("Region indexer failed to prefetch %d ids" % (len(ids)), exc_info=True)
+            return
+        self.residents.update(doc['_id'] for doc in result['docs'] if doc.get('found'))
+        self.residents_checked.update(ids)
+
     def in_regions_es(self, id):
         '''returns True if an id is in regions es'''
         #return False # DEBUG
+        if self.residents_complete or str(id) in self.residents_checked:
+            return str(id) in self.residents
         try:
             doc = self.regions_es.get(index=self.residents_index, doc_type='default', id=str(id)).get('_source',{})
             if doc:
@@ -511,9 +658,92 @@ class RegionIndexer(Indexer):
         return False
 
 
+    def ensure_mapping(self, index, doc_type, mapping):
+        '''Makes sure index and doc_type mapping exist in regions es, asking es only the first time.'''
+        if (index, doc_type) in self.known_mappings:
+            return
+        if not self.regions_es.indices.exists(index):
+            self.regions_es.indices.create(index=index, body=index_settings())
+
+        if not self.regions_es.indices.exists_type(index=index, doc_type=doc_type):
+            self.regions_es.indices.put_mapping(index=index, doc_type=doc_type, body=mapping)
+        self.known_mappings.add((index, doc_type))
+
+    def queue_action(self, action, positions=0):
+        '''Queues a bulk action for regions es, sending the queue once enough peaks are waiting.'''
+        self.bulk_actions.append(action)
+        self.bulk_positions += positions
+        if self.bulk_positions >= REGIONS_BULK_POSITIONS:
+            self.flush_regions_es()
+
+    def bulk_regions_es(self, actions):
+        '''Sends actions to regions es in one bulk request.  Returns the uuids that failed, recording errors.'''
+        timestamp = datetime.datetime.now().isoformat()
+        try:
+            (_, failures) = bulk(self.regions_es, actions, chunk_size=len(actions), raise_on_error=False,
+                                 request_timeout=60)
+        except Exception as e:
+            log.error("Region indexer failed bulk write of %d actions" % (len(actions)), exc_info=True)
+            self.known_mappings = set()  # Don't trust what we think exists
+            failed = set(region_doc_uuid(action['_id']) for action in actions)
+            self.cycle_errors.extend([{'error_message': repr(e), 'timestamp': timestamp, 'uuid': uuid}
+                                     for uuid in failed])
+            return failed
+
+        failed = {}
+        for failure in failures:
+            (op_type, info) = list(failure.items())[0]
+            if op_type == 'delete' and info.get('status') == 404:
+                continue  # Not an error: already gone
+            self.known_mappings.discard((info.get('_index'), info.get('_type')))
+            failed[region_doc_uuid(info['_id'])] = repr(info.get('error'))
+        for uuid, error_message in failed.items():
+            log.error("Region indexer failed to write %s: %s" % (uuid, error_message))
+            self.cycle_errors.append({'error_message': error_message, 'timestamp': timestamp, 'uuid': uuid})
+        return set(failed)
+
+    def flush_regions_es(self):
+        '''Sends all queued region writes to regions es, then the residency of files whose regions were all
+           written.  Files with a failed region write get their region docs deleted instead, to be retried.'''
+        actions = self.bulk_actions
+        pending = self.pending_residents
+        if not actions and not pending:
+            return
+        self.bulk_actions = []
+        self.bulk_positions = 0
+        self.pending_residents = {}
+
+        if actions:
+            self.failed_regions.update(self.bulk_regions_es(actions))
+        if not pending:
+            return
+
+        written = []
+        for (uuid, resident) in pending.items():
+            if uuid in self.failed_regions:
+                self.discard_partial_file(uuid, resident['action']['_source']['assembly'], resident['chunks'])
+            else:
+                self.bulk_actions.append(resident['action'])
+                written.append(uuid)
+        actions = self.bulk_actions
+        self.bulk_actions = []
+        failed = self.bulk_regions_es(actions)
+        for uuid in written:
+            if uuid in failed:
+                continue
+            self.residents.add(uuid)
+            self.residents_checked.add(uuid)
+            self.interval_changed(uuid, pending[uuid]['action']['_source'])
+            added = pending[uuid]['added']
+            if added is not None:
+                log.info("added file: %s %s %s", *added)
+                self.state.file_added(uuid)
+
     def remove_from_regions_es(self, id):
         '''Removes all traces of an id (usually uuid) from region search elasticsearch index.'''
         #return True # DEBUG
+        if (self.residents_complete or str(id) in self.residents_checked) and str(id) not in self.residents:
+            return False  # Not an error: remove may be called without looking first
         try:
             doc = self.regions_es.get(index=self.residents_index, doc_type='default', id=str(id)).get('_source',{})
             if not doc:
@@ -521,136 +751,352 @@ class RegionIndexer(Indexer):
         except:
             return False  # Not an error: remove may be called without looking first
 
+        # Queued with any adds, so a forced re-add of the same id is applied after the deletes
+        chunks = doc.get('chunks', {})
         for chrom in doc['chroms']:
-            try:
-                self.regions_es.delete(index=chrom, doc_type=doc['assembly'], id=str(uuid))
-            except:
-                #log.error("Region indexer failed to remove %s regions of %s" % (chrom,id))
-                return False # Will try next full cycle
-
-        try:
-            self.regions_es.delete(index=self.residents_index, doc_type='default', id=str(uuid))
-        except:
-            log.error("Region indexer failed to remove %s from %s" % (id, self.residents_index))
-            return False # Will try next full cycle
-
+            for chunk in range(chunks.get(chrom, 1)):
+                self.queue_action({
+                    '_op_type': 'delete',
+                    '_index': chrom,
+                    '_type': doc['assembly'],
+                    '_id': region_doc_id(id, chunk)
+                })
+
+        self.queue_action({
+            '_op_type': 'delete',
+            '_index': self.residents_index,
+            '_type': 'default',
+            '_id': str(id)
+        })
+        self.residents.discard(str(id))
+        self.interval_changed(str(id), None, doc)
         return True
 
-
-    def add_to_regions_es(self, id, assembly, assay_term_name, regions, source='encoded'):
-        '''Given regions from some source (most likely encoded file) loads the data into region search es'''
-        #return True # DEBUG
-        for key in regions:
-            doc = {
-                'uuid': str(id),
-                'positions': regions[key]
-            }
-            # Could be a chrom never seen before!
-            if not self.regions_es.indices.exists(key):
-                self.regions_es.indices.create(index=key, body=index_settings())
-
-            if not self.regions_es.indices.exists_type(index=key, doc_type=assembly):
-                self.regions_es.indices.put_mapping(index=key, doc_type=assembly, body=get_mapping(assembly))
-
-            self.regions_es.index(index=key, doc_type=assembly, body=doc, id=str(id))
-
-        # Now add dataset to residency list
+    def add_region_batch(self, id, assembly, chrom, chunk, starts, ends):
+        '''Queues one batch of a file's peaks on one chromosome for region search es.'''
+        doc = {
+            'uuid': str(id),
+            'positions': [{'start': start, 'end': end} for start, end in zip(starts, ends)]
+        }
+        # Could be a chrom never seen before!
+        self.ensure_mapping(chrom, assembly, get_mapping(assembly))
+        self.queue_action({
+            '_op_type': 'index',
+            '_index': chrom,
+            '_type': assembly,
+            '_id': region_doc_id(id, chunk),
+            '_source': doc
+        }, positions=len(doc['positions']))
+
+    def add_residency(self, id, assembly, assay_term_name, chunks, source='encoded', added=None):
+        '''Records that an id is resident in region search es, along with how many batches each chrom took.
+           The residency doc is written by flush_regions_es once all of the id's region docs have been.
+           With added (accession, href, using), the file is logged and handed on as added then.'''
         doc = {
             'uuid': str(id),
             'source': source,
             'assay_term_name': assay_term_name,
             'assembly': assembly,
-            'chroms': list(regions.keys())
+            'chroms': list(chunks.keys()),
+            'chunks': chunks
         }
         # Make sure there is an index set up to handle whether uuids are resident
-        if not self.regions_es.indices.exists(self.residents_index):
-            self.regions_es.indices.create(index=self.residents_index, body=index_settings())
-
-        if not self.regions_es.indices.exists_type(index=self.residents_index, doc_type='default'):
-            mapping = {'default': {"enabled": False}}
-            self.regions_es.indices.put_mapping(index=self.residents_index, doc_type='default', body=mapping)
-
-        self.regions_es.index(index=self.residents_index, doc_type='default', body=doc, id=str(id))
+        self.ensure_mapping(self.residents_index, 'default', {'default': {"enabled": False}})
+        self.pending_residents[str(id)] = {
+            'action': {
+                '_op_type': 'index',
+                '_index': self.residents_index,
+                '_type': 'default',
+                '_id': str(id),
+                '_source': doc
+            },
+            'chunks': chunks,
+            'added': added
+        }
         return True
 
-    def add_encoded_file_to_regions_es(self, request, assay_term_name, afile):
-        '''Given an encoded file object, reads the file to create regions data then loads that into region search es.'''
+    def add_to_regions_es(self, id, assembly, assay_term_name, regions, source='encoded'):
+        '''Given regions from some source (most likely encoded file) loads the data into region search es'''
         #return True # DEBUG
+        chunks = {}
+        for chrom in regions:
+            positions = regions[chrom]
+            for chunk, i in enumerate(range(0, len(positions), REGIONS_BATCH_SIZE)):
+                batch = positions[i:i + REGIONS_BATCH_SIZE]
+                starts = [position['start'] for position in batch]
+                ends = [position['end'] for position in batch]
+                self.add_region_batch(id, assembly, chrom, chunk, starts, ends)
+                chunks[chrom] = chunk + 1
+
+        # Now add dataset to residency list
+        self.add_residency(id, assembly, assay_term_name, chunks, source)
+        self.flush_regions_es()
+        return True
 
+    def encoded_file_assembly(self, afile):
+        '''Returns the regions es assembly (doc_type) for an encoded file, or None if not supported.'''
         assembly = afile.get('assembly','unknown')
         if assembly == 'mm10-minimal':        # Treat mm10-minimal as mm10
             assembly = 'mm10'
         if assembly not in SUPPORTED_ASSEMBLIES:
-            return False
+            return None
+        return assembly
 
+    def encoded_file_href(self, request, afile):
+        '''Returns the url an encoded file can be downloaded from.'''
         # Special case local instace so that tests can work...
         if self.test_instance:
             #if request.host_url == 'http://localhost':
             # assume we are running in dev-servers
             #href = request.host_url + ':8000' + afile['submitted_file_name']
-            href = 'http://www.encodeproject.org' + afile['href']
-        else:
-            href = request.host_url + afile['href']
-
-        ### Works with localhost:8000
-        # NOTE: Using requests instead of http.request which works locally and doesn't require gzip.open
-        #r = requests.get(href)
-        #if not r or r.status_code != 200:
-        #    log.warn("File (%s or %s) not found" % (afile.get('accession', id), href))
-        #    return False
-        #file_in_mem = io.StringIO()
-        #file_in_mem.write(r.text)
-        #file_in_mem.seek(0)
-        #
-        #file_data = {}
-        #if afile['file_format'] == 'bed':
-        #    for row in tsvreader(file_in_mem):
-        #        chrom, start, end = row[0].lower(), int(row[1]), int(row[2])
-        #        if isinstance(start, int) and isinstance(end, int):
-        #            if chrom in file_data:
-        #                file_data[chrom].append({
-        #                    'start': start + 1,
-        #                    'end': end + 1
-        #                })
-        #            else:
-        #                file_data[chrom] = [{'start': start + 1, 'end': end + 1}]
-        #        else:
-        #            log.warn('positions are not integers, will not index file')
-        ##else:  Other file types?
+            return 'http://www.encodeproject.org' + afile['href']
+        return request.host_url + afile['href']
 
+    def read_encoded_file(self, href, afile):
+        '''Yields (chrom, starts, ends) batches of peaks streamed from an encoded file's download url.
+           Safe to run in a worker thread: it touches neither the request nor regions es.'''
         ### Works with http://www.encodeproject.org
-        # Note: this reads the file into an in-memory byte stream.  If files get too large,
-        # We could replace this with writing a temp file, then reading it via gzip and tsvreader.
+        # Note: the response is decompressed and parsed as it arrives.  Only one batch of peaks
+        # per chromosome is ever in memory, each being flushed to regions es as it fills.
         urllib3.disable_warnings()
         http = urllib3.PoolManager()
-        r = http.request('GET', href)
-        if r.status != 200:
-            log.warn("File (%s or %s) not found" % (afile.get('accession', id), href))
+        r = http.request('GET', href, preload_content=False)
+        try:
+            if r.status != 200:
+                log.warn("File (%s or %s) not found" % (afile.get('accession', id), href))
+                return
+            if afile['file_format'] == 'bed':
+                # NOTE: requests doesn't require gzip but http.request does.
+                with gzip.open(r, mode='rt') as file:  # localhost:8000 would not require localhost
+                    for batch in read_bed_regions(file):
+                        yield batch
+            #else:  Other file types?
+        finally:
+            r.release_conn()
+
+    def discard_partial_file(self, id, assembly, chunks):
+        '''Queues deletes for the region batches already written for a file that could not be finished.'''
+        for chrom, count in chunks.items():
+            for chunk in range(count):
+                self.queue_action({
+                    '_op_type': 'delete',
+                    '_index': chrom,
+                    '_type': assembly,
+                    '_id': region_doc_id(id, chunk)
+                })
+
+    def add_encoded_file_to_regions_es(self, request, assay_term_name, afile, added=None):
+        '''Given an encoded file object, reads the file to create regions data then loads that into region search es.'''
+        #return True # DEBUG
+
+        assembly = self.encoded_file_assembly(afile)
+        if assembly is None:
             return False
-        file_in_mem = io.BytesIO()
-        file_in_mem.write(r.data)
-        file_in_mem.seek(0)
-        r.release_conn()
-
-        file_data = {}
-        if afile['file_format'] == 'bed':
-            # NOTE: requests doesn't require gzip but http.request does.
-            with gzip.open(file_in_mem, mode='rt') as file:  # localhost:8000 would not require localhost
-                for row in tsvreader(file):
-                    chrom, start, end = row[0].lower(), int(row[1]), int(row[2])
-                    if isinstance(start, int) and isinstance(end, int):
-                        if chrom in file_data:
-                            file_data[chrom].append({
-                                'start': start + 1,
-                                'end': end + 1
-                            })
-                        else:
-                            file_data[chrom] = [{'start': start + 1, 'end': end + 1}]
-                    else:
-                        log.warn('positions are not integers, will not index file')
-        #else:  Other file types?
-
-        if file_data:
-            return self.add_to_regions_es(afile['uuid'], assembly, assay_term_name, file_data, 'encoded')
+        href = self.encoded_file_href(request, afile)
+
+        chunks = {}
+        try:
+            for (chrom, starts, ends) in self.read_encoded_file(href, afile):
+                chunk = chunks.get(chrom, 0)
+                self.add_region_batch(afile['uuid'], assembly, chrom, chunk, starts, ends)
+                chunks[chrom] = chunk + 1
+        except ValueError:
+            log.warn('positions are not integers, will not index file %s' % (afile.get('accession', href)))
+            self.discard_partial_file(afile['uuid'], assembly, chunks)  # Don't leave a partial file behind
+            return False
+
+        if chunks:
+            return self.add_residency(afile['uuid'], assembly, assay_term_name, chunks, 'encoded', added)
 
         return False
+
+    def submit_encoded_file(self, request, accession, assay_term_name, afile, using=''):
+        '''Hands an encoded file to the worker pool to be downloaded and parsed.
+           Its peaks come back through self.loaded and are written by drain_loaded_files().'''
+        assembly = self.encoded_file_assembly(afile)
+        if assembly is None:
+            return
+        href = self.encoded_file_href(request, afile)
+        self.loading[afile['uuid']] = {
+            'accession': accession,
+            'assay_term_name': assay_term_name,
+            'assembly': assembly,
+            'href': href,
+            'using': using,
+            'chunks': {}
+        }
+        self.pool.submit(self.load_file_worker, href, afile, self.loaded, self.cancelled)
+        self.drain_loaded_files(block=False)
+
+    def load_file_worker(self, href, afile, loaded, cancelled):
+        '''Runs in the worker pool: streams one file's peaks onto the loaded queue for the main thread.'''
+        uuid = afile['uuid']
+
+        def put(item):
+            while not cancelled.is_set():  # Give up if the cycle was abandoned and nobody is reading
+                try:
+                    loaded.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in self.read_encoded_file(href, afile):
+                if not put(('batch', uuid, batch)):
+                    return
+        except Exception as e:
+            put(('error', uuid, e))
+        else:
+            put(('done', uuid, None))
+
+    def drain_loaded_files(self, block=True):
+        '''Writes peaks the workers have parsed so far.  With block, waits for every submitted file.'''
+        while self.loading:
+            try:
+                (what, uuid, value) = self.loaded.get(block=block)
+            except queue.Empty:
+                return
+            loading = self.loading[uuid]
+            if what == 'batch':
+                (chrom, starts, ends) = value
+                chunk = loading['chunks'].get(chrom, 0)
+                self.add_region_batch(uuid, loading['assembly'], chrom, chunk, starts, ends)
+                loading['chunks'][chrom] = chunk + 1
+                continue
+
+            del self.loading[uuid]
+            chunks = loading['chunks']
+            if what == 'error':
+                if isinstance(value, ValueError):
+                    log.warn('positions are not integers, will not index file %s' % (loading['href']))
+                else:
+                    log.error("Region indexer failed to read %s: %r" % (loading['href'], value))
+                    self.cycle_errors.append({
+                        'error_message': repr(value),
+                        'timestamp': datetime.datetime.now().isoformat(),
+                        'uuid': uuid
+                    })
+                self.discard_partial_file(uuid, loading['assembly'], chunks)  # Don't leave a partial file behind
+            elif chunks:
+                self.add_residency(uuid, loading['assembly'], loading['assay_term_name'], chunks, 'encoded',
+                                   added=(loading['accession'], loading['href'], loading['using']))
+
+    def interval_index_built(self):
+        '''Returns True unless an interval index is configured but has not been written yet.'''
+        if not self.interval_index_path:
+            return True
+        return os.path.exists(os.path.join(self.interval_index_path, CURRENT, 'index.json'))
+
+    def interval_changed(self, uuid, resident, previous=None):
+        '''Notes the chromosomes the interval index has to rewrite for a file now resident (resident is its
+           residency doc) or dropped (resident is None, previous was its residency doc).'''
+        self.interval_files[uuid] = resident
+        doc = resident if resident is not None else previous
+        self.interval_chroms.update((doc['assembly'], chrom) for chrom in doc['chroms'])
+
+    def read_interval_peaks(self, assembly, chrom, docs):
+        '''Reads the peaks of region docs [(position in uuids, region doc id)] on one chromosome from regions
+           es, INTERVAL_INDEX_MGET_SIZE at a time.  Returns (starts, ends, files) arrays.'''
+        (starts, ends, files) = (array('l'), array('l'), array('l'))
+        for i in range(0, len(docs), INTERVAL_INDEX_MGET_SIZE):
+            batch = docs[i:i + INTERVAL_INDEX_MGET_SIZE]
+            result = self.regions_es.mget(index=chrom, doc_type=assembly,
+                                          body={'ids': [doc_id for (_, doc_id) in batch]})
+            for (file_no, _), doc in zip(batch, result['docs']):
+                if not doc.get('found'):
+                    continue
+                for position in doc['_source']['positions']:
+                    starts.append(position['start'])
+                    ends.append(position['end'])
+                    files.append(file_no)
+        return (starts, ends, files)
+
+    def write_all_chroms(self, writer):
+        '''Writes every peak resident in regions es to writer.  Returns the uuids list.'''
+        query = {'query': {'match_all': {}}, '_source': ['uuid', 'assembly', 'chroms', 'chunks']}
+        uuids = []
+        chrom_docs = {}  # (assembly, chrom) => [(position in uuids, region doc id)]
+        try:
+            for hit in scan(self.regions_es, query=query, index=self.residents_index, doc_type='default'):
+                doc = hit['_source']
+                chunks = doc.get('chunks', {})
+                for chrom in doc['chroms']:
+                    for chunk in range(chunks.get(chrom, 1)):
+                        chrom_docs.setdefault((doc['assembly'], chrom), []).append(
+                            (len(uuids), region_doc_id(doc['uuid'], chunk)))
+                uuids.append(doc['uuid'])
+        except NotFoundError:
+            pass  # Nothing resident yet, so write an empty index
+
+        for (assembly, chrom), docs in sorted(chrom_docs.items()):
+            # One chromosome at a time, so memory is bounded by the largest chromosome
+            writer.add_chrom(assembly, chrom, *self.read_interval_peaks(assembly, chrom, docs))
+        return uuids
+
+    def write_changed_chroms(self, writer, current):
+        '''Writes the current interval index to writer with the files in interval_files added or dropped.
+           Only their chromosomes are rewritten, and only the added files' region docs are read from regions
+           es.  Returns the uuids list.'''
+        # Dropped files keep their place in uuids (no peak refers to it) until the next full write
+        uuids = list(current.uuids)
+        file_nos = {uuid: i for (i, uuid) in enumerate(uuids)}
+        replaced = np.array([file_nos[uuid] for uuid in self.interval_files if uuid in file_nos], dtype=np.int64)
+        chrom_docs = {}
+        for (uuid, doc) in sorted(self.interval_files.items()):
+            if doc is None:
+                continue
+            if uuid not in file_nos:
+                file_nos[uuid] = len(uuids)
+                uuids.append(uuid)
+            chunks = doc.get('chunks', {})
+            for chrom in doc['chroms']:
+                for chunk in range(chunks.get(chrom, 1)):
+                    chrom_docs.setdefault((doc['assembly'], chrom), []).append(
+                        (file_nos[uuid], region_doc_id(uuid, chunk)))
+
+        for (assembly, chroms) in sorted(current.chroms.items()):
+            for chrom in sorted(chroms):
+                if (assembly, chrom) not in self.interval_chroms:
+                    writer.copy_chrom(current, assembly, chrom)
+        for (assembly, chrom) in sorted(self.interval_chroms):
+            (starts, ends, files) = current.chrom_peaks(assembly, chrom)
+            keep = ~np.isin(files, replaced)
+            (new_starts, new_ends, new_files) = self.read_interval_peaks(
+                assembly, chrom, chrom_docs.get((assembly, chrom), []))
+            writer.add_chrom(assembly, chrom,
+                             np.concatenate([starts[keep], np.asarray(new_starts, dtype=np.int64)]),
+                             np.concatenate([ends[keep], np.asarray(new_ends, dtype=np.int64)]),
+                             np.concatenate([files[keep], np.asarray(new_files, dtype=np.int64)]))
+        return uuids
+
+    def write_interval_index(self):
+        '''Writes the in-process interval index used by region search.  The first write in a process (or after
+           a failed one) reads every peak in regions es; later ones rewrite only the chromosomes of files added
+           or dropped since, carrying the rest over from the current build.'''
+        if not self.interval_index_path:
+            return
+        current = None
+        if not self.interval_index_full:
+            current = load_interval_index(self.interval_index_path)
+        writer = IntervalIndexWriter(self.interval_index_path)
+        try:
+            if current is None:
+                uuids = self.write_all_chroms(writer)
+            else:
+                uuids = self.write_changed_chroms(writer, current)
+            writer.commit(uuids)
+        except:
+            log.error("Region indexer failed to write interval index %s" % (self.interval_index_path),
+                      exc_info=True)
+            writer.abort()
+            self.interval_index_full = True
+            return
+        if current is None:
+            log.info("Region indexer wrote interval index of %d files" % (len(uuids)))
+        else:
+            log.info("Region indexer rewrote %d chromosome(s) of interval index for %d changed files" %
+                     (len(self.interval_chroms), len(self.interval_files)))
+        self.interval_files = {}
+        self.interval_chroms = set()
+        self.interval_index_full = False
@@ -0,0 +1,199 @@
+"""\
+In-process interval index for region search.
+
+The region indexer can write every peak resident in regions es out to a
+directory of sorted numpy arrays, one set per assembly and chromosome.
+Web workers memory-map those arrays and answer region search overlap
+queries locally instead of sending a nested query to elasticsearch.
+
+Layout of the directory named by the region_search.interval_index setting:
+
+    current -> build-<timestamp>-<pid>-<n>   symlink swapped atomically on rebuild
+    build-.../index.json                      file uuids and per-chromosome peak counts
+    build-.../<assembly>/<chrom>.starts.npy
+    build-.../<assembly>/<chrom>.ends.npy
+    build-.../<assembly>/<chrom>.files.npy    index into the uuids list
+
+A build may carry chromosomes over from the previous one (hard linked), so
+only the chromosomes that changed need writing.
+
+When no index has been built, region search falls back to elasticsearch.
+"""
+import itertools
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+INTERVAL_INDEX_SETTING = 'region_search.interval_index'
+CURRENT = 'current'
+BUILD_PREFIX = 'build-'
+_ARRAYS = ('starts', 'ends', 'files')
+
+# path => IntervalIndex, reloaded when the current symlink moves
+_loaded = {}
+
+# Numbers builds started by this process, so two in the same millisecond get different directories
+_builds = itertools.count()
+
+
+def get_interval_index(registry):
+    '''Returns the IntervalIndex configured for this app, or None if there isn't a built one.'''
+    path = registry.settings.get(INTERVAL_INDEX_SETTING)
+    if not path:
+        return None
+    return load_interval_index(path)
+
+
+def load_interval_index(path):
+    '''Returns the current IntervalIndex in the directory path, or None if there isn't a built one.'''
+    build = os.path.realpath(os.path.join(path, CURRENT))
+    index = _loaded.get(path)
+    if index is not None and index.path == build:
+        return index
+    try:
+        index = IntervalIndex(build)
+    except (IOError, OSError, ValueError):
+        return None  # Not built yet
+    _loaded[path] = index
+    return index
+
+
+class IntervalIndex(object):
+    '''Read-only view of one interval index build.  Arrays are memory-mapped on first use,
+       so all workers on a machine share the same pages.'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            meta = json.load(f)
+        self.uuids = meta['uuids']
+        self.chroms = meta['chroms']
+        self.arrays = {}
+
+    def _arrays(self, assembly, chrom):
+        arrays = self.arrays.get((assembly, chrom))
+        if arrays is None:
+            base = os.path.join(self.path, assembly, chrom)
+            arrays = tuple(np.load('%s.%s.npy' % (base, name), mmap_mode='r') for name in _ARRAYS)
+            self.arrays[(assembly, chrom)] = arrays
+        return arrays
+
+    def chrom_peaks(self, assembly, chrom):
+        '''Returns (starts, ends, files) of all the peaks on one chromosome, sorted by start.'''
+        if chrom not in self.chroms.get(assembly, {}):
+            empty = np.empty(0, dtype=np.int64)
+            return (empty, empty, empty)
+        return self._arrays(assembly, chrom)
+
+    def overlapping(self, assembly, chrom, start, end):
+        '''Returns (starts, ends, files) of the peaks matched by region search's peak query.'''
+        info = self.chroms.get(assembly, {}).get(chrom)
+        if info is None:
+            empty = np.empty(0, dtype=np.int64)
+            return (empty, empty, empty)
+        (starts, ends, files) = self._arrays(assembly, chrom)
+        low, high = min(start, end), max(start, end)
+        # Sorted by start, so only peaks starting within max_length of the range can reach it
+        first = np.searchsorted(starts, low - info['max_length'], side='left')
+        last = np.searchsorted(starts, high, side='right')
+        (starts, ends, files) = (starts[first:last], ends[first:last], files[first:last])
+        # Same four clauses as region_search.get_peak_query
+        match = (starts <= start) & (ends >= end)
+        match |= (starts <= end) & (ends >= start)
+        match |= (starts <= start) & (ends >= start)
+        match |= (starts <= end) & (ends >= end)
+        return (starts[match], ends[match], files[match])
+
+    def file_uuids(self, assembly, chrom, start, end):
+        '''Returns the set of file uuids with a peak overlapping the region.'''
+        files = self.overlapping(assembly, chrom, start, end)[2]
+        return set(self.uuids[i] for i in np.unique(files))
+
+    def peak_hits(self, assembly, chrom, start, end, with_inner_hits=False):
+        '''Returns overlapping peaks shaped like the hits of region_search.get_peak_query.'''
+        (starts, ends, files) = self.overlapping(assembly, chrom, start, end)
+        hits = []
+        for i in np.unique(files):
+            hit = {
+                '_index': chrom,
+                '_type': assembly,
+                '_id': self.uuids[i],
+            }
+            if with_inner_hits:
+                mine = files == i
+                hit['inner_hits'] = {'positions': {'hits': {'hits': [
+                    {'_source': {'start': int(s), 'end': int(e)}}
+                    for s, e in zip(starts[mine], ends[mine])
+                ]}}}
+            hits.append(hit)
+        return hits
+
+
+class IntervalIndexWriter(object):
+    '''Writes a new interval index build next to the current one, then swaps it in.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.build = os.path.join(path, '%s%d-%d-%d' % (BUILD_PREFIX, int(time.time() * 1000), os.getpid(),
+                                                          next(_builds)))
+        os.makedirs(self.build)
+        self.chroms = {}
+
+    def add_chrom(self, assembly, chrom, starts, ends, files):
+        '''Sorts and writes one chromosome's peaks.  files are positions in the uuids list given to commit.'''
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        files = np.asarray(files, dtype=np.int32)
+        if not len(starts):
+            return
+        order = np.argsort(starts, kind='mergesort')
+        directory = os.path.join(self.build, assembly)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        base = os.path.join(directory, chrom)
+        for name, values in zip(_ARRAYS, (starts, ends, files)):
+            np.save('%s.%s.npy' % (base, name), values[order])
+        self.chroms.setdefault(assembly, {})[chrom] = {
+            'count': int(len(starts)),
+            'max_length': max(int((ends - starts).max()), 0),
+        }
+
+    def copy_chrom(self, index, assembly, chrom):
+        '''Carries one chromosome over unchanged from another build, hard linking its arrays where possible.'''
+        directory = os.path.join(self.build, assembly)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in _ARRAYS:
+            source = '%s.%s.npy' % (os.path.join(index.path, assembly, chrom), name)
+            target = '%s.%s.npy' % (os.path.join(directory, chrom), name)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
+        self.chroms.setdefault(assembly, {})[chrom] = dict(index.chroms[assembly][chrom])
+
+    def commit(self, uuids):
+        '''Makes this build the current one and removes older builds.'''
+        with open(os.path.join(self.build, 'index.json'), 'w') as f:
+            json.dump({'uuids': list(uuids), 'chroms': self.chroms}, f)
+        current = os.path.join(self.path, CURRENT)
+        previous = os.path.basename(os.path.realpath(current)) if os.path.lexists(current) else None
+        link = current + '.tmp'
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.basename(self.build), link)
+        os.replace(link, current)
+        # The previous build is kept for workers still part way through reading it
+        for name in os.listdir(self.path):
+            if name.startswith(BUILD_PREFIX) and name not in (os.path.basename(self.build), previous):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def abort(self):
+        shutil.rmtree(self.build, ignore_errors=True)
@@ -14,6 +14,13 @@ from snovault.helpers.helper import (
     set_facets
 )
 from .batch_download import get_peak_metadata_links
+from .region_indexer import region_doc_uuid
+from .region_intervals import get_interval_index
+from .coordinate_cache import (
+    DEFAULT_CAPACITY,
+    DEFAULT_TTL,
+    CoordinateCache,
+)
 from collections import OrderedDict
 import requests
 from urllib.parse import urlencode
@@ -27,6 +34,8 @@ log = logging.getLogger(__name__)
 
 _ENSEMBL_URL = 'http://rest.ensembl.org/'
 
+COORDINATE_RESOLVER = 'coordinate_resolver'
+
 _REGION_FIELDS = [
     'embedded.files.uuid',
     'embedded.files.accession',
@@ -69,6 +78,7 @@ def includeme(config):
     config.add_route('region-search', '/region-search{slash:/?}')
     config.add_route('suggest', '/suggest{slash:/?}')
     config.scan(__name__)
+    config.registry[COORDINATE_RESOLVER] = coordinate_resolver(config.registry.settings)
 
 
 def get_bool_query(start, end):
@@ -163,94 +173,150 @@ def sanitize_rsid(rsid):
     return 'rs' + ''.join([a for a in filter(str.isdigit, rsid)])
 
 
-def get_annotation_coordinates(es, id, assembly):
-    ''' Gets annotation coordinates from annotation index in ES '''
-    chromosome, start, end = '', '', ''
-    try:
-        es_results = es.get(index='annotations', doc_type='default', id=id)
-    except:
-        return (chromosome, start, end)
-    else:
-        annotations = es_results['_source']['annotations']
-        for annotation in annotations:
-            if annotation['assembly_name'] == assembly:
-                return ('chr' + annotation['chromosome'],
-                        annotation['start'],
-                        annotation['end'])
-        else:
-            return (chromosome, start, end)
+class CoordinateResolver(object):
+    '''Turns annotation ids, rsIDs and Ensembl ids into coordinates.  Answers are kept in a
+       CoordinateCache so popular SNPs and genes are only looked up once; the Ensembl REST API
+       is only reached through fetch(), and ensembl_url can point at a local stub.'''
 
-def assembly_mapper(location, species, input_assembly, output_assembly):
-    # All others
-    new_url = _ENSEMBL_URL + 'map/' + species + '/' \
-        + input_assembly + '/' + location + '/' + output_assembly \
-        + '/?content-type=application/json'
-    try:
-        new_response = requests.get(new_url).json()
-    except:
-        return('', '', '')
-    else:
-        if 'mappings' not in new_response or len(new_response['mappings']) < 1:
+    def __init__(self, cache, ensembl_url=_ENSEMBL_URL):
+        self.cache = cache
+        self.ensembl_url = ensembl_url
+
+    def fetch(self, url):
+        return requests.get(url).json()
+
+    def annotation(self, es, id, assembly):
+        ''' Gets annotation coordinates from annotation index in ES '''
+        key = 'annotation:{}:{}'.format(id, assembly)
+        return self.cache.lookup(key, lambda: self._annotation(es, id, assembly))
+
+    def _annotation(self, es, id, assembly):
+        chromosome, start, end = '', '', ''
+        try:
+            es_results = es.get(index='annotations', doc_type='default', id=id)
+        except:
+            return (chromosome, start, end)
+        else:
+            annotations = es_results['_source']['annotations']
+            for annotation in annotations:
+                if annotation['assembly_name'] == assembly:
+                    return ('chr' + annotation['chromosome'],
+                            annotation['start'],
+                            annotation['end'])
+            else:
+                return (chromosome, start, end)
+
+    def assembly_mapper(self, location, species, input_assembly, output_assembly):
+        key = 'map:{}:{}:{}:{}'.format(species, input_assembly, location, output_assembly)
+        return self.cache.lookup(
+            key, lambda: self._assembly_mapper(location, species, input_assembly, output_assembly))
+
+    def _assembly_mapper(self, location, species, input_assembly, output_assembly):
+        # All others
+        new_url = self.ensembl_url + 'map/' + species + '/' \
+            + input_assembly + '/' + location + '/' + output_assembly \
+            + '/?content-type=application/json'
+        try:
+            new_response = self.fetch(new_url)
+        except:
             return('', '', '')
-        data = new_response['mappings'][0]['mapped']
-        chromosome = 'chr' + data['seq_region_name']
-        start = data['start']
-        end = data['end']
-        return(chromosome, start, end)
-
-
-def get_rsid_coordinates(id, assembly):
-    species = _GENOME_TO_SPECIES[assembly]
-    url = '{ensembl}variation/{species}/{id}?content-type=application/json'.format(
-        ensembl=_ENSEMBL_URL,
-        species=species,
-        id=id
-    )
-    try:
-        response = requests.get(url).json()
-    except:
-        return('', '', '')
-    else:
-        if 'mappings' not in response:
+        else:
+            if 'mappings' not in new_response or len(new_response['mappings']) < 1:
+                return('', '', '')
+            data = new_response['mappings'][0]['mapped']
+            chromosome = 'chr' + data['seq_region_name']
+            start = data['start']
+            end = data['end']
+            return(chromosome, start, end)
+
+    def rsid(self, id, assembly):
+        key = 'rsid:{}:{}'.format(id, assembly)
+        return self.cache.lookup(key, lambda: self._rsid(id, assembly))
+
+    def _rsid(self, id, assembly):
+        species = _GENOME_TO_SPECIES[assembly]
+        url = '{ensembl}variation/{species}/{id}?content-type=application/json'.format(
+            ensembl=self.ensembl_url,
+            species=species,
+            id=id
+        )
+        try:
+            response = self.fetch(url)
+        except:
             return('', '', '')
-        for mapping in response['mappings']:
-            if 'PATCH' not in mapping['location']:
-                location = mapping['location']
-                if mapping['assembly_name'] == assembly:
-                    chromosome, start, end = re.split(':|-', mapping['location'])
-                    return('chr' + chromosome, start, end)
-                elif assembly == 'GRCh37':
-                    return assembly_mapper(location, species, 'GRCh38', assembly)
-                elif assembly == 'GRCm37':
-                    return assembly_mapper(location, species, 'GRCm38', 'NCBIM37')
-        return ('', '', '',)
-
-
-def get_ensemblid_coordinates(id, assembly):
-    species = _GENOME_TO_SPECIES[assembly]
-    url = '{ensembl}lookup/id/{id}?content-type=application/json'.format(
-        ensembl=_ENSEMBL_URL,
-        id=id
-    )
-    try:
-        response = requests.get(url).json()
-    except:
-        return('', '', '')
-    else:
-        location = '{chr}:{start}-{end}'.format(
-            chr=response['seq_region_name'],
-            start=response['start'],
-            end=response['end']
+        else:
+            if 'mappings' not in response:
+                return('', '', '')
+            for mapping in response['mappings']:
+                if 'PATCH' not in mapping['location']:
+                    location = mapping['location']
+                    if mapping['assembly_name'] == assembly:
+                        chromosome, start, end = re.split(':|-', mapping['location'])
+                        return('chr' + chromosome, start, end)
+                    elif assembly == 'GRCh37':
+                        return self.assembly_mapper(location, species, 'GRCh38', assembly)
+                    elif assembly == 'GRCm37':
+                        return self.assembly_mapper(location, species, 'GRCm38', 'NCBIM37')
+            return ('', '', '',)
+
+    def ensemblid(self, id, assembly):
+        key = 'ensembl:{}:{}'.format(id.upper(), assembly)
+        return self.cache.lookup(key, lambda: self._ensemblid(id, assembly))
+
+    def _ensemblid(self, id, assembly):
+        species = _GENOME_TO_SPECIES[assembly]
+        url = '{ensembl}lookup/id/{id}?content-type=application/json'.format(
+            ensembl=self.ensembl_url,
+            id=id
         )
-        if response['assembly_name'] == assembly:
-            chromosome, start, end = re.split(':|-', location)
-            return('chr' + chromosome, start, end)
-        elif assembly == 'GRCh37':
-            return assembly_mapper(location, species, 'GRCh38', assembly)
-        elif assembly == 'GRCm37':
-            return assembly_mapper(location, species, 'GRCm38', 'NCBIM37')
+        try:
+            response = self.fetch(url)
+        except:
+            return('', '', '')
         else:
-            return ('', '', '')
+            location = '{chr}:{start}-{end}'.format(
+                chr=response['seq_region_name'],
+                start=response['start'],
+                end=response['end']
+            )
+            if response['assembly_name'] == assembly:
+                chromosome, start, end = re.split(':|-', location)
+                return('chr' + chromosome, start, end)
+            elif assembly == 'GRCh37':
+                return self.assembly_mapper(location, species, 'GRCh38', assembly)
+            elif assembly == 'GRCm37':
+                return self.assembly_mapper(location, species, 'GRCm38', 'NCBIM37')
+            else:
+                return ('', '', '')
+
+    def seed_annotations(self, docs):
+        '''Caches the coordinates of annotation docs as built by generate-annotations, so lookups
+           of those genes never reach es or Ensembl.'''
+        items = []
+        for doc in docs:
+            if not doc or 'annotations' not in doc or 'id' not in doc:
+                continue  # bulk action lines
+            for annotation in doc['annotations']:
+                if not annotation.get('chromosome'):
+                    continue
+                coordinates = ('chr' + str(annotation['chromosome']), annotation['start'], annotation['end'])
+                items.append(('annotation:{}:{}'.format(doc['id'], annotation['assembly_name']), coordinates))
+                if doc['id'].upper().startswith('ENS') and annotation['assembly_name'] in ('GRCh38', 'GRCm38'):
+                    key = 'ensembl:{}:{}'.format(doc['id'].upper(), annotation['assembly_name'])
+                    items.append((key, coordinates))
+        self.cache.set_many(items)
+        return len(items)
+
+
+def coordinate_resolver(settings):
+    '''Returns a CoordinateResolver configured from the region_search.* settings.'''
+    cache = CoordinateCache(
+        path=settings.get('region_search.coordinate_cache'),
+        capacity=int(settings.get('region_search.coordinate_cache.capacity', DEFAULT_CAPACITY)),
+        ttl=int(settings.get('region_search.coordinate_cache.ttl', DEFAULT_TTL)),
+    )
+    return CoordinateResolver(cache, settings.get('region_search.ensembl_url', _ENSEMBL_URL))
+
 
 def format_position(position, resolution):
     chromosome, start, end = re.split(':|-', position)
@@ -298,19 +364,20 @@ def region_search(context, request):
     annotation = request.params.get('annotation', '*')
     chromosome, start, end = ('', '', '')
 
+    resolver = request.registry[COORDINATE_RESOLVER]
     if annotation != '*':
         if annotation.lower().startswith('ens'):
-            chromosome, start, end = get_ensemblid_coordinates(annotation, assembly)
+            chromosome, start, end = resolver.ensemblid(annotation, assembly)
         else:
-            chromosome, start, end = get_annotation_coordinates(es, annotation, assembly)
+            chromosome, start, end = resolver.annotation(es, annotation, assembly)
     elif region != '*':
         region = region.lower()
         if region.startswith('rs'):
             sanitized_region = sanitize_rsid(region)
-            chromosome, start, end = get_rsid_coordinates(sanitized_region, assembly)
+            chromosome, start, end = resolver.rsid(sanitized_region, assembly)
             region_inside_peak_status = True
         elif region.startswith('ens'):
-            chromosome, start, end = get_ensemblid_coordinates(region, assembly)
+            chromosome, start, end = resolver.ensemblid(region, assembly)
         elif region.startswith('chr'):
             chromosome, start, end = sanitize_coordinates(region)
     else:
@@ -325,25 +392,30 @@ def region_search(context, request):
         )
 
     # Search for peaks for the coordinates we got
-    try:
-        # including inner hits is very slow
-        # figure out how to distinguish browser requests from .embed method requests
-        if 'peak_metadata' in request.query_string:
-            peak_query = get_peak_query(start, end, with_inner_hits=True, within_peaks=region_inside_peak_status)
-        else:
-            peak_query = get_peak_query(start, end, within_peaks=region_inside_peak_status)
-        peak_results = snp_es.search(body=peak_query,
-                                     index=chromosome.lower(),
-                                     doc_type=_GENOME_TO_ALIAS[assembly],
-                                     size=99999)
-    except Exception:
-        result['notification'] = 'Error during search'
-        return result
-    file_uuids = []
-    for hit in peak_results['hits']['hits']:
-        if hit['_id'] not in file_uuids:
-            file_uuids.append(hit['_id'])
-    file_uuids = list(set(file_uuids))
+    # including inner hits is very slow
+    # figure out how to distinguish browser requests from .embed method requests
+    with_inner_hits = 'peak_metadata' in request.query_string
+    peaks = None
+    interval_index = get_interval_index(request.registry)
+    if interval_index is not None and assembly in _GENOME_TO_ALIAS:
+        try:
+            peaks = interval_index.peak_hits(_GENOME_TO_ALIAS[assembly], chromosome.lower(),
+                                             int(start), int(end), with_inner_hits=with_inner_hits)
+        except Exception:
+            log.warn('Region search interval index failed, using elasticsearch', exc_info=True)
+    if peaks is None:
+        try:
+            peak_query = get_peak_query(start, end, with_inner_hits=with_inner_hits,
+                                        within_peaks=region_inside_peak_status)
+            peak_results = snp_es.search(body=peak_query,
+                                         index=chromosome.lower(),
+                                         doc_type=_GENOME_TO_ALIAS[assembly],
+                                         size=99999)
+        except Exception:
+            result['notification'] = 'Error during search'
+            return result
+        peaks = peak_results['hits']['hits']
+    file_uuids = list(set(region_doc_uuid(hit['_id']) for hit in peaks))
     result['notification'] = 'No results found'
 
 
@@ -373,7 +445,7 @@ def region_search(context, request):
         result['@graph'] = list(format_results(request, es_results['hits']['hits']))
         result['total'] = total = es_results['hits']['total']
         result['facets'] = BaseView._format_facets(es_results, _FACETS, used_filters, schemas, total, principals)
-        result['peaks'] = list(peak_results['hits']['hits'])
+        result['peaks'] = list(peaks)
         result['download_elements'] = get_peak_metadata_links(request)
         if result['total'] > 0:
             result['notification'] = 'Success'
@@ -0,0 +1,85 @@
+import pytest
+
+
+ES_RESULTS = {
+    'hits': {'total': 3},
+    'aggregations': {'matrix': {'doc_count': 3, 'x': {'buckets': [{'key': 'ChIP-seq', 'doc_count': 3}]}}},
+}
+
+
+@pytest.fixture
+def agg_request(mocker):
+    from pyramid.registry import Registry
+    from pyramid.request import Request
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    from encoded.aggregation_cache import AGGREGATION_CACHE, AggregationCache
+    cache = AggregationCache(max_bytes=4096, ttl=60)
+    principals = mocker.patch.object(Request, 'effective_principals', new_callable=mocker.PropertyMock,
+                                     return_value=['system.Everyone'])
+
+    def make(query='type=Experiment', xmin=100, user=None):
+        request = Request.blank('/matrix/?' + query)
+        request._stats = {}
+        es = mocker.Mock()
+        es.get.return_value = {'_source': {'status': 'done', 'xmin': xmin}}
+        request.registry = Registry()
+        request.registry.settings = {'snovault.elasticsearch.index': 'snovault'}
+        request.registry.update({ELASTIC_SEARCH: es, AGGREGATION_CACHE: cache})
+        principals.return_value = ['system.Everyone'] + ([user] if user else [])
+        return request
+    return make
+
+
+def test_aggregation_cache_shared_by_same_query(agg_request, mocker):
+    from encoded.aggregation_cache import cached_search
+    search = mocker.Mock(side_effect=lambda: __import__('copy').deepcopy(ES_RESULTS))
+    request = agg_request('type=Experiment&status=released')
+    first = cached_search(request, 'matrix', search)
+    assert request._stats == {'aggregation_cache_miss_count': 1}
+    # Views rework the results in place, which mustn't reach the cache
+    first['aggregations']['matrix']['x'] = 'summarized'
+    request = agg_request('status=released&type=Experiment&x.limit=50')
+    second = cached_search(request, 'matrix', search)
+    assert search.call_count == 1
+    assert second == ES_RESULTS
+    assert request._stats == {'aggregation_cache_hit_count': 1}
+
+
+@pytest.mark.parametrize('other', [
+    {'query': 'type=Experiment&status=released'},
+    {'user': 'userid.1234'},
+    {'xmin': 101},
+])
+def test_aggregation_cache_keyed_on_params_principals_and_xmin(agg_request, mocker, other):
+    from encoded.aggregation_cache import cached_search
+    search = mocker.Mock(return_value=ES_RESULTS)
+    cached_search(agg_request(), 'matrix', search)
+    cached_search(agg_request(**other), 'matrix', search)
+    assert search.call_count == 2
+
+
+def test_aggregation_cache_not_used_without_indexer(agg_request, mocker):
+    from encoded.aggregation_cache import cached_search
+    search = mocker.Mock(return_value=ES_RESULTS)
+    cached_search(agg_request(xmin=None), 'matrix', search)
+    request = agg_request(xmin=None)
+    cached_search(request, 'matrix', search)
+    assert search.call_count == 2
+    assert request._stats == {}
+
+
+def test_aggregation_cache_bounds(mocker):
+    from encoded.aggregation_cache import AggregationCache
+    time = mocker.patch('encoded.aggregation_cache.time.time', return_value=1000)
+    cache = AggregationCache(max_bytes=40, ttl=10)
+    cache.set('a', {'a': 'x' * 10})
+    cache.set('b', {'b': 'x' * 10})
+    assert cache.get('a') is not None
+    cache.set('c', {'c': 'x'})
+    assert cache.get('b') is None
+    assert cache.size <= 40
+    cache.set('d', {'d': 'x' * 50})  # Too big to keep at all
+    assert cache.get('d') is None
+    time.return_value = 1011
+    assert cache.get('a') is None
+    assert cache.size == len('{"c": "x"}')
@@ -0,0 +1,221 @@
+import json
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+HUMAN_TSV = '\r'.join([
+    'HGNC ID\tApproved Symbol\tApproved Name\tSynonyms\tEntrez Gene ID\tEnsembl Gene ID',
+    'HGNC:5\tA1BG\talpha-1-B glycoprotein\t\t1\tENSG00000121410',
+    'HGNC:37133\tA1BG-AS1\tA1BG antisense RNA 1\tFLJ23569, NCRNA00181\t503538\tENSG00000268895',
+    'HGNC:24086\tA1CF\tAPOBEC1 complementation factor\t\t\tENSG00000148584',
+    'HGNC:7\tA2M\talpha-2-macroglobulin\t\t2\tENSG00000175899',
+])
+
+MOUSE_TSV = '\n'.join([
+    'Ensembl Gene ID\tChromosome Name\tGene Start (bp)\tGene End (bp)\tMGI symbol\tMGI ID',
+    'ENSMUSG00000064370\tMT\t15289\t16299\tmt-Cytb\tMGI:102501',
+    '',
+])
+
+STUB_RESPONSES = {
+    '/lookup/id/ENSG00000121410?content-type=application/json': {
+        'assembly_name': 'GRCh38', 'seq_region_name': '19', 'start': 58345178, 'end': 58353492,
+        'species': 'homo_sapiens', 'biotype': 'protein_coding',
+    },
+    '/lookup/id/ENSG00000268895?content-type=application/json': {
+        'assembly_name': 'GRCh38', 'seq_region_name': '19', 'start': 58347718, 'end': 58355183,
+        'species': 'homo_sapiens',
+    },
+    '/map/homo_sapiens/GRCh38/19:58345178-58353492/GRCh37/?content-type=application/json': {
+        'mappings': [{'mapped': {'seq_region_name': '19', 'start': 58856545, 'end': 58864859}}],
+    },
+    '/map/homo_sapiens/GRCh38/19:58347718-58355183/GRCh37/?content-type=application/json': {
+        'mappings': [],
+    },
+    '/gene/ENSMUSG00000064370?fields=genomic_pos_mm9': {
+        'genomic_pos_mm9': {'chr': 'MT', 'start': 15289, 'end': 16299},
+    },
+}
+
+
+@pytest.fixture
+def annotation_sources():
+    '''A local stand-in for the gene lists, the Ensembl REST API and mygene.info, recording requests.'''
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            if self.path in ('/human.tsv', '/mouse.tsv'):
+                body = (HUMAN_TSV if self.path == '/human.tsv' else MOUSE_TSV).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/tab-separated-values')
+            else:
+                body = json.dumps(STUB_RESPONSES.get(self.path, {'error': 'not found'})).encode('utf-8')
+                self.send_response(200 if self.path in STUB_RESPONSES else 400)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('X-RateLimit-Remaining', '50')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d/' % server.server_port, requested
+    server.shutdown()
+    server.server_close()
+
+
+def generate(url, cache_path, output_path, workers=2):
+    from encoded.commands.generate_annotations import (
+        AnnotationLookups,
+        human_annotations,
+        mouse_annotations,
+        write_annotations,
+    )
+    from encoded.coordinate_cache import CoordinateCache
+    lookups = AnnotationLookups(CoordinateCache(cache_path), ensembl_url=url, geneinfo_url=url + 'gene/')
+    return write_annotations(
+        output_path,
+        human_annotations(url + 'human.tsv', lookups, workers),
+        mouse_annotations(url + 'mouse.tsv', lookups, workers),
+    )
+
+
+def test_generate_annotations_ndjson(annotation_sources, tmpdir):
+    url, requested = annotation_sources
+    output = str(tmpdir.join('annotations.json'))
+    assert generate(url, str(tmpdir.join('cache.sqlite')), output) == 3
+    lines = [json.loads(line) for line in open(output)]
+    assert [line['index']['_id'] for line in lines[0::2]] == ['HGNC:5', 'HGNC:37133', 'ENSMUSG00000064370']
+    a1bg = lines[1]
+    assert a1bg['annotations'] == [
+        {'assembly_name': 'GRCh38', 'chromosome': '19', 'start': 58345178, 'end': 58353492},
+        {'assembly_name': 'GRCh37', 'chromosome': '19', 'start': 58856545, 'end': 58864859},
+    ]
+    assert a1bg['suggest']['input'][:2] == ['alpha-1-B glycoprotein (homo sapiens)', 'A1BG (homo sapiens)']
+    assert lines[3]['annotations'][1] == {'assembly_name': 'GRCh37', 'chromosome': '', 'start': '', 'end': ''}
+    assert 'NCRNA00181 (homo sapiens)' in lines[3]['suggest']['input']
+    assert lines[5]['annotations'][1] == {'assembly_name': 'GRCm37', 'chromosome': 'MT', 'start': 15289, 'end': 16299}
+    # A2M couldn't be looked up
+    assert '/lookup/id/ENSG00000175899?content-type=application/json' in requested
+    assert not tmpdir.join('annotations.json.tmp').check()
+
+
+def test_generate_annotations_rerun_uses_cache(annotation_sources, tmpdir):
+    url, requested = annotation_sources
+    cache_path = str(tmpdir.join('cache.sqlite'))
+    generate(url, cache_path, str(tmpdir.join('first.json')))
+    del requested[:]
+    generate(url, cache_path, str(tmpdir.join('second.json')))
+    assert tmpdir.join('first.json').read() == tmpdir.join('second.json').read()
+    # Only lookups that failed are tried again
+    assert sorted(requested) == [
+        '/human.tsv',
+        '/lookup/id/ENSG00000175899?content-type=application/json',
+        '/map/homo_sapiens/GRCh38/19:58347718-58355183/GRCh37/?content-type=application/json',
+        '/mouse.tsv',
+    ]
+
+
+def test_generate_annotations_bounded_map_keeps_order():
+    import time
+    from encoded.commands.generate_annotations import bounded_map
+    consumed = []
+
+    def items():
+        for i in range(50):
+            consumed.append(i)
+            yield i
+
+    def slow_square(i):
+        time.sleep(0.001 * (i % 3))
+        return i * i
+
+    results = bounded_map(slow_square, items(), 2)
+    assert next(results) == 0
+    assert len(consumed) <= 2 * 4 + 1
+    assert list(results) == [i * i for i in range(1, 50)]
+
+
+class BulkRecorder(object):
+    '''Answers es bulk requests, rejecting the documents in `busy` once each.'''
+
+    def __init__(self, busy=()):
+        from types import SimpleNamespace
+        from elasticsearch.serializer import JSONSerializer
+        self.transport = SimpleNamespace(serializer=JSONSerializer())
+        self.busy = set(busy)
+        self.requests = []
+
+    def bulk(self, body, **kwargs):
+        lines = [json.loads(line) for line in body.strip().split('\n')]
+        ids = [line['index']['_id'] for line in lines[0::2]]
+        self.requests.append(ids)
+        items = []
+        for id in ids:
+            status = 201
+            if id in self.busy:
+                self.busy.discard(id)
+                status = 429
+            items.append({'index': {'_id': id, 'status': status}})
+        return {'errors': any(item['index']['status'] != 201 for item in items), 'items': items}
+
+
+def annotation_docs(count):
+    return [{'id': 'HGNC:%d' % i, 'annotations': [], 'suggest': {'input': []}} for i in range(count)]
+
+
+def test_index_annotations_reads_both_formats(tmpdir):
+    from encoded.commands.index_annotations import read_annotations
+    docs = annotation_docs(3)
+    lines = []
+    for doc in docs:
+        lines.extend([{'index': {'_index': 'annotations', '_type': 'default', '_id': doc['id']}}, doc])
+    ndjson = tmpdir.join('annotations.ndjson')
+    ndjson.write(''.join(json.dumps(line) + '\n' for line in lines))
+    legacy = tmpdir.join('annotations.json')
+    legacy.write(' ' + json.dumps(lines))
+    assert list(read_annotations(str(ndjson))) == docs
+    assert list(read_annotations(str(legacy))) == docs
+
+
+def test_index_annotations_chunks_and_retries(mocker):
+    from encoded.commands.index_annotations import index_annotations
+    mocker.patch('elasticsearch.helpers.time.sleep')
+    es = BulkRecorder(busy=['HGNC:3'])
+    indexed, errors = index_annotations(es, iter(annotation_docs(5)), chunk_size=2)
+    assert (indexed, errors) == (5, [])
+    assert es.requests == [['HGNC:0', 'HGNC:1'], ['HGNC:2', 'HGNC:3'], ['HGNC:3'], ['HGNC:4']]
+
+
+def test_index_annotations_gives_up_after_retries(mocker):
+    from encoded.commands.index_annotations import index_annotations
+    mocker.patch('elasticsearch.helpers.time.sleep')
+    es = BulkRecorder(busy=['HGNC:1'])
+    indexed, errors = index_annotations(es, iter(annotation_docs(2)), max_retries=0)
+    assert indexed == 1
+    assert [error['index']['_id'] for error in errors] == ['HGNC:1']
+
+
+def test_index_annotations_seeds_in_batches():
+    from encoded.commands.index_annotations import seeding
+    from encoded.coordinate_cache import CoordinateCache
+    from encoded.region_search import CoordinateResolver
+    resolver = CoordinateResolver(CoordinateCache())
+    docs = [
+        {'id': 'HGNC:%d' % i, 'annotations': [
+            {'assembly_name': 'GRCh38', 'chromosome': '1', 'start': i, 'end': i + 10}]}
+        for i in range(5)
+    ]
+    seeded = seeding(iter(docs), resolver, batch_size=2)
+    assert next(seeded) == docs[0]
+    assert resolver.cache.get('annotation:HGNC:0:GRCh38') is None
+    assert list(seeded) == docs[1:]
+    assert resolver.cache.get('annotation:HGNC:4:GRCh38') == ('chr1', 4, 14)
@@ -0,0 +1,290 @@
+import pytest
+
+
+def reference_rep_fastqs(bam_file, files_structure, replicate_type):
+    # The replicate fastqs of is_outdated_bams_replicate before ExperimentFileGraph
+    rep_type_fastqs = [
+        f for f in files_structure.get('fastq_files').values()
+        if replicate_type in f
+    ]
+    rep_set = set(bam_file.get(replicate_type))
+    return [
+        f for f in rep_type_fastqs
+        if any(e in rep_set for e in set(f[replicate_type]))
+    ]
+
+
+def chip_pipeline():
+    return {
+        '@id': '/pipelines/ENCPL612HIG/',
+        'title': 'ChIP-seq read mapping',
+        'assay_term_names': ['ChIP-seq'],
+    }
+
+
+def analysis_step_version(title):
+    return {
+        'analysis_step': {'title': title, 'pipelines': [chip_pipeline()]},
+        'software_versions': [],
+    }
+
+
+def bam_metric(uuid):
+    return {
+        '@type': ['SamtoolsFlagstatsQualityMetric', 'QualityMetric', 'Item'],
+        'uuid': uuid,
+        'total': 30000000,
+        'processing_stage': 'filtered',
+    }
+
+
+def synthetic_files(dataset_id, replicates, files_per_replicate, prefix):
+    # fastqs, unfiltered and filtered bams for each replicate, and peaks from pairs of filtered bams
+    files = []
+    bams = []
+    for (bio, tech) in replicates:
+        replicate = {
+            '@id': '%sreplicates/%d_%d/' % (prefix, bio, tech),
+            'biological_replicate_number': bio,
+            'technical_replicate_number': tech,
+        }
+        fastqs = []
+        for i in range(files_per_replicate):
+            accession = '%sFF%d%d%03d' % (prefix.strip('/').upper(), bio, tech, i)
+            fastqs.append({
+                '@id': '/files/%s/' % accession,
+                'accession': accession,
+                'dataset': dataset_id,
+                'status': 'released',
+                'file_format': 'fastq',
+                'output_type': 'reads',
+                'output_category': 'raw data',
+                'lab': '/labs/some-lab/',
+                'replicate': replicate,
+                'biological_replicates': [bio],
+                'technical_replicates': ['%d_%d' % (bio, tech)],
+                'read_length': 50 + i % 2,
+                'read_count': 20000000,
+                'run_type': 'single-ended',
+                'platform': {'term_id': 'OBI:0002002', 'term_name': 'Illumina HiSeq 2000'},
+            })
+        files.extend(fastqs)
+        for (output_type, step) in [('unfiltered alignments', 'Alignment step'), ('alignments', 'Filtering step')]:
+            for assembly in ['GRCh38', 'hg19']:
+                accession = '%sBAM%d%d%s%s' % (prefix.strip('/').upper(), bio, tech, assembly, output_type[0])
+                bam = {
+                    '@id': '/files/%s/' % accession,
+                    'accession': accession,
+                    'dataset': dataset_id,
+                    'status': 'released',
+                    'file_format': 'bam',
+                    'output_type': output_type,
+                    'output_category': 'alignment',
+                    'assembly': assembly,
+                    'lab': '/labs/encode-processing-pipeline/',
+                    'award': {'rfa': 'ENCODE4'},
+                    'biological_replicates': [bio],
+                    'technical_replicates': ['%d_%d' % (bio, tech)],
+                    'derived_from': [f['@id'] for f in fastqs],
+                    'analysis_step_version': analysis_step_version(step),
+                    'quality_metrics': [bam_metric('%s-metric' % accession)],
+                    'mapped_read_length': 50,
+                }
+                files.append(bam)
+                if output_type == 'alignments':
+                    bams.append(bam)
+    return files, bams
+
+
+def synthetic_experiment(fastqs_per_replicate=40, replicates=6):
+    control_id = '/experiments/ENCSR000CTL/'
+    control_files, control_bams = synthetic_files(
+        control_id, [(1, 1), (2, 1)], fastqs_per_replicate // 4, '/ctl/')
+    experiment_id = '/experiments/ENCSR000EXP/'
+    replicate_numbers = [(1 + i, 1) for i in range(replicates)]
+    files, bams = synthetic_files(experiment_id, replicate_numbers, fastqs_per_replicate, '/exp/')
+    for (i, bam) in enumerate(bams):
+        accession = 'EXPPEAKS%03d' % i
+        files.append({
+            '@id': '/files/%s/' % accession,
+            'accession': accession,
+            'dataset': experiment_id,
+            'status': 'released',
+            'file_format': 'bed',
+            'output_type': 'peaks',
+            'output_category': 'annotation',
+            'assembly': bam['assembly'],
+            'lab': '/labs/encode-processing-pipeline/',
+            'award': {'rfa': 'ENCODE4'},
+            'biological_replicates': bam['biological_replicates'],
+            'derived_from': [bam['@id'], control_bams[i % len(control_bams)]['@id']],
+        })
+    control = {
+        '@id': control_id,
+        '@type': ['Experiment', 'Dataset', 'Item'],
+        'accession': 'ENCSR000CTL',
+        'status': 'released',
+        'assay_term_name': 'ChIP-seq',
+        'target': {'name': 'Control-human', 'investigated_as': ['control']},
+        'original_files': control_files,
+        'replicates': [],
+    }
+    return {
+        '@id': experiment_id,
+        '@type': ['Experiment', 'Dataset', 'Item'],
+        'accession': 'ENCSR000EXP',
+        'status': 'released',
+        'assay_term_name': 'ChIP-seq',
+        'assay_term_id': 'OBI:0000716',
+        'award': {'rfa': 'ENCODE4'},
+        'target': {'name': 'CTCF-human', 'investigated_as': ['transcription factor']},
+        'replication_type': 'isogenic',
+        'possible_controls': [control],
+        'original_files': files,
+        'contributing_files': [],
+        'replicates': [],
+    }
+
+
+def files_structure_of(experiment):
+    from encoded.audit.experiment import create_files_mapping, get_contributing_files
+    files_structure = create_files_mapping(experiment['original_files'], ['revoked', 'archived'])
+    files_structure['contributing_files'] = get_contributing_files(
+        experiment['contributing_files'], ['revoked', 'archived'])
+    return files_structure
+
+
+def test_experiment_file_graph_replicate_fastqs():
+    experiment = synthetic_experiment(fastqs_per_replicate=5)
+    files_structure = files_structure_of(experiment)
+    graph = files_structure['graph']
+    for bam in files_structure['alignments'].values():
+        for replicate_type in ['biological_replicates', 'technical_replicates']:
+            expected = reference_rep_fastqs(bam, files_structure, replicate_type)
+            found = graph.replicate_fastqs(replicate_type, set(bam[replicate_type]))
+            assert sorted(f['@id'] for f in found) == sorted(f['@id'] for f in expected)
+            assert found
+
+
+def test_experiment_file_graph_derived_from_files():
+    from encoded.audit.experiment import get_derived_from_files_set
+    experiment = synthetic_experiment(fastqs_per_replicate=5)
+    files_structure = files_structure_of(experiment)
+    graph = files_structure['graph']
+    for f in files_structure['original_files'].values():
+        for file_format in ['fastq', 'bam']:
+            expected = get_derived_from_files_set([f], files_structure, file_format, True)
+            assert graph.derived_from_files(f, file_format) == expected
+            assert graph.derived_from_files(f, file_format) is graph.derived_from_files(f, file_format)
+
+
+def test_experiment_file_graph_unfiltered_alignments():
+    from encoded.audit.experiment import has_no_unfiltered
+    experiment = synthetic_experiment(fastqs_per_replicate=5)
+    files_structure = files_structure_of(experiment)
+    graph = files_structure['graph']
+    unfiltered = list(files_structure['unfiltered_alignments'].values())
+    for bam in files_structure['alignments'].values():
+        assert has_no_unfiltered(bam, graph.unfiltered_alignments_like(bam)) == has_no_unfiltered(bam, unfiltered)
+        assert not has_no_unfiltered(bam, graph.unfiltered_alignments_like(bam))
+    lonely = dict(bam, derived_from=['/files/other/'])
+    assert has_no_unfiltered(lonely, graph.unfiltered_alignments_like(lonely))
+
+
+def test_experiment_file_graph_by_replicate():
+    experiment = synthetic_experiment(fastqs_per_replicate=3, replicates=2)
+    graph = files_structure_of(experiment)['graph']
+    assert sorted(graph.by_replicate) == ['/exp/replicates/1_1/', '/exp/replicates/2_1/']
+    assert [f['accession'] for f in graph.by_replicate['/exp/replicates/2_1/']] == [
+        'EXPFF21000', 'EXPFF21001', 'EXPFF21002']
+
+
+def test_experiment_file_graph_control_structures():
+    experiment = synthetic_experiment(fastqs_per_replicate=4)
+    files_structure = files_structure_of(experiment)
+    graph = files_structure['graph']
+    control = experiment['possible_controls'][0]
+    control_structure = graph.control_files_structure(control)
+    assert graph.control_files_structure(control) is control_structure
+    assert len(control_structure['alignments']) == 4
+    # Checks add to excluded_types as they go
+    files_structure['excluded_types'] += ['deleted', 'replaced']
+    assert graph.control_files_structure(control) is not control_structure
+
+
+def test_experiment_file_graph_metrics():
+    from encoded.audit.experiment import get_metrics
+    experiment = synthetic_experiment(fastqs_per_replicate=2, replicates=2)
+    shared = {'@type': ['StarQualityMetric', 'QualityMetric', 'Item'], 'uuid': 'shared-metric'}
+    bams = [f for f in experiment['original_files'] if f['output_type'] == 'alignments']
+    for bam in bams:
+        bam['quality_metrics'].append(shared)
+    bams[0]['genome_annotation'] = 'V24'
+    del bams[-1]['quality_metrics']
+    files_structure = files_structure_of(experiment)
+    graph = files_structure['graph']
+    alignments = files_structure['alignments'].values()
+    for metric_type in ['SamtoolsFlagstatsQualityMetric', 'StarQualityMetric', 'QualityMetric', 'IDRQualityMetric']:
+        for assembly in [None, 'GRCh38', 'hg19', 'mm10']:
+            for annotation in [None, 'V24']:
+                expected = get_metrics(alignments, metric_type, assembly, annotation)
+                assert graph.metrics('alignments', metric_type, assembly, annotation) == expected
+    assert graph.metrics('alignments', 'StarQualityMetric') == [shared]
+    assert graph.metrics('optimal_idr_peaks', 'IDRQualityMetric') == []
+
+
+def test_experiment_file_graph_audit_runs():
+    from encoded.audit.experiment import function_dispatcher_with_files
+    experiment = synthetic_experiment(fastqs_per_replicate=4)
+    files_structure = files_structure_of(experiment)
+    failures = []
+    for check in function_dispatcher_with_files.values():
+        failures.extend(check(experiment, None, files_structure))
+    assert 'out of date analysis' not in [failure.category for failure in failures]
+
+
+def test_experiment_file_graph_large_experiment():
+    from encoded.audit.experiment import is_outdated_bams_replicate
+    experiment = synthetic_experiment(fastqs_per_replicate=80, replicates=6)
+    files_structure = files_structure_of(experiment)
+    assert len(files_structure['original_files']) >= 500
+    graph = files_structure['graph']
+    bams = list(files_structure['alignments'].values()) + list(files_structure['unfiltered_alignments'].values())
+    for bam in bams:
+        expected = reference_rep_fastqs(bam, files_structure, 'technical_replicates')
+        found = graph.replicate_fastqs('technical_replicates', set(bam['technical_replicates']))
+        assert sorted(f['@id'] for f in found) == sorted(f['@id'] for f in expected)
+    assert not any(is_outdated_bams_replicate(bam, files_structure, 'DNase-seq') for bam in bams)
+
+
+@pytest.mark.slow
+def test_experiment_file_graph_benchmark():
+    # Reports timings only; a timing assert would fail at random on a loaded machine
+    import time
+    from encoded.audit.experiment import function_dispatcher_with_files, get_metrics
+    experiment = synthetic_experiment(fastqs_per_replicate=80, replicates=6)
+    files_structure = files_structure_of(experiment)
+    bams = list(files_structure['alignments'].values()) + list(files_structure['unfiltered_alignments'].values())
+
+    start = time.time()
+    for i in range(20):
+        for bam in bams:
+            reference_rep_fastqs(bam, files_structure, 'technical_replicates')
+            get_metrics(files_structure['alignments'].values(), 'SamtoolsFlagstatsQualityMetric', bam['assembly'])
+    reference_time = time.time() - start
+
+    start = time.time()
+    for i in range(20):
+        graph = files_structure_of(experiment)['graph']
+        for bam in bams:
+            graph.replicate_fastqs('technical_replicates', set(bam['technical_replicates']))
+            graph.metrics('alignments', 'SamtoolsFlagstatsQualityMetric', bam['assembly'])
+    graph_time = time.time() - start
+
+    start = time.time()
+    for check in function_dispatcher_with_files.values():
+        list(check(experiment, None, files_structure))
+    audit_time = time.time() - start
+
+    print('%d files: replicate fastq and metric scans %.3fs, indexed %.3fs; file checks %.3fs' % (
+        len(files_structure['original_files']), reference_time, graph_time, audit_time))
@@ -1,3 +1,6 @@
+import pytest
+
+
 def test_audit_item_schema_validation(testapp, organism):
     testapp.patch_json(organism['@id'] +
                        '?validate=false', {'disallowed': 'errs'})
@@ -95,3 +98,182 @@ def test_audit_item_status_level_dict_contains_all_statuses_in_schema(testapp):
             # If this assertion fails update STATUS_LEVEL dict with new statuses in schema.
             assert not schema_dict_diff, '{} in {} schema but not in STATUS_LEVEL dict.'.format(
                 schema_dict_diff, title)
+
+
+def test_audit_item_status_linked_statuses(testapp, experiment):
+    from urllib.parse import parse_qsl
+    item = {
+        'experiment': experiment['uuid'],
+        'biological_replicate_number': 1,
+        'technical_replicate_number': 1,
+        'status': 'released'
+    }
+    replicate = testapp.post_json('/replicate', item, status=201).json['@graph'][0]
+    res = testapp.get(replicate['@id'] + '@@index-data')
+    errors_list = []
+    for error_type in res.json['audit']:
+        errors_list.extend(res.json['audit'][error_type])
+    assert any(
+        error['category'] == 'mismatched status' and experiment['@id'] in error['detail']
+        for error in errors_list)
+    assert experiment['uuid'] in res.json['embedded_uuids']
+    stats = dict(parse_qsl(res.headers['X-Stats']))
+    assert int(stats['audit_embed_avoided_count']) > 0
+
+
+class FakeModel(object):
+    def __init__(self, uuid, properties):
+        self.uuid = uuid
+        self.properties = properties
+
+
+def fake_item(uuid, status):
+    from types import SimpleNamespace
+    from snovault import Item
+
+    class Lab(Item):
+        type_info = SimpleNamespace(name='Lab', schema_version=None)
+        base_types = ['Item']
+        __parent__ = None
+
+    properties = {'name': uuid} if status is None else {'name': uuid, 'status': status}
+    return Lab(None, FakeModel(uuid, properties))
+
+
+class FakeRoot(dict):
+    __parent__ = None
+    __name__ = ''
+
+
+@pytest.fixture
+def status_request():
+    from types import SimpleNamespace
+    from snovault import CONNECTION
+    labs = FakeRoot()
+    labs.__name__ = 'labs'
+    labs.__parent__ = root = FakeRoot(labs=labs)
+    for (name, status) in [('a', 'released'), ('b', 'deleted'), ('c', None)]:
+        labs[name] = fake_item(name, status)
+    embedded = []
+
+    def embed(path):
+        embedded.append(path)
+        return {'@id': path[:-len('@@object')], '@type': ['Award', 'Item'], 'status': 'current'}
+
+    connection = SimpleNamespace(embed_cache={
+        '/labs/cached/@@object': ({'@id': '/labs/cached/', '@type': ['Lab', 'Item'], 'status': 'revoked',
+                                   'uuid': 'cached', 'name': 'cached'}, set(), set()),
+    })
+    return SimpleNamespace(
+        registry={CONNECTION: connection},
+        root=root,
+        embed=embed,
+        embedded=embedded,
+        resource_path=lambda item: '/labs/%s/' % item.model.uuid,
+        _embedded_uuids=set(),
+        _stats={},
+    )
+
+
+def test_audit_item_linked_statuses_without_embeds(status_request):
+    from ..audit.item import linked_statuses
+    results = linked_statuses(status_request, ['/labs/a/', '/labs/b/', '/labs/c/', '/labs/cached/', '/awards/x/'])
+    assert results['/labs/a/'] == {'@id': '/labs/a/', '@type': ['Lab', 'Item'], 'uuid': 'a', 'status': 'released'}
+    assert results['/labs/b/']['status'] == 'deleted'
+    assert 'status' not in results['/labs/c/']
+    assert results['/labs/cached/'] == {'@id': '/labs/cached/', '@type': ['Lab', 'Item'], 'uuid': 'cached', 'status': 'revoked'}
+    # Anything traversal can't find falls back to an embed
+    assert results['/awards/x/'] == {'@id': '/awards/x/', '@type': ['Award', 'Item'], 'status': 'current'}
+    assert status_request.embedded == ['/awards/x/@@object']
+    assert status_request._embedded_uuids == {'a', 'b', 'c', 'cached'}
+    assert status_request._stats['audit_embed_avoided_count'] == 4
+
+
+def test_audit_item_linked_statuses_memo(status_request):
+    from pyramid.registry import Registry
+    from pyramid.threadlocal import manager
+    from ..audit.item import linked_statuses
+    registry = Registry()
+    registry.settings = {}
+    manager.push({'registry': registry, 'request': status_request})
+    try:
+        linked_statuses(status_request, ['/labs/a/', '/awards/x/'])
+        del status_request.root['labs']['a']
+        results = linked_statuses(status_request, ['/labs/a/', '/awards/x/'])
+    finally:
+        manager.pop()
+    assert results['/labs/a/']['status'] == 'released'
+    assert status_request.embedded == ['/awards/x/@@object']
+    assert status_request._stats['audit_embed_avoided_count'] == 1 + 2
+    # The memo belongs to the request (and its transaction)
+    assert linked_statuses(status_request, ['/awards/x/'])
+    assert len(status_request.embedded) == 2
+
+
+@pytest.fixture
+def organism_context():
+    from pyramid.registry import Registry
+    from pyramid.threadlocal import manager
+    from types import SimpleNamespace
+    from snovault.schema_utils import load_schema
+    schema = load_schema('encoded:schemas/organism.json')
+    properties = {
+        'name': 'human',
+        'scientific_name': 'Homo sapiens',
+        'taxon_id': '9606',
+        'status': 'released',
+        'schema_version': schema['properties']['schema_version']['default'],
+    }
+    context = SimpleNamespace(
+        schema=schema,
+        properties=properties,
+        uuid='7745b647-ff15-4ff3-9ced-b897d4e2983c',
+        model=SimpleNamespace(tid='2fbb3a9c-4b3d-4d8c-9d0c-2f4a3ee11a01'),
+        type_info=SimpleNamespace(name='Organism', schema_version=properties['schema_version']),
+    )
+    # The permission and requestMethod validators look at the current request
+    request = SimpleNamespace(context=context, method='GET', has_permission=lambda permission, context: True)
+    registry = Registry()
+    registry.settings = {'audit.skip_unchanged_validation': 'true'}
+    manager.push({'registry': registry, 'request': request})
+    yield context, {'context': context, 'registry': registry, 'request': request}
+    manager.pop()
+
+
+def test_audit_item_schema_validate_properties(organism_context):
+    from snovault.schema_utils import validate
+    from ..audit.item import schema_validator, validate_properties
+    context, system = organism_context
+    assert schema_validator(context) is schema_validator(context)
+    for properties in [
+        dict(context.properties),
+        dict(context.properties, taxon_id=9606),
+        dict(context.properties, status='unknown', disallowed='errs'),
+    ]:
+        properties['uuid'] = context.uuid
+        expected = validate(context.schema, properties, properties)
+        validated, errors = validate_properties(context, properties)
+        assert validated == expected[0]
+        assert [(list(e.path), e.message) for e in errors] == [(list(e.path), e.message) for e in expected[1]]
+
+
+def test_audit_item_schema_skips_unchanged(organism_context, mocker):
+    from ..audit import item
+    context, system = organism_context
+    validate_properties = mocker.spy(item, 'validate_properties')
+    value = {'@id': '/organisms/human/'}
+    assert list(item.audit_item_schema(value, system)) == []
+    assert list(item.audit_item_schema(value, system)) == []
+    assert validate_properties.call_count == 1
+    # Written since, and now invalid
+    context.model.tid = '5d5e3f0e-6f6c-4c5e-8b1e-7d3b0ad9d9a2'
+    context.properties['disallowed'] = 'errs'
+    assert [f.category for f in item.audit_item_schema(value, system)] == ['validation error']
+    assert [f.category for f in item.audit_item_schema(value, system)] == ['validation error']
+    assert validate_properties.call_count == 3
+    system['registry'].settings = {}
+    del context.properties['disallowed']
+    assert list(item.audit_item_schema(value, system)) == []
+    assert list(item.audit_item_schema(value, system)) == []
+    assert validate_properties.call_count == 5
+
@@ -8,6 +8,12 @@ from encoded.tests.features.conftest import workbook
 from encoded.batch_download import lookup_column_value
 from encoded.batch_download import restricted_files_present
 from encoded.batch_download import file_type_param_list
+from encoded.batch_download import _tsv_chunks
+from encoded.batch_download import _embedded_items
+from encoded.batch_download import peak_metadata
+from encoded.batch_download import _cart_search_results
+from encoded.batch_download import format_row
+from encoded.batch_download import format_rows
 
 
 param_list_1 = {'files.file_type': 'fastq'}
@@ -107,6 +113,27 @@ def test_batch_download_files_txt(testapp, workbook):
         assert url_frag[4] == (url_frag[6].split('.'))[0]
 
 
+def test_batch_download_metadata_tsv(testapp, workbook):
+    res = testapp.get('/metadata/type=Experiment/metadata.tsv')
+    assert res.headers['content-type'] == 'text/tsv; charset=UTF-8'
+    assert res.headers['content-disposition'] == 'attachment;filename="metadata.tsv"'
+    lines = res.body.splitlines()
+    header = lines[0].split(b'\t')
+    assert header[:3] == [b'File accession', b'File format', b'Output type']
+    assert len(lines) > 1
+    assert all(len(line.split(b'\t')) == len(header) for line in lines[1:])
+
+
+def test_batch_download_tsv_chunks(mocker):
+    mocker.patch('encoded.batch_download.TSV_CHUNK_SIZE', 10)
+    groups = [[['a', 'b']], [], [['cccccccccc', 'd'], ['e', 'f']], [['g', 'h']]]
+    chunks = list(_tsv_chunks(['x', 'y'], iter(groups)))
+    assert len(chunks) > 1
+    assert b''.join(chunks).decode('utf-8').splitlines() == [
+        'x\ty', 'a\tb', 'cccccccccc\td', 'e\tf', 'g\th',
+    ]
+
+
 def test_batch_download_restricted_files_present(testapp, workbook):
     results = testapp.get('/search/?limit=all&field=files.href&field=files.file_type&field=files&type=Experiment')
     results = results.body.decode("utf-8")
@@ -142,3 +169,279 @@ def test_file_type_param_list(test_input, expected):
 ])
 def test_restricted_files_present(test_input, expected):
     assert test_input == expected
+
+
+@pytest.fixture
+def peak_metadata_request(mocker):
+    files = {
+        'f1': {'uuid': 'f1', 'accession': 'ENCFF001AAA', 'dataset': '/experiments/ENCSR001AAA/'},
+        'f2': {'uuid': 'f2', 'accession': 'ENCFF002AAA', 'dataset': '/experiments/ENCSR001AAA/'},
+    }
+    experiments = {
+        '/experiments/ENCSR001AAA/': {
+            '@id': '/experiments/ENCSR001AAA/',
+            'accession': 'ENCSR001AAA',
+            'assay_term_name': 'ChIP-seq',
+            'target': {'label': 'CTCF'},
+            'files': [],
+            'replicates': [{'library': {'biosample': {'accession': 'ENCBS001AAA'}}}],
+        },
+    }
+
+    def search(index, body, size):
+        field, values = list(body['query']['terms'].items())[0]
+        items = files if field == 'embedded.uuid' else experiments
+        return {'hits': {'hits': [{'_source': {'embedded': items[v]}} for v in values if v in items]}}
+
+    def positions(*spans):
+        return {'hits': {'hits': [{'_source': {'start': s, 'end': e}} for s, e in spans]}}
+
+    region_search = {
+        '@graph': [{'files': [{'uuid': 'f1'}, {'uuid': 'f2'}]}],
+        'peaks': [
+            {'_id': 'f1', '_index': 'chr1', 'inner_hits': {'positions': positions((1, 10), (20, 30))}},
+            {'_id': 'f2:1', '_index': 'chr1', 'inner_hits': {'positions': positions((5, 15))}},
+        ],
+    }
+    es = mocker.Mock()
+    es.search.side_effect = search
+    request = mocker.Mock()
+    request.registry = {'elasticsearch': es}
+    request.matchdict = {'search_params': 'region=chr1:1-100&genome=GRCh38'}
+    request.embed.side_effect = lambda path, **kw: region_search
+    return request
+
+
+def test_batch_download_embedded_items_batches(peak_metadata_request):
+    memo = _embedded_items(peak_metadata_request, 'uuid', ['f1', 'f2', 'f1'], {})
+    assert sorted(memo) == ['f1', 'f2']
+    es = peak_metadata_request.registry['elasticsearch']
+    assert es.search.call_count == 1
+    _embedded_items(peak_metadata_request, 'uuid', ['f2'], memo)
+    assert es.search.call_count == 1
+
+
+def test_batch_download_peak_metadata_json(peak_metadata_request):
+    peak_metadata_request.url = 'http://localhost/peak_metadata/region=chr1/peak_metadata.json'
+    response = peak_metadata(None, peak_metadata_request)
+    doc = json.loads(b''.join(response.app_iter).decode('utf-8'))
+    # Every peak is reported, including the first of each assay
+    assert [peak['coordinates'] for peak in doc['ChIP-seq']] == ['chr1:1-10', 'chr1:20-30', 'chr1:5-15']
+    assert peak_metadata_request.embed.call_count == 1
+
+
+def test_batch_download_peak_metadata_tsv_embeds_before_returning(peak_metadata_request):
+    region_search = peak_metadata_request.embed.side_effect(None)
+    es = peak_metadata_request.registry['elasticsearch']
+    es.search.side_effect = lambda index, body, size: {'hits': {'hits': []}}
+    experiment = {
+        '@id': '/experiments/ENCSR001AAA/', 'accession': 'ENCSR001AAA', 'assay_term_name': 'DNase-seq',
+        'files': [], 'replicates': [],
+    }
+    items = {
+        'f1': {'uuid': 'f1', 'accession': 'ENCFF001AAA', 'dataset': experiment['@id']},
+        'f2': {'uuid': 'f2', 'accession': 'ENCFF002AAA', 'dataset': experiment['@id']},
+        experiment['@id']: experiment,
+    }
+
+    def embed(path, **kw):
+        return region_search if path.startswith('/region-search/') else items[path]
+
+    peak_metadata_request.embed.side_effect = embed
+    peak_metadata_request.url = 'http://localhost/peak_metadata/region=chr1/peak_metadata.tsv'
+    response = peak_metadata(None, peak_metadata_request)
+    # Nothing es didn't have is left to embed once the transaction has ended
+    assert peak_metadata_request.embed.call_count == 4
+    peak_metadata_request.embed.side_effect = AssertionError('embed after the view returned')
+    lines = b''.join(response.app_iter).decode('utf-8').splitlines()
+    assert len(lines) == 4
+    assert lines[1].split('\t')[:2] == ['DNase-seq', 'chr1:1-10']
+
+
+def test_batch_download_cart_search_results_in_order(mocker):
+    import threading
+    from urllib.parse import parse_qs
+    mocker.patch('encoded.batch_download.ELEMENT_CHUNK_SIZE', 2)
+    elements = ['/experiments/ENCSR%03dAAA/' % i for i in range(9)]
+    searched = []
+    read_on = set()
+
+    def search(context, request, return_generator=False):
+        assert return_generator
+        params = parse_qs(request.query_string)
+        searched.append((params['@id'], params['field'], threading.current_thread()))
+
+        def hits():
+            read_on.add(threading.current_thread())
+            for i in params['@id']:
+                yield {'@id': i}
+        return hits()
+
+    mocker.patch('encoded.batch_download.search', side_effect=search)
+    request = mocker.Mock(query_string='')
+    results = _cart_search_results(None, request, {'field': ['files.href']}, elements)
+    # Nothing is searched until the response is read
+    assert searched == []
+    assert [result['@id'] for result in results] == elements
+    assert [ids for (ids, _, _) in searched] == [elements[i:i + 2] for i in range(0, 9, 2)]
+    assert all(fields == ['files.href'] for (_, fields, _) in searched)
+    # Searches start on the thread reading the response; hits are read on the pool
+    assert {thread for (_, _, thread) in searched} == {threading.current_thread()}
+    assert threading.current_thread() not in read_on
+    assert not request.embed.called
+
+
+def reference_lookup_column_value(value, path):
+    # lookup_column_value before columns were compiled
+    nodes = [value]
+    names = path.split('.')
+    for name in names:
+        nextnodes = []
+        for node in nodes:
+            if name not in node:
+                continue
+            value = node[name]
+            if isinstance(value, list):
+                nextnodes.extend(value)
+            else:
+                nextnodes.append(value)
+        nodes = nextnodes
+        if not nodes:
+            return ''
+    if nodes and hasattr(nodes[0], '__contains__') and '@id' in nodes[0]:
+        nodes = [node['@id'] for node in nodes]
+    deduped_nodes = []
+    for n in nodes:
+        if isinstance(n, dict):
+            n = str(n)
+        if n not in deduped_nodes:
+            deduped_nodes.append(n)
+    return u','.join(u'{}'.format(n) for n in deduped_nodes)
+
+
+def report_item(i):
+    biosample = {
+        'accession': 'ENCBS%06d' % i,
+        'organism': {'scientific_name': 'Homo sapiens', 'name': 'human'},
+        'life_stage': 'adult',
+        'age': '53',
+        'age_units': 'year',
+        'treatments': [
+            {'treatment_term_name': 'estradiol', 'treatment_term_id': 'CHEBI:23965',
+             'concentration': 100, 'concentration_units': 'nM', 'duration': 1, 'duration_units': 'hour'},
+        ],
+    }
+    return {
+        '@id': '/experiments/ENCSR%06d/' % i,
+        'accession': 'ENCSR%06d' % i,
+        'assay_term_name': 'ChIP-seq',
+        'assay_title': 'TF ChIP-seq',
+        'target': {'label': 'CTCF', 'genes': [{'symbol': 'CTCF'}]},
+        'biosample_summary': 'Homo sapiens K562',
+        'biosample_ontology': {'term_name': 'K562'},
+        'description': 'CTCF ChIP-seq\ton K562\n',
+        'status': 'released',
+        'lab': {'@id': '/labs/lab-%d/' % (i % 7), 'title': 'Lab %d' % (i % 7)},
+        'award': {'project': 'ENCODE'},
+        'assembly': ['GRCh38', 'hg19', 'GRCh38'],
+        'replicates': [
+            {
+                '@id': '/replicates/%d-%d/' % (i, r),
+                'biological_replicate_number': r,
+                'technical_replicate_number': 1,
+                'antibody': {'accession': 'ENCAB000AAA'},
+                'library': {'biosample': biosample},
+            }
+            for r in range(1, 3)
+        ],
+        'files': [{'@id': '/files/ENCFF%06d%d/' % (i, f)} for f in range(4)],
+        'empty': None,
+        'matrix': [[1, 2], [1, 2], [3]],
+        'audit': {'ERROR': [{'category': 'missing', 'detail': 'a\tb\n'}]},
+    }
+
+
+# Columns of the Experiment report
+experiment_report_paths = [
+    'accession', 'assay_term_name', 'assay_title', 'target.label', 'target.genes.symbol',
+    'biosample_summary', 'biosample_ontology.term_name', 'description', 'lab.title',
+    'award.project', 'status', 'files.@id', 'replicates.library.biosample.accession',
+    'replicates.biological_replicate_number', 'replicates.technical_replicate_number',
+    'replicates.antibody.accession', 'replicates.library.biosample.organism.scientific_name',
+    'replicates.library.biosample.life_stage', 'replicates.library.biosample.age',
+    'replicates.library.biosample.age_units',
+    'replicates.library.biosample.treatments.treatment_term_name',
+    'replicates.library.biosample.treatments.treatment_term_id',
+    'replicates.library.biosample.treatments.concentration',
+    'replicates.library.biosample.treatments.concentration_units',
+    'replicates.library.biosample.treatments.duration',
+    'replicates.library.biosample.treatments.duration_units',
+    'replicates.library.biosample.synchronization',
+    'replicates.library.biosample.post_synchronization_time',
+    'replicates.library.biosample.post_synchronization_time_units', 'replicates.@id',
+]
+
+
+report_paths = experiment_report_paths + [
+    '@id', 'lab', 'assembly', 'replicates', 'replicates.library.biosample.organism',
+    'files', 'files.href', 'missing', 'missing.deeper', 'empty', 'matrix', 'audit.ERROR',
+    'audit.ERROR.detail', 'lab.title.x',
+]
+
+
+@pytest.mark.parametrize('path', report_paths)
+def test_batch_download_lookup_column_value_matches_reference(path):
+    for i in range(3):
+        item = report_item(i)
+        assert lookup_column_value(item, path) == reference_lookup_column_value(item, path)
+
+
+def test_batch_download_format_rows():
+    rows = [['a\tb ', ' c\r\nd'], [u'\u00e9', '']]
+    assert format_rows(rows) == b''.join(format_row(row) for row in rows)
+    assert format_rows(rows) == u'a b\tc d\r\n\u00e9\t\r\n'.encode('utf-8')
+
+
+def reference_report_rows(items, paths):
+    # report rows before columns were compiled
+    from pyramid.compat import bytes_
+
+    def reference_format_row(columns):
+        return b'\t'.join([bytes_(" ".join(c.strip('\t\n\r').split()), 'utf-8') for c in columns]) + b'\r\n'
+
+    return b''.join(
+        reference_format_row([reference_lookup_column_value(item, path) for path in paths])
+        for item in items
+    )
+
+
+def compiled_report_rows(items, paths):
+    from encoded.batch_download import column_extractor
+    extractors = [column_extractor(path) for path in paths]
+    chunks = []
+    for i in range(0, len(items), 500):
+        chunks.append(format_rows([[extract(item) for extract in extractors] for item in items[i:i + 500]]))
+    return b''.join(chunks)
+
+
+def test_batch_download_report_rows_match_reference():
+    items = [report_item(i) for i in range(1200)]
+    reference = reference_report_rows(items, experiment_report_paths)
+    assert compiled_report_rows(items, experiment_report_paths) == reference
+
+
+@pytest.mark.slow
+def test_batch_download_report_rows_benchmark():
+    # Reports timings only; a timing assert would fail at random on a loaded machine
+    import time
+    items = [report_item(i) for i in range(100000)]
+
+    start = time.time()
+    reference_report_rows(items, experiment_report_paths)
+    reference_time = time.time() - start
+
+    start = time.time()
+    compiled_report_rows(items, experiment_report_paths)
+    compiled_time = time.time() - start
+
+    print('100k Experiment report rows: lookup_column_value %.2fs, compiled %.2fs' % (reference_time, compiled_time))
@@ -0,0 +1,121 @@
+import json
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+ENSEMBL_RESPONSES = {
+    '/variation/homo_sapiens/rs1?content-type=application/json': {
+        'mappings': [
+            {'location': 'HG1_PATCH:100-100', 'assembly_name': 'GRCh38'},
+            {'location': '1:1000-1000', 'assembly_name': 'GRCh38'},
+        ]
+    },
+    '/map/homo_sapiens/GRCh38/1:1000-1000/GRCh37/?content-type=application/json': {
+        'mappings': [{'mapped': {'seq_region_name': '1', 'start': 900, 'end': 900}}]
+    },
+    '/lookup/id/ENSG00000001?content-type=application/json': {
+        'assembly_name': 'GRCh38', 'seq_region_name': '2', 'start': 10, 'end': 20
+    },
+}
+
+
+@pytest.fixture
+def ensembl_stub():
+    '''A local stand-in for the Ensembl REST API, recording the paths asked for.'''
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            body = ENSEMBL_RESPONSES.get(self.path, {'error': 'not found'})
+            self.send_response(200 if self.path in ENSEMBL_RESPONSES else 400)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(body).encode('utf-8'))
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d/' % server.server_port, requested
+    server.shutdown()
+    server.server_close()
+
+
+def test_coordinate_cache_lru():
+    from encoded.coordinate_cache import CoordinateCache
+    cache = CoordinateCache(capacity=2)
+    cache.set('a', ['chr1', 1, 2])
+    cache.set('b', ['chr1', 3, 4])
+    assert cache.get('a') == ['chr1', 1, 2]
+    cache.set('c', ['chr1', 5, 6])
+    assert cache.get('b') is None
+    assert cache.get('a') == ['chr1', 1, 2]
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_coordinate_cache_ttl():
+    from encoded.coordinate_cache import CoordinateCache
+    cache = CoordinateCache(ttl=-1)
+    cache.set('a', ['chr1', 1, 2])
+    assert cache.get('a') is None
+
+
+def test_coordinate_cache_on_disk(tmpdir):
+    from encoded.coordinate_cache import CoordinateCache
+    path = str(tmpdir.join('coordinates.sqlite'))
+    CoordinateCache(path).set('a', ['chr1', 1, 2])
+    assert CoordinateCache(path).get('a') == ['chr1', 1, 2]
+
+
+def test_coordinate_cache_lookup_skips_empty():
+    from encoded.coordinate_cache import CoordinateCache
+    cache = CoordinateCache()
+    assert cache.lookup('a', lambda: ('', '', '')) == ('', '', '')
+    assert cache.get('a') is None
+    assert cache.lookup('b', lambda: ('chr1', 1, 2)) == ('chr1', 1, 2)
+    assert cache.lookup('b', lambda: pytest.fail('resolved twice')) == ('chr1', 1, 2)
+
+
+def test_resolver_rsid_liftover_cached(ensembl_stub):
+    from encoded.coordinate_cache import CoordinateCache
+    from encoded.region_search import CoordinateResolver
+    (url, requested) = ensembl_stub
+    resolver = CoordinateResolver(CoordinateCache(), url)
+    assert tuple(resolver.rsid('rs1', 'GRCh38')) == ('chr1', '1000', '1000')
+    assert tuple(resolver.rsid('rs1', 'GRCh37')) == ('chr1', 900, 900)
+    assert tuple(resolver.rsid('rs1', 'GRCh37')) == ('chr1', 900, 900)
+    assert tuple(resolver.rsid('rs1', 'GRCh38')) == ('chr1', '1000', '1000')
+    assert len(requested) == 3
+
+
+def test_resolver_ensemblid(ensembl_stub):
+    from encoded.coordinate_cache import CoordinateCache
+    from encoded.region_search import CoordinateResolver
+    (url, requested) = ensembl_stub
+    resolver = CoordinateResolver(CoordinateCache(), url)
+    assert tuple(resolver.ensemblid('ENSG00000001', 'GRCh38')) == ('chr2', '10', '20')
+    assert tuple(resolver.ensemblid('ensg00000001', 'GRCh38')) == ('chr2', '10', '20')
+    assert len(requested) == 1
+
+
+def test_resolver_seed_annotations(ensembl_stub):
+    from encoded.coordinate_cache import CoordinateCache
+    from encoded.region_search import CoordinateResolver
+    (url, requested) = ensembl_stub
+    resolver = CoordinateResolver(CoordinateCache(), url)
+    annotations = [
+        {'index': {'_index': 'annotations', '_type': 'default', '_id': 'ENSMUSG00000002'}},
+        {'id': 'ENSMUSG00000002', 'annotations': [
+            {'assembly_name': 'GRCm38', 'chromosome': '7', 'start': 5, 'end': 50},
+            {'assembly_name': 'GRCm37', 'chromosome': '', 'start': '', 'end': ''},
+        ]},
+    ]
+    assert resolver.seed_annotations(annotations) == 2
+    assert tuple(resolver.ensemblid('ENSMUSG00000002', 'GRCm38')) == ('chr7', 5, 50)
+    assert tuple(resolver.annotation(None, 'ENSMUSG00000002', 'GRCm38')) == ('chr7', 5, 50)
+    assert requested == []
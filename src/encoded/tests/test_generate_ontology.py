@@ -0,0 +1,160 @@
+import pytest
+
+
+def reference_iterative_children(nodes, terms, data):
+    # generate_ontology.iterativeChildren before closures were computed in one pass
+    results = []
+    while 1:
+        newNodes = []
+        if len(nodes) == 0:
+            break
+        for node in nodes:
+            results.append(node)
+            if terms[node][data]:
+                for child in terms[node][data]:
+                    if child not in results:
+                        newNodes.append(child)
+        nodes = list(set(newNodes))
+    return list(set(results))
+
+
+def reference_slims(terms, term, slimType):
+    # generate_ontology.getSlims, with the closures it was given
+    from encoded.commands.generate_ontology import getSlimTerms, slim_shims
+    data = 'data_with_develops_from' if slimType == 'developmental' else 'data'
+    closure = reference_iterative_children(terms[term][data], terms, data) + [term]
+    slimTerms = getSlimTerms(slimType)
+    slims = [slimTerms[slimTerm] for slimTerm in slimTerms if slimTerm in closure]
+    shim = slim_shims.get(slimType, {}).get(term, '')
+    if shim:
+        slims = list(shim)
+    return slims
+
+
+def ontology_term(data=(), develops_from=()):
+    return {
+        'data': list(data),
+        'data_with_develops_from': list(data) + list(develops_from),
+    }
+
+
+def slim_ontology():
+    return {
+        # heart is part of the circulatory system, and develops from mesoderm
+        'UBERON:0000948': ontology_term(['UBERON:0000479', 'UBERON:0001009'], ['UBERON:0000926']),
+        'UBERON:0000479': ontology_term(),
+        'UBERON:0001009': ontology_term(['UBERON:0000467']),
+        'UBERON:0000467': ontology_term(),
+        'UBERON:0000926': ontology_term(),
+        # a cycle through brain
+        'TEST:0000001': ontology_term(['TEST:0000002']),
+        'TEST:0000002': ontology_term(['TEST:0000001', 'UBERON:0000955']),
+        'UBERON:0000955': ontology_term(['TEST:0000002']),
+        'TEST:0000003': ontology_term(['TEST:0000003']),
+        # assays and objectives, DNase-seq is shimmed
+        'OBI:0000716': ontology_term(['OBI:0000218']),
+        'OBI:0000218': ontology_term(),
+        'OBI:0001853': ontology_term(['OBI:0000716']),
+    }
+
+
+def test_generate_ontology_strongly_connected_order():
+    from encoded.commands.generate_ontology import stronglyConnected
+    edges = {'a': ['b'], 'b': ['c', 'a'], 'c': ['d'], 'd': [], 'e': ['d', 'a']}
+    components = list(stronglyConnected(edges, edges.__getitem__))
+    assert sorted(sorted(component) for component in components) == [['a', 'b'], ['c'], ['d'], ['e']]
+    position = {node: i for (i, component) in enumerate(components) for node in component}
+    for (node, children) in edges.items():
+        for child in children:
+            assert position[child] <= position[node]
+
+
+def test_generate_ontology_slims_match_reference():
+    from encoded.commands.generate_ontology import SLIM_TYPES, assignSlims
+    terms = slim_ontology()
+    assignSlims(terms)
+    reference = slim_ontology()
+    for term in terms:
+        for (field, slimType) in SLIM_TYPES:
+            assert terms[term][field] == reference_slims(reference, term, slimType), (term, field)
+    assert terms['UBERON:0000948']['developmental'] == ['mesoderm']
+    assert terms['UBERON:0000948']['developmental'] != terms['UBERON:0000948']['organs']
+    assert 'brain' in terms['TEST:0000001']['organs']
+    assert terms['OBI:0001853']['assay'] == ['DNA accessibility']
+
+
+def test_generate_ontology_slims_missing_term_is_a_leaf():
+    from encoded.commands.generate_ontology import assignSlims
+    terms = {'TEST:0000001': ontology_term(['UBERON:0000955', 'TEST:9999999'])}
+    assignSlims(terms)
+    assert terms['TEST:0000001']['organs'] == ['brain']
+
+
+def test_generate_ontology_merge_terms():
+    from encoded.commands.generate_ontology import getTermStructure, mergeTerms
+    first = getTermStructure()
+    first.update({'id': 'UBERON:0000948', 'name': 'heart', 'part_of': ['UBERON:0000467']})
+    # Only a blank node mentions heart in the second ontology
+    second = getTermStructure()
+    second['part_of'] = ['UBERON:0001009']
+    # The third one defines it again
+    third = getTermStructure()
+    third.update({'id': 'UBERON:0000948', 'name': 'Heart', 'parents': ['UBERON:0000062']})
+    terms = {}
+    for more in [{'UBERON:0000948': first}, {'UBERON:0000948': second, 'EFO:0002067': getTermStructure()},
+                 {'UBERON:0000948': third}]:
+        mergeTerms(terms, more)
+    assert list(terms) == ['UBERON:0000948', 'EFO:0002067']
+    heart = terms['UBERON:0000948']
+    assert heart['name'] == 'Heart'
+    assert heart['part_of'] == ['UBERON:0000467', 'UBERON:0001009']
+    assert heart['parents'] == ['UBERON:0000062']
+
+
+def synthetic_ontology(size, seed=0):
+    # A wide DAG under a few hundred roots, with slim terms and a few cycles
+    import random
+    from encoded.commands.generate_ontology import SLIM_TYPES, getSlimTerms
+    rng = random.Random(seed)
+    slim_ids = sorted({slimTerm for (_, slimType) in SLIM_TYPES for slimTerm in getSlimTerms(slimType)})
+    ids = slim_ids + ['TEST:%07d' % i for i in range(size - len(slim_ids))]
+    terms = {}
+    for (i, term) in enumerate(ids):
+        parents = [ids[rng.randrange(i)] for _ in range(rng.randint(1, 3))] if i > 300 else []
+        if i > 300 and rng.random() < 0.001:
+            parents.append(ids[i + 1] if i + 1 < len(ids) else ids[0])
+        develops_from = [ids[rng.randrange(i)]] if i > 300 and rng.random() < 0.1 else []
+        terms[term] = ontology_term(parents, develops_from)
+    return terms
+
+
+def test_generate_ontology_slims_match_reference_synthetic():
+    from encoded.commands.generate_ontology import SLIM_TYPES, assignSlims
+    terms = synthetic_ontology(3000)
+    sample = list(terms)[-200:]
+    expected = {term: [reference_slims(terms, term, slimType) for (_, slimType) in SLIM_TYPES] for term in sample}
+    assignSlims(terms)
+    for term in sample:
+        assert [terms[term][field] for (field, _) in SLIM_TYPES] == expected[term], term
+
+
+@pytest.mark.slow
+def test_generate_ontology_slims_benchmark():
+    # Reports timings only; a timing assert would fail at random on a loaded machine
+    import time
+    from encoded.commands.generate_ontology import SLIM_TYPES, assignSlims
+    terms = synthetic_ontology(200000)
+    sample = list(terms)[-200:]
+
+    start = time.time()
+    for term in sample:
+        for (_, slimType) in SLIM_TYPES:
+            reference_slims(terms, term, slimType)
+    reference_time = (time.time() - start) * len(terms) / len(sample)
+
+    start = time.time()
+    assignSlims(terms)
+    one_pass_time = time.time() - start
+
+    print('%d terms: per-term closures ~%.0fs (extrapolated), one pass %.2fs' %
+          (len(terms), reference_time, one_pass_time))
@@ -0,0 +1,99 @@
+import pytest
+
+
+TRACKDB = 'track ENCSR000AAA\ncompositeTrack on\nshortLabel ChIP-seq\n'
+
+
+@pytest.fixture
+def hub_request(mocker):
+    from pyramid.registry import Registry
+    from pyramid.request import Request
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    from encoded.hub_cache import HubCache
+    from encoded.visualization import HUB_CACHE
+    cache = HubCache(1024)
+    mocker.patch.object(Request, 'effective_principals', new_callable=mocker.PropertyMock,
+                        return_value=['system.Everyone'])
+
+    def make(headers=None, xmin=100):
+        request = Request.blank('/batch_hub/type=Experiment/hg19/trackDb.txt', headers=headers or {})
+        es = mocker.Mock()
+        es.get.return_value = {'_source': {'status': 'done', 'xmin': xmin}}
+        request.registry = Registry()
+        request.registry.settings = {'snovault.elasticsearch.index': 'snovault'}
+        request.registry.update({ELASTIC_SEARCH: es, HUB_CACHE: cache})
+        return request
+    return make
+
+
+def test_hub_cache_evicts_least_recently_used():
+    from encoded.hub_cache import HubCache, hub_text
+    cache = HubCache(max_bytes=10)
+    cache.set('a', hub_text('aaaa', 'text/plain'))
+    cache.set('b', hub_text('bbbb', 'text/plain'))
+    assert cache.get('a').body == b'aaaa'
+    cache.set('c', hub_text('cccc', 'text/plain'))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.size == 8
+    # Too big to keep at all
+    cache.set('d', hub_text('d' * 11, 'text/plain'))
+    assert cache.get('d') is None
+
+
+def test_hub_cache_generates_once_per_xmin(hub_request, mocker):
+    from encoded.visualization import cached_hub_text
+    generate = mocker.Mock(return_value=(TRACKDB, 'text/plain'))
+    first = cached_hub_text(hub_request(), ('batch_hub', 'x'), generate)
+    second = cached_hub_text(hub_request(), ('batch_hub', 'x'), generate)
+    assert generate.call_count == 1
+    assert first == second
+    cached_hub_text(hub_request(xmin=101), ('batch_hub', 'x'), generate)
+    assert generate.call_count == 2
+
+
+def test_hub_cache_not_used_without_vis_indexer(hub_request, mocker):
+    from encoded.visualization import cached_hub_text
+    generate = mocker.Mock(return_value=(TRACKDB, 'text/plain'))
+    cached_hub_text(hub_request(xmin=None), ('batch_hub', 'x'), generate)
+    cached_hub_text(hub_request(xmin=None), ('batch_hub', 'x'), generate)
+    assert generate.call_count == 2
+
+
+def test_hub_text_range_sliced_from_cached_bytes(hub_request):
+    from encoded.hub_cache import hub_text
+    from encoded.visualization import respond_with_hub_text
+    entry = hub_text(TRACKDB, 'text/plain')
+    request = hub_request({'Range': 'bytes=6-16'})
+    response = request.get_response(respond_with_hub_text(request, entry))
+    assert response.status_code == 206
+    assert response.body == TRACKDB.encode('utf-8')[6:17]
+    assert response.headers['Content-Range'] == 'bytes 6-16/%d' % len(TRACKDB)
+    assert response.headers['ETag'] == '"%s"' % entry.etag
+
+    request = hub_request({'Range': 'bytes=6-'})
+    response = request.get_response(respond_with_hub_text(request, entry))
+    assert response.body == TRACKDB.encode('utf-8')[6:]
+
+
+def test_hub_text_if_range_mismatch_sends_everything(hub_request):
+    from encoded.hub_cache import hub_text
+    from encoded.visualization import respond_with_hub_text
+    entry = hub_text(TRACKDB, 'text/plain')
+    request = hub_request({'Range': 'bytes=0-4', 'If-Range': '"%s"' % entry.etag})
+    response = request.get_response(respond_with_hub_text(request, entry))
+    assert response.status_code == 206
+    request = hub_request({'Range': 'bytes=0-4', 'If-Range': '"stale"'})
+    response = request.get_response(respond_with_hub_text(request, entry))
+    assert response.status_code == 200
+    assert response.body == TRACKDB.encode('utf-8')
+
+
+def test_hub_text_if_none_match(hub_request):
+    from pyramid.httpexceptions import HTTPNotModified
+    from encoded.hub_cache import hub_text
+    from encoded.visualization import respond_with_hub_text
+    entry = hub_text(TRACKDB, 'text/plain')
+    request = hub_request({'If-None-Match': '"%s"' % entry.etag})
+    with pytest.raises(HTTPNotModified):
+        respond_with_hub_text(request, entry)
@@ -0,0 +1,161 @@
+import json
+import threading
+import pytest
+
+
+class FakeResponse(object):
+    def __init__(self, status_int, url):
+        self.status_int = status_int
+        self.status = '%d' % status_int
+        self.location = url
+        self.json = {'detail': '', 'errors': []}
+
+
+class RecordingApp(object):
+    '''Stands in for a TestApp, recording the requests loadxl makes.'''
+
+    def __init__(self, delay=0):
+        self.requests = []
+        self.lock = threading.Lock()
+        self.delay = delay
+        self.concurrent = 0
+        self.max_concurrent = 0
+
+    def request(self, method, url, value):
+        import time
+        with self.lock:
+            self.concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        time.sleep(self.delay)
+        with self.lock:
+            self.concurrent -= 1
+            self.requests.append((method, url, value))
+        return FakeResponse(201 if method == 'POST' else 200, url)
+
+    def post_json(self, url, value, status=None):
+        return self.request('POST', url, value)
+
+    def put_json(self, url, value, status=None):
+        return self.request('PUT', url, value)
+
+
+@pytest.fixture
+def workbook_dir(tmpdir):
+    labs = [{'uuid': 'lab-%d' % i, 'name': 'lab-%d' % i, 'title': 'Lab %d' % i} for i in range(20)]
+    biosamples = [
+        {'uuid': 'biosample-%d' % i, 'accession': 'ENCBS%03dAAA' % i, 'lab': 'lab-%d' % i,
+         'derived_from': ['ENCBS%03dAAA' % (i - 1)] if i else []}
+        for i in range(20)
+    ]
+    tmpdir.join('lab.json').write(json.dumps(labs))
+    tmpdir.join('biosample.json').write(json.dumps(biosamples))
+    return str(tmpdir)
+
+
+def test_loadxl_load_all_phases(workbook_dir):
+    from encoded.loadxl import load_all
+    app = RecordingApp()
+    stats = load_all(app, workbook_dir, [])
+    posts = [(url, value) for (method, url, value) in app.requests if method == 'POST']
+    puts = [(url, value) for (method, url, value) in app.requests if method == 'PUT']
+    assert [url for (url, value) in posts] == ['/lab'] * 20 + ['/biosample'] * 20
+    assert all('derived_from' not in value for (url, value) in posts)
+    # Only biosamples derived from another one need a second pass
+    assert [url for (url, value) in puts] == ['/biosample-%d' % i for i in range(1, 20)]
+    assert puts[0][1]['derived_from'] == ['ENCBS000AAA']
+    assert stats['lab']['loaded'] == 20
+    assert stats['biosample']['loaded'] == 20 + 19
+    assert stats['biosample']['errors'] == 0
+
+
+def test_loadxl_load_all_reads_sheets_once(workbook_dir, mocker):
+    from encoded import loadxl
+    read_single_sheet = mocker.patch.object(loadxl, 'read_single_sheet', wraps=loadxl.read_single_sheet)
+    loadxl.load_all(RecordingApp(), workbook_dir, [])
+    assert read_single_sheet.call_count == len(loadxl.ORDER)
+
+
+def test_loadxl_load_all_workers(workbook_dir):
+    from encoded.loadxl import load_all
+    serial = RecordingApp()
+    load_all(serial, workbook_dir, [])
+    concurrent = RecordingApp(delay=0.005)
+    stats = load_all(concurrent, workbook_dir, [], workers=4)
+    assert concurrent.max_concurrent > 1
+    assert sorted(concurrent.requests, key=repr) == sorted(serial.requests, key=repr)
+    # Every type (and phase) is finished before the next one starts
+    methods_and_types = [(method, url.split('-')[0]) for (method, url, value) in concurrent.requests]
+    runs = [key for (i, key) in enumerate(methods_and_types) if i == 0 or methods_and_types[i - 1] != key]
+    assert runs == [('POST', '/lab'), ('POST', '/biosample'), ('PUT', '/biosample')]
+    assert stats['biosample']['loaded'] == 39
+
+
+def test_loadxl_make_request_keeps_row_order():
+    from encoded.loadxl import make_request
+    app = RecordingApp(delay=0.001)
+    rows = [{'_url': '/lab', 'name': 'lab-%d' % i} for i in range(30)]
+    rows[3]['_skip'] = True
+    done = list(make_request(app, 'lab', 'POST', workers=3)(iter(rows)))
+    assert [row['name'] for row in done] == ['lab-%d' % i for i in range(30) if i != 3]
+    assert all(row['_response'].status_int == 201 for row in done)
+
+
+class LinkCheckingApp(RecordingApp):
+    '''A RecordingApp that fails posts linking to a row of the type not created yet.'''
+
+    # Same-type links in the inserts, by item type
+    links = {
+        'page': ['parent'],
+        'file': ['paired_with', 'derived_from', 'controlled_by', 'supersedes'],
+    }
+
+    def __init__(self, inserts, delay=0):
+        from encoded.loadxl import row_keys
+        super(LinkCheckingApp, self).__init__(delay)
+        self.keys = {}
+        for (item_type, rows) in inserts.items():
+            for row in rows:
+                for key in row_keys(row):
+                    self.keys[(item_type, key)] = self.identity(row)
+        self.created = set()
+        self.unresolved = []
+
+    @staticmethod
+    def identity(row):
+        return row.get('uuid') or row.get('accession') or row['name']
+
+    def request(self, method, url, value):
+        from encoded.loadxl import value_links
+        item_type = url.strip('/')
+        if method == 'POST':
+            missing = {
+                self.keys[(item_type, link)]
+                for name in self.links[item_type] for link in value_links(value.get(name, []))
+                if (item_type, link) in self.keys and self.keys[(item_type, link)] != self.identity(value)
+            } - self.created
+            if missing:
+                self.unresolved.append((self.identity(value), sorted(missing)))
+                return FakeResponse(422, url)
+        response = super(LinkCheckingApp, self).request(method, url, value)
+        if method == 'POST':
+            with self.lock:
+                self.created.add(self.identity(value))
+        return response
+
+
+def test_loadxl_load_all_workers_waits_for_same_type_links(tmpdir):
+    from pkg_resources import resource_filename
+    from encoded.loadxl import load_all
+    inserts = {}
+    for item_type in ['page', 'file']:
+        with open(resource_filename('encoded', 'tests/data/inserts/%s.json' % item_type)) as f:
+            inserts[item_type] = json.load(f)
+        tmpdir.join('%s.json' % item_type).write(json.dumps(inserts[item_type]))
+    assert any(row.get('parent') for row in inserts['page'])
+    assert any(row.get('paired_with') for row in inserts['file'])
+    app = LinkCheckingApp(inserts, delay=0.002)
+    stats = load_all(app, str(tmpdir), [], workers=8)
+    assert app.unresolved == []
+    assert app.max_concurrent > 1
+    assert stats['page']['errors'] == 0
+    assert stats['file']['errors'] == 0
@@ -0,0 +1,152 @@
+import pytest
+
+
+def embed_request(registry):
+    from functools import partial
+    from types import SimpleNamespace
+    from snovault.embed import embed
+    request = SimpleNamespace(
+        registry=registry, _embedded_uuids=set(), _linked_uuids=set(), _stats={})
+    request.embed = partial(embed, request)
+    return request
+
+
+@pytest.fixture
+def frames_request(mocker):
+    '''A request whose embeds are counted, inside a transaction's threadlocals.'''
+    from pyramid.registry import Registry
+    from pyramid.threadlocal import manager
+    from types import SimpleNamespace
+    from snovault import CONNECTION
+    from snovault.cache import ManagerLRUCache
+    import snovault.embed
+    from encoded.object_cache import includeme
+    embedded = []
+
+    def _embed(request, path):
+        embedded.append(path)
+        item_path = path.split('@@')[0]
+        uuid = item_path.strip('/').split('/')[-1]
+        result = {'@id': item_path, 'uuid': uuid, 'status': 'released'}
+        if 'skip_calculated' not in path:
+            result['summary'] = 'calculated'
+        return result, {uuid}, {uuid, 'linked-from-' + uuid}
+
+    mocker.patch.object(snovault.embed, '_embed', side_effect=_embed)
+    registry = Registry()
+    registry.settings = {}
+    registry[CONNECTION] = SimpleNamespace(embed_cache=ManagerLRUCache('test.embed_cache', 100))
+    includeme(SimpleNamespace(registry=registry))
+    request = embed_request(registry)
+    request.embedded = embedded
+    manager.push({'registry': registry, 'request': request})
+    yield request
+    manager.pop()
+
+
+def test_object_cache_counts_frames(frames_request):
+    from snovault import CONNECTION
+    from encoded.object_cache import FrameCountingCache
+    embed_cache = frames_request.registry[CONNECTION].embed_cache
+    assert isinstance(embed_cache, FrameCountingCache)
+    assert (embed_cache.name, embed_cache.default_capacity) == ('test.embed_cache', 100)
+    donor = frames_request.embed('/human-donors/ENCDO000AAA/', '@@object')
+    assert frames_request.embed('/human-donors/ENCDO000AAA/', '@@object') == donor
+    frames_request.embed('/human-donors/ENCDO000AAA/', '@@object?skip_calculated=true')
+    frames_request.embed('/human-donors/ENCDO000AAA/', '@@embedded')
+    assert frames_request.embedded == [
+        '/human-donors/ENCDO000AAA/@@object',
+        '/human-donors/ENCDO000AAA/@@object?skip_calculated=true',
+        '/human-donors/ENCDO000AAA/@@embedded',
+    ]
+    assert frames_request._stats == {'object_cache_miss_count': 2, 'object_cache_hit_count': 1}
+
+
+def test_object_cache_counts_towards_root_request(frames_request):
+    frames_request.embed('/organisms/human/', '@@object')
+    # Another item rendering in the same transaction
+    other = embed_request(frames_request.registry)
+    other.embed('/organisms/human/', '@@object')
+    assert other._embedded_uuids == {'human'}
+    assert other._stats == {}
+    assert frames_request._stats == {'object_cache_miss_count': 1, 'object_cache_hit_count': 1}
+
+
+def test_object_cache_outside_transaction(frames_request):
+    from pyramid.threadlocal import manager
+    threadlocals = manager.pop()
+    try:
+        frames_request.embed('/organisms/human/', '@@object')
+        frames_request.embed('/organisms/human/', '@@object')
+    finally:
+        manager.push(threadlocals)
+    assert len(frames_request.embedded) == 2
+
+
+class FakeModel(object):
+    def __init__(self, uuid, properties):
+        self.uuid = uuid
+        self.properties = properties
+
+
+class FakeContainer(dict):
+    __parent__ = None
+    __name__ = ''
+
+
+@pytest.fixture
+def files_request(frames_request):
+    '''frames_request, with files to traverse to.'''
+    from types import SimpleNamespace
+    from snovault import CONNECTION, Item
+
+    class File(Item):
+        type_info = SimpleNamespace(name='File', schema_version=None)
+        base_types = ['Item']
+        __parent__ = None
+
+    files = FakeContainer()
+    files.__name__ = 'files'
+    files.__parent__ = root = FakeContainer(files=files)
+    by_uuid = {}
+    for (name, status, assembly, derived_from) in [
+        ('fastq', 'released', None, []),
+        ('bam', 'released', 'GRCh38', ['uuid-fastq']),
+        ('bed', 'revoked', 'GRCh38', ['uuid-bam', 'uuid-missing']),
+        ('other', 'deleted', 'hg19', []),
+    ]:
+        properties = {'status': status, 'derived_from': derived_from}
+        if assembly is not None:
+            properties['assembly'] = assembly
+        files[name] = by_uuid['uuid-' + name] = File(None, FakeModel('uuid-' + name, properties))
+    frames_request.registry[CONNECTION] = SimpleNamespace(
+        embed_cache={}, get_by_uuid=by_uuid.get)
+    frames_request.root = root
+    frames_request.resource_path = lambda item: '/files/%s/' % item.model.uuid[len('uuid-'):]
+    return frames_request
+
+
+def test_object_cache_item_properties(files_request):
+    from encoded import object_cache
+    paths = ['/files/bed/', '/files/bam/', '/files/nothing/']
+    properties = object_cache.item_properties(files_request, paths)
+    assert properties == {
+        '/files/bed/': {'uuid': 'uuid-bed', 'status': 'revoked', 'assembly': 'GRCh38',
+                        'derived_from': ['/files/bam/']},
+        '/files/bam/': {'uuid': 'uuid-bam', 'status': 'released', 'assembly': 'GRCh38',
+                        'derived_from': ['/files/fastq/']},
+        '/files/nothing/': {},
+    }
+    assert files_request._embedded_uuids == {'uuid-bed', 'uuid-bam'}
+
+
+def test_object_cache_item_properties_memoized(files_request, mocker):
+    from encoded import object_cache
+    upgrade_properties = mocker.spy(type(files_request.root['files']['bam']), 'upgrade_properties')
+    first = object_cache.item_properties(files_request, ['/files/bam/', '/files/other/'])
+    second = object_cache.item_properties(
+        files_request, ['/files/other/', '/files/bam/', '/files/bam/'])
+    assert second['/files/bam/'] is first['/files/bam/']
+    assert second['/files/other/'] == {
+        'uuid': 'uuid-other', 'status': 'deleted', 'assembly': 'hg19', 'derived_from': []}
+    assert upgrade_properties.call_count == 2
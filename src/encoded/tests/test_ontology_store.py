@@ -0,0 +1,82 @@
+import pytest
+
+
+ONTOLOGY = {
+    'UBERON:0002469': {'name': 'esophagus mucosa', 'synonyms': [], 'organs': ['esophagus'],
+                       'part_of': ['UBERON:0001043', 'UBERON:0001096', 'UBERON:1111111']},
+    'UBERON:1111111': {'name': 'a', 'synonyms': [], 'part_of': []},
+    'UBERON:0001096': {'name': 'b', 'synonyms': [], 'part_of': []},
+    'UBERON:0001043': {'name': 'esophagus', 'synonyms': ['gullet'], 'part_of': ['UBERON:0001007', 'UBERON:0004908']},
+    'UBERON:0001007': {'name': 'digestive system', 'synonyms': [], 'part_of': []},
+    'UBERON:0004908': {'name': 'c', 'synonyms': [], 'part_of': ['UBERON:0001043', 'UBERON:1234567']},
+    'UBERON:1234567': {'name': 'd', 'synonyms': [], 'part_of': ['UBERON:0006920', 'UBERON:9999999']},
+    'UBERON:0006920': {'name': 'e', 'synonyms': [], 'part_of': []},
+    'UBERON:1231231': {'name': 'liver'},
+    'OBI:0000716': {'name': 'ChIP-seq', 'synonyms': [], 'assay': ['DNA binding'], 'category': ['DNA binding']},
+}
+
+
+@pytest.fixture
+def ontology_store(tmpdir):
+    from encoded.ontology_store import OntologyStore, build_ontology_store
+    path = str(tmpdir.join('ontology.sqlite'))
+    build_ontology_store(ONTOLOGY, path)
+    return OntologyStore(path)
+
+
+def test_ontology_store_mapping(ontology_store):
+    assert len(ontology_store) == len(ONTOLOGY)
+    assert sorted(ontology_store) == sorted(ONTOLOGY)
+    assert 'OBI:0000716' in ontology_store
+    assert 'OBI:0000000' not in ontology_store
+    assert ontology_store['OBI:0000716']['assay'] == ['DNA binding']
+    assert ontology_store.get('OBI:0000000') is None
+    with pytest.raises(KeyError):
+        ontology_store['OBI:0000000']
+    assert dict(ontology_store.items()) == ONTOLOGY
+
+
+def test_ontology_store_ancestors(ontology_store):
+    from encoded.ontology_store import part_of_closure
+    for term_id in ONTOLOGY:
+        assert ontology_store.ancestors(term_id) == part_of_closure(ONTOLOGY, term_id)
+    assert ontology_store.ancestors('UBERON:0002469') == {
+        'UBERON:0001043', 'UBERON:0001096', 'UBERON:1111111', 'UBERON:0001007', 'UBERON:0004908',
+        'UBERON:1234567', 'UBERON:0006920', 'UBERON:9999999',
+    }
+
+
+@pytest.mark.parametrize('term_id, part_of_term_id, expected', [
+    ('UBERON:0002469', 'UBERON:0001007', True),
+    ('UBERON:0002469', 'UBERON:0006920', True),
+    ('UBERON:0002469', 'UBERON:0001043', True),
+    ('UBERON:0004908', 'UBERON:0004908', True),  # Through a cycle
+    ('UBERON:1111111', 'UBERON:0001043', False),
+    ('UBERON:1231231', 'UBERON:0001043', False),
+    ('UBERON:0001007', 'UBERON:0001043', False),
+])
+def test_ontology_store_is_part_of_matches_dict(ontology_store, term_id, part_of_term_id, expected):
+    from encoded.audit.biosample import is_part_of
+    assert is_part_of(term_id, part_of_term_id, ontology_store) is expected
+    assert is_part_of(term_id, part_of_term_id, ONTOLOGY) is expected
+
+
+def test_open_ontology_builds_store_once(tmpdir, mocker):
+    import json
+    import os
+    import encoded.ontology_store as ontology_store
+    json_path = str(tmpdir.join('ontology.json'))
+    store_path = str(tmpdir.join('ontology.sqlite'))
+    with open(json_path, 'w') as f:
+        json.dump(ONTOLOGY, f)
+    settings = {'ontology_path': json_path, 'ontology_store_path': store_path}
+    build = mocker.spy(ontology_store, 'build_ontology_store')
+    assert dict(ontology_store.open_ontology(settings).items()) == ONTOLOGY
+    ontology_store.open_ontology(settings)
+    assert build.call_count == 1
+    # A newer ontology.json is picked up
+    os.utime(store_path, (0, 0))
+    ontology_store.open_ontology(settings)
+    assert build.call_count == 2
+    assert ontology_store.open_ontology({'ontology_path': json_path}) == ONTOLOGY
+    assert ontology_store.open_ontology({}) == {}
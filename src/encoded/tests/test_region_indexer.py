@@ -0,0 +1,318 @@
+import gzip
+import io
+import pytest
+
+
+def bed_lines(count, chroms=24):
+    for i in range(count):
+        yield 'chr%d\t%d\t%d\tpeak%d\t0\t.\n' % (i % chroms + 1, i * 10, i * 10 + 50, i)
+
+
+def test_read_bed_regions_batches():
+    from encoded.region_indexer import read_bed_regions
+    lines = ['track name=peaks\n'] + list(bed_lines(25, chroms=2))
+    batches = list(read_bed_regions(iter(lines), batch_size=5))
+    assert [(chrom, len(starts)) for chrom, starts, ends in batches] == [
+        ('chr1', 5), ('chr2', 5), ('chr1', 5), ('chr2', 5), ('chr1', 3), ('chr2', 2)
+    ]
+    chrom, starts, ends = batches[0]
+    assert list(starts) == [1, 21, 41, 61, 81]
+    assert list(ends) == [51, 71, 91, 111, 131]
+
+
+def test_read_bed_regions_gzip_stream():
+    from encoded.region_indexer import read_bed_regions
+    data = gzip.compress(''.join(bed_lines(100, chroms=1)).encode('utf-8'))
+    with gzip.open(io.BytesIO(data), mode='rt') as file:
+        batches = list(read_bed_regions(file))
+    assert len(batches) == 1
+    assert len(batches[0][1]) == 100
+
+
+def test_read_bed_regions_bad_position():
+    from encoded.region_indexer import read_bed_regions
+    with pytest.raises(ValueError):
+        list(read_bed_regions(iter(['chr1\tstart\tend\n'])))
+
+
+def test_region_doc_ids():
+    from encoded.region_indexer import region_doc_id, region_doc_uuid
+    uuid = '8a8f5b9f-6f35-4ec4-9a9e-6e1a1f7f7f71'
+    assert region_doc_id(uuid, 0) == uuid
+    assert region_doc_id(uuid, 3) == uuid + ':3'
+    assert region_doc_uuid(region_doc_id(uuid, 0)) == uuid
+    assert region_doc_uuid(region_doc_id(uuid, 3)) == uuid
+
+
+@pytest.mark.slow
+def test_read_bed_regions_memory_is_flat():
+    # Benchmark: peak parser memory must not grow with the number of rows in the file.
+    import tracemalloc
+    from encoded.region_indexer import read_bed_regions
+
+    def peak_memory(rows):
+        tracemalloc.start()
+        for chrom, starts, ends in read_bed_regions(bed_lines(rows), batch_size=5000):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    small = peak_memory(100000)
+    large = peak_memory(1000000)
+    assert large < small * 1.5
+
+
+class FakeIndices(object):
+    def __init__(self):
+        self.calls = 0
+
+    def exists(self, index):
+        self.calls += 1
+        return True
+
+    def exists_type(self, index, doc_type):
+        self.calls += 1
+        return True
+
+
+class FakeRegionsES(object):
+    def __init__(self, residents=None):
+        self.indices = FakeIndices()
+        self.residents = residents or {}
+
+        self.gets = 0
+
+    def get(self, index, doc_type, id):
+        from elasticsearch.exceptions import NotFoundError
+        self.gets += 1
+        if id not in self.residents:
+            raise NotFoundError(404, 'not_found')
+        return {'_source': self.residents[id]}
+
+    def mget(self, index, doc_type, body, _source):
+        return {'docs': [{'_id': id, 'found': id in self.residents} for id in body['ids']]}
+
+
+def region_indexer(regions_es):
+    from encoded.region_indexer import RegionIndexer, RESIDENT_REGIONSET_KEY
+    indexer = RegionIndexer.__new__(RegionIndexer)
+    indexer.regions_es = regions_es
+    indexer.residents_index = RESIDENT_REGIONSET_KEY
+    indexer.known_mappings = set()
+    indexer.bulk_actions = []
+    indexer.bulk_positions = 0
+    indexer.pending_residents = {}
+    indexer.failed_regions = set()
+    indexer.cycle_errors = []
+    indexer.test_instance = False
+    indexer.pool = None
+    indexer.loading = {}
+    indexer.residents = set()
+    indexer.residents_checked = set()
+    indexer.residents_complete = False
+    indexer.interval_files = {}
+    indexer.interval_chroms = set()
+    return indexer
+
+
+def test_add_to_regions_es_single_bulk_request(mocker):
+    bulk = mocker.patch('encoded.region_indexer.bulk', return_value=(4, []))
+    regions_es = FakeRegionsES()
+    indexer = region_indexer(regions_es)
+    regions = {
+        'chr1': [{'start': 1, 'end': 10}, {'start': 20, 'end': 30}],
+        'chr2': [{'start': 5, 'end': 15}],
+    }
+    indexer.add_to_regions_es('uuid1', 'GRCh38', 'ChIP-seq', regions)
+    indexer.add_to_regions_es('uuid2', 'GRCh38', 'ChIP-seq', regions)
+    # One bulk request for the regions, then one for the residency they were written for
+    assert bulk.call_count == 4
+    regions_actions = bulk.call_args_list[2][0][1]
+    assert [(a['_index'], a['_id']) for a in regions_actions] == [('chr1', 'uuid2'), ('chr2', 'uuid2')]
+    actions = bulk.call_args[0][1]
+    assert [(a['_index'], a['_id']) for a in actions] == [('resident_regionsets', 'uuid2')]
+    assert actions[-1]['_source']['chunks'] == {'chr1': 1, 'chr2': 1}
+    assert indexer.residents == {'uuid1', 'uuid2'}
+    # index and mapping existence is only checked the first time each is seen
+    assert regions_es.indices.calls == 6
+
+
+def test_remove_from_regions_es_queues_deletes(mocker):
+    bulk = mocker.patch('encoded.region_indexer.bulk', return_value=(0, [
+        {'delete': {'_index': 'chr2', '_type': 'GRCh38', '_id': 'uuid1', 'status': 404}}
+    ]))
+    resident = {'assembly': 'GRCh38', 'chroms': ['chr1', 'chr2'], 'chunks': {'chr1': 2, 'chr2': 1}}
+    indexer = region_indexer(FakeRegionsES({'uuid1': resident}))
+    assert indexer.remove_from_regions_es('uuid1')
+    assert not indexer.remove_from_regions_es('uuid2')
+    indexer.flush_regions_es()
+    assert bulk.call_count == 1
+    actions = bulk.call_args[0][1]
+    assert [(a['_op_type'], a['_index'], a['_id']) for a in actions] == [
+        ('delete', 'chr1', 'uuid1'),
+        ('delete', 'chr1', 'uuid1:1'),
+        ('delete', 'chr2', 'uuid1'),
+        ('delete', 'resident_regionsets', 'uuid1'),
+    ]
+    assert indexer.cycle_errors == []
+    assert indexer.interval_files == {'uuid1': None}
+    assert indexer.interval_chroms == {('GRCh38', 'chr1'), ('GRCh38', 'chr2')}
+
+
+def test_prefetched_residency_avoids_gets(mocker):
+    mocker.patch('encoded.region_indexer.bulk', return_value=(0, []))
+    resident = {'assembly': 'GRCh38', 'chroms': ['chr1']}
+    regions_es = FakeRegionsES({'uuid1': resident})
+    indexer = region_indexer(regions_es)
+    indexer.prefetch_residents(['uuid1', 'uuid2', 'uuid3'])
+    assert indexer.in_regions_es('uuid1')
+    assert not indexer.in_regions_es('uuid2')
+    assert not indexer.remove_from_regions_es('uuid3')
+    assert regions_es.gets == 0
+    assert indexer.remove_from_regions_es('uuid1')  # only a real removal needs the residency doc
+    assert regions_es.gets == 1
+    assert not indexer.in_regions_es('uuid1')
+
+
+class FakeState(object):
+    def __init__(self):
+        self.added = []
+
+    def file_added(self, uuid):
+        self.added.append(uuid)
+
+
+def test_concurrent_file_loading(mocker):
+    import queue
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from array import array
+    bulk = mocker.patch('encoded.region_indexer.bulk', return_value=(0, []))
+    indexer = region_indexer(FakeRegionsES())
+    indexer.state = FakeState()
+
+    def read_encoded_file(href, afile):
+        if afile['uuid'] == 'bad':
+            raise IOError('connection reset')
+        yield ('chr1', array('l', [1, 2]), array('l', [5, 6]))
+        yield ('chr1', array('l', [7]), array('l', [9]))
+
+    indexer.read_encoded_file = read_encoded_file
+    indexer.pool = ThreadPoolExecutor(max_workers=3)
+    indexer.loaded = queue.Queue(maxsize=2)
+    indexer.cancelled = threading.Event()
+    request = mocker.Mock(host_url='http://localhost')
+    for uuid in ['a', 'b', 'bad', 'c']:
+        afile = {'uuid': uuid, 'assembly': 'GRCh38', 'href': '/files/%s/@@download' % uuid, 'file_format': 'bed'}
+        indexer.submit_encoded_file(request, 'ENCSR000AAA', 'ChIP-seq', afile)
+    indexer.drain_loaded_files(block=True)
+    indexer.pool.shutdown()
+    indexer.flush_regions_es()
+
+    assert sorted(indexer.state.added) == ['a', 'b', 'c']
+    assert [error['uuid'] for error in indexer.cycle_errors] == ['bad']
+    actions = bulk.call_args[0][1]
+    residents = [a for a in actions if a['_index'] == 'resident_regionsets']
+    assert sorted(a['_id'] for a in residents) == ['a', 'b', 'c']
+    assert all(a['_source']['chunks'] == {'chr1': 2} for a in residents)
+
+
+def test_failed_regions_leave_file_unresident(mocker):
+    from array import array
+    failures = [{'index': {'_index': 'chr2', '_type': 'GRCh38', '_id': 'bad:1', 'status': 429,
+                           'error': 'es_rejected_execution_exception'}}]
+    bulk = mocker.patch('encoded.region_indexer.bulk', side_effect=[(5, failures), (1, []), (2, [])])
+    indexer = region_indexer(FakeRegionsES())
+    indexer.state = FakeState()
+    for uuid in ['good', 'bad']:
+        indexer.add_region_batch(uuid, 'GRCh38', 'chr1', 0, array('l', [1]), array('l', [5]))
+        indexer.add_region_batch(uuid, 'GRCh38', 'chr2', 0, array('l', [1]), array('l', [5]))
+        indexer.add_region_batch(uuid, 'GRCh38', 'chr2', 1, array('l', [7]), array('l', [9]))
+        indexer.add_residency(uuid, 'GRCh38', 'ChIP-seq', {'chr1': 1, 'chr2': 2},
+                              added=('ENCSR000AAA', '/files/%s/@@download' % uuid, ''))
+    indexer.flush_regions_es()
+
+    assert bulk.call_count == 2
+    # Only the file whose regions all made it is resident; the other's regions are deleted to be retried
+    actions = bulk.call_args[0][1]
+    assert [(a['_op_type'], a['_index'], a['_id']) for a in actions] == [
+        ('index', 'resident_regionsets', 'good'),
+        ('delete', 'chr1', 'bad'),
+        ('delete', 'chr2', 'bad'),
+        ('delete', 'chr2', 'bad:1'),
+    ]
+    assert indexer.residents == {'good'}
+    assert indexer.state.added == ['good']
+    assert not indexer.in_regions_es('bad')
+    assert [error['uuid'] for error in indexer.cycle_errors] == ['bad']
+    assert list(indexer.interval_files) == ['good']
+    assert indexer.interval_chroms == {('GRCh38', 'chr1'), ('GRCh38', 'chr2')}
+
+
+class FakeIntervalES(object):
+    def __init__(self):
+        self.regions = {}  # (chrom, doc id) => positions
+        self.mgets = []
+
+    def add(self, uuid, chrom, chunks):
+        from encoded.region_indexer import region_doc_id
+        for chunk, positions in enumerate(chunks):
+            self.regions[(chrom, region_doc_id(uuid, chunk))] = [
+                {'start': start, 'end': end} for (start, end) in positions]
+        return len(chunks)
+
+    def mget(self, index, doc_type, body):
+        self.mgets.extend(body['ids'])
+        return {'docs': [
+            {'_id': id, 'found': True, '_source': {'positions': self.regions[(index, id)]}}
+            if (index, id) in self.regions else {'_id': id, 'found': False}
+            for id in body['ids']]}
+
+
+def test_interval_index_rewrites_changed_chroms(tmpdir, mocker):
+    import os
+    from encoded.region_intervals import load_interval_index
+    regions_es = FakeIntervalES()
+    residents = {
+        'a': {'uuid': 'a', 'assembly': 'GRCh38', 'chroms': ['chr1', 'chr2'], 'chunks': {
+            'chr1': regions_es.add('a', 'chr1', [[(100, 200)], [(500, 600)]]),
+            'chr2': regions_es.add('a', 'chr2', [[(100, 200)]])}},
+        'b': {'uuid': 'b', 'assembly': 'GRCh38', 'chroms': ['chr2'], 'chunks': {
+            'chr2': regions_es.add('b', 'chr2', [[(150, 250)]])}},
+        'c': {'uuid': 'c', 'assembly': 'GRCh38', 'chroms': ['chr2', 'chrX'], 'chunks': {
+            'chr2': regions_es.add('c', 'chr2', [[(180, 190)]]),
+            'chrX': regions_es.add('c', 'chrX', [[(1, 5)]])}},
+    }
+    scan = mocker.patch('encoded.region_indexer.scan', side_effect=lambda es, query, index, doc_type: [
+        {'_source': residents[uuid]} for uuid in ['a', 'b']])
+    indexer = region_indexer(regions_es)
+    indexer.interval_index_path = str(tmpdir)
+    indexer.interval_index_full = True
+    indexer.write_interval_index()
+    first = load_interval_index(str(tmpdir))
+    assert first.file_uuids('GRCh38', 'chr2', 160, 160) == {'a', 'b'}
+
+    # b dropped and c added: only chr2 and chrX are rewritten, from c's region docs
+    indexer.interval_changed('b', None, residents['b'])
+    indexer.interval_changed('c', residents['c'])
+    regions_es.mgets = []
+    indexer.write_interval_index()
+    assert scan.call_count == 1
+    assert sorted(regions_es.mgets) == ['c', 'c']
+    index = load_interval_index(str(tmpdir))
+    assert index.path != first.path
+    assert os.path.samefile(os.path.join(index.path, 'GRCh38', 'chr1.starts.npy'),
+                            os.path.join(first.path, 'GRCh38', 'chr1.starts.npy'))
+    assert (indexer.interval_files, indexer.interval_chroms) == ({}, set())
+
+    # Same answers as reading everything again
+    scan.side_effect = lambda es, query, index, doc_type: [{'_source': residents[uuid]} for uuid in ['a', 'c']]
+    indexer.interval_index_full = True
+    indexer.write_interval_index()
+    full = load_interval_index(str(tmpdir))
+    for (chrom, start, end) in [('chr1', 150, 150), ('chr1', 550, 560), ('chr2', 160, 185), ('chr2', 240, 240),
+                                ('chrX', 2, 3)]:
+        assert index.file_uuids('GRCh38', chrom, start, end) == full.file_uuids('GRCh38', chrom, start, end)
+    assert index.file_uuids('GRCh38', 'chr2', 100, 300) == {'a', 'c'}
+    assert index.chroms == full.chroms
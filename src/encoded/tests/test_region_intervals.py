@@ -0,0 +1,79 @@
+import random
+import pytest
+
+
+def build_index(path, peaks, uuids):
+    from encoded.region_intervals import IntervalIndexWriter
+    writer = IntervalIndexWriter(str(path))
+    for (assembly, chrom), rows in peaks.items():
+        starts, ends, files = zip(*rows)
+        writer.add_chrom(assembly, chrom, starts, ends, files)
+    writer.commit(uuids)
+
+
+def es_matches(row, start, end):
+    # The clauses of region_search.get_peak_query
+    (peak_start, peak_end) = row[:2]
+    return ((peak_start <= start and peak_end >= end) or
+            (peak_start <= end and peak_end >= start) or
+            (peak_start <= start and peak_end >= start) or
+            (peak_start <= end and peak_end >= end))
+
+
+@pytest.fixture
+def interval_settings(tmpdir):
+    class Registry(object):
+        settings = {'region_search.interval_index': str(tmpdir)}
+    return Registry()
+
+
+def test_interval_index_not_built(interval_settings):
+    from encoded.region_intervals import get_interval_index
+    assert get_interval_index(interval_settings) is None
+
+
+def test_interval_index_matches_peak_query(tmpdir, interval_settings):
+    from encoded.region_intervals import get_interval_index
+    rng = random.Random(42)
+    uuids = ['file%d' % i for i in range(20)]
+    rows = []
+    for i in range(5000):
+        start = rng.randint(1, 1000000)
+        rows.append((start, start + rng.randint(0, 5000), rng.randrange(len(uuids))))
+    build_index(tmpdir, {('GRCh38', 'chr1'): rows}, uuids)
+    index = get_interval_index(interval_settings)
+    for _ in range(200):
+        start = rng.randint(1, 1000000)
+        end = start + rng.randint(0, 2000)
+        expected = set(uuids[row[2]] for row in rows if es_matches(row, start, end))
+        assert index.file_uuids('GRCh38', 'chr1', start, end) == expected
+    assert index.file_uuids('GRCh38', 'chr2', 1, 100) == set()
+    assert index.file_uuids('mm10', 'chr1', 1, 100) == set()
+
+
+def test_interval_index_peak_hits(tmpdir, interval_settings):
+    from encoded.region_intervals import get_interval_index
+    rows = [(100, 200, 0), (150, 250, 1), (180, 190, 0), (300, 400, 1)]
+    build_index(tmpdir, {('GRCh38', 'chr1'): rows}, ['a', 'b'])
+    hits = get_interval_index(interval_settings).peak_hits('GRCh38', 'chr1', 185, 210, with_inner_hits=True)
+    assert [(hit['_index'], hit['_id']) for hit in hits] == [('chr1', 'a'), ('chr1', 'b')]
+    positions = [inner['_source'] for inner in hits[0]['inner_hits']['positions']['hits']['hits']]
+    assert positions == [{'start': 100, 'end': 200}, {'start': 180, 'end': 190}]
+
+
+def test_interval_index_rebuild_swaps(tmpdir, interval_settings):
+    from encoded.region_intervals import get_interval_index
+    build_index(tmpdir, {('GRCh38', 'chr1'): [(100, 200, 0)]}, ['a'])
+    assert get_interval_index(interval_settings).file_uuids('GRCh38', 'chr1', 150, 150) == {'a'}
+    build_index(tmpdir, {('GRCh38', 'chr1'): [(100, 200, 0)]}, ['b'])
+    build_index(tmpdir, {('GRCh38', 'chr1'): [(100, 200, 0)]}, ['c'])
+    assert get_interval_index(interval_settings).file_uuids('GRCh38', 'chr1', 150, 150) == {'c'}
+    assert len([name for name in tmpdir.listdir() if name.basename.startswith('build-')]) == 2
+
+
+def test_interval_index_builds_in_same_millisecond(tmpdir, mocker):
+    from encoded.region_intervals import IntervalIndexWriter
+    mocker.patch('encoded.region_intervals.time.time', return_value=1500000000.0)
+    first = IntervalIndexWriter(str(tmpdir))
+    second = IntervalIndexWriter(str(tmpdir))
+    assert first.build != second.build
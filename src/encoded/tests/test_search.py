@@ -222,6 +222,15 @@ def test_matrix_view(workbook, testapp):
         'biosample_ontology.classification']['buckets'][0]['biosample_ontology.term_name']['buckets']) > 0
 
 
+def test_matrix_view_leaves_type_matrix_alone(workbook, testapp):
+    from encoded.types.experiment import Experiment
+    testapp.get('/matrix/?type=Experiment&x.limit=7')
+    assert 'limit' not in Experiment.matrix['x']
+    assert 'buckets' not in Experiment.matrix['x']
+    res = testapp.get('/matrix/?type=Experiment').json
+    assert res['matrix']['x']['limit'] == 20
+
+
 def test_set_filters():
 
     request = FakeRequest((
@@ -0,0 +1,158 @@
+import pytest
+
+
+@pytest.fixture
+def vis_registry(mocker):
+    from pyramid.registry import Registry
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    import encoded.vis_defines as vis_defines
+    mocker.patch.object(vis_defines, 'VIS_BLOB_LRU', None)
+    mocker.patch.object(vis_defines, 'VIS_CACHE_EXISTS', True)
+    es = mocker.Mock()
+    es.get.side_effect = lambda index, doc_type, id: (
+        {'_source': {'status': 'done', 'xmin': 100}} if id == 'vis_indexer' else {'_source': {'id': id}})
+    es.mget.side_effect = lambda body, **kw: {'docs': [
+        {'_id': vis_id, 'found': True, '_source': {'id': vis_id}} if vis_id.startswith('ENCSR') else
+        {'_id': vis_id, 'found': False} for vis_id in body['ids']]}
+    registry = Registry()
+    registry.settings = {'snovault.elasticsearch.index': 'snovault'}
+    registry[ELASTIC_SEARCH] = es
+    return registry
+
+
+def vis_request(registry):
+    from pyramid.request import Request
+    request = Request.blank('/')
+    request.registry = registry
+    return request
+
+
+def test_vis_cache_lru_answers_repeat_gets(vis_registry):
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    from encoded.vis_defines import VisCache
+    es = vis_registry[ELASTIC_SEARCH]
+    VisCache(vis_request(vis_registry)).get('ENCSR000AAA_hg19')
+    VisCache(vis_request(vis_registry)).get(accession='ENCSR000AAA', assembly='hg19')
+    blob_gets = [c for c in es.get.call_args_list if c[1]['id'] != 'vis_indexer']
+    assert len(blob_gets) == 1
+
+
+def test_vis_cache_search_only_asks_es_for_misses(vis_registry):
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    from encoded.vis_defines import VisCache
+    es = vis_registry[ELASTIC_SEARCH]
+    results = VisCache(vis_request(vis_registry)).search(['ENCSR000AAA', 'XXX'], 'hg19')
+    assert list(results) == ['ENCSR000AAA_hg19']
+    results = VisCache(vis_request(vis_registry)).search(['ENCSR000AAA', 'ENCSR000AAB', 'XXX'], 'hg19')
+    assert sorted(results) == ['ENCSR000AAA_hg19', 'ENCSR000AAB_hg19']
+    # Second search only asked for the one never seen, known misses included
+    assert es.mget.call_args[1]['body']['ids'] == ['ENCSR000AAB_hg19']
+
+
+def test_vis_cache_search_chunks_in_order(vis_registry):
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    from encoded.vis_defines import VisCache
+    accessions = ['ENCSR%03dAAA' % i for i in range(5)] + ['XXX']
+    chunks = list(VisCache(vis_request(vis_registry)).search_chunks(accessions, 'GRCh38', chunk_size=4))
+    assert [list(chunk) for chunk in chunks] == [
+        [acc + '_hg38' for acc in accessions[:4]], [acc + '_hg38' for acc in accessions[4:]]]
+    assert chunks[1]['XXX_hg38'] is None
+    assert vis_registry[ELASTIC_SEARCH].mget.call_count == 2
+
+
+def test_vis_cache_dropped_when_vis_indexer_moves_on(vis_registry, mocker):
+    import encoded.vis_defines as vis_defines
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    es = vis_registry[ELASTIC_SEARCH]
+    vis_defines.VisCache(vis_request(vis_registry)).add('ENCSR000AAA_hg19', {'v': 1})
+    assert vis_defines.VIS_BLOB_LRU.get('ENCSR000AAA_hg19') == (True, {'v': 1})
+    es.get.side_effect = lambda index, doc_type, id: {'_source': {'status': 'done', 'xmin': 101}}
+    vis_defines.VIS_BLOB_LRU.checked = 0
+    vis_defines.VisCache(vis_request(vis_registry))
+    assert vis_defines.VIS_BLOB_LRU.get('ENCSR000AAA_hg19') == (False, None)
+
+
+def test_vis_cache_not_used_without_vis_indexer(vis_registry):
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    from encoded.vis_defines import VisCache
+    vis_registry[ELASTIC_SEARCH].get.side_effect = Exception('missing')
+    assert VisCache(vis_request(vis_registry)).lru is None
+
+
+def test_vis_cache_batched_adds_use_bulk(vis_registry, mocker):
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    import encoded.vis_defines as vis_defines
+    bulk = mocker.patch.object(vis_defines, 'bulk', return_value=(2, []))
+    vis_cache = vis_defines.VisCache(vis_request(vis_registry), batch_size=2)
+    for i in range(5):
+        vis_cache.add('ENCSR%03dAAA_hg19' % i, {'i': i})
+    assert bulk.call_count == 2
+    assert [a['_id'] for a in bulk.call_args[0][1]] == ['ENCSR002AAA_hg19', 'ENCSR003AAA_hg19']
+    assert vis_cache.flush() == []
+    assert bulk.call_count == 3
+    assert vis_cache.flush() == []
+    assert bulk.call_count == 3
+    assert not vis_registry[ELASTIC_SEARCH].index.called
+
+
+def test_vis_cache_flush_reports_failures(vis_registry, mocker):
+    import encoded.vis_defines as vis_defines
+    mocker.patch.object(vis_defines, 'bulk', return_value=(0, [{'index': {'_id': 'ENCSR000AAA_hg19'}}]))
+    vis_cache = vis_defines.VisCache(vis_request(vis_registry), batch_size=10)
+    vis_cache.add('ENCSR000AAA_hg19', {})
+    assert vis_cache.flush() == ['ENCSR000AAA_hg19']
+
+
+def test_vis_cache_failed_writes_leave_the_lru(vis_registry, mocker):
+    from elasticsearch.exceptions import ConnectionTimeout
+    import encoded.vis_defines as vis_defines
+    bulk = mocker.patch.object(vis_defines, 'bulk', side_effect=ConnectionTimeout('TIMEOUT', 'timed out', None))
+    vis_cache = vis_defines.VisCache(vis_request(vis_registry), batch_size=2)
+    for i in range(3):
+        vis_cache.add('ENCSR%03dAAA_hg19' % i, {'i': i})
+    bulk.side_effect = None
+    bulk.return_value = (1, [])
+    # The failed write add() set off is reported along with the flush's own
+    assert vis_cache.flush() == ['ENCSR000AAA_hg19', 'ENCSR001AAA_hg19']
+    assert vis_cache.lru.get('ENCSR000AAA_hg19') == (False, None)
+    assert vis_cache.lru.get('ENCSR002AAA_hg19') == (True, {'i': 2})
+    assert vis_cache.flush() == []
+
+
+def test_vis_cache_recreated_after_index_not_found(vis_registry, mocker):
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    import encoded.vis_defines as vis_defines
+    error = {'index': {'_id': 'ENCSR000AAA_hg19', 'status': 404,
+                       'error': {'type': 'index_not_found_exception', 'reason': 'no such index'}}}
+    mocker.patch.object(vis_defines, 'bulk', side_effect=[(0, [error]), (1, [])])
+    es = vis_registry[ELASTIC_SEARCH]
+    es.indices.exists.return_value = False
+    vis_cache = vis_defines.VisCache(vis_request(vis_registry), batch_size=10)
+    vis_cache.add('ENCSR000AAA_hg19', {})
+    assert vis_cache.flush() == ['ENCSR000AAA_hg19']
+    assert not vis_defines.VIS_CACHE_EXISTS
+    assert not es.indices.create.called
+    vis_cache.add('ENCSR000AAA_hg19', {})
+    assert vis_cache.flush() == []
+    assert es.indices.put_mapping.call_count == 1
+
+
+def test_vis_cache_search_chunks_mget_concurrently(vis_registry, mocker):
+    import threading
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    import encoded.vis_defines as vis_defines
+    es = vis_registry[ELASTIC_SEARCH]
+    mget = es.mget.side_effect
+    threads = set()
+
+    def recording_mget(body, **kw):
+        threads.add(threading.current_thread())
+        return mget(body, **kw)
+
+    es.mget.side_effect = recording_mget
+    accessions = ['ENCSR%03dAAA' % i for i in range(12)]
+    chunks = list(vis_defines.VisCache(vis_request(vis_registry)).search_chunks(accessions, 'hg19', chunk_size=2))
+    assert [list(chunk) for chunk in chunks] == [
+        [acc + '_hg19' for acc in accessions[i:i + 2]] for i in range(0, 12, 2)]
+    assert es.mget.call_count == 6
+    assert threading.current_thread() not in threads
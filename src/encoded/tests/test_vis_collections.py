@@ -0,0 +1,136 @@
+import pytest
+
+
+VIS_TYPES = ['TF_ChIP_type', 'DNASE_type', 'LRNA']
+
+
+def vis_blob(i):
+    accession = 'ENCSR%03dAAA' % i
+    tracks = [
+        {'name': accession + '_pk', 'shortLabel': 'peaks %d' % i, 'membership': {'view': 'PK', 'BS': 'b%d' % (i % 3)}},
+        {'name': accession + '_sig', 'shortLabel': 'signal %d' % i, 'membership': {'view': 'SIG', 'BS': 'b%d' % (i % 3)}},
+    ]
+    return {
+        'name': accession.lower(),
+        'vis_type': VIS_TYPES[i % len(VIS_TYPES)],
+        'longLabel': 'Experiment %s' % accession,
+        'shortLabel': 'ENCODE %s' % accession,
+        'pennantIcon': 'NHGRI' if i % 7 == 0 else 'ENCODE',
+        'tracks': tracks,
+        'view': {
+            'title': 'Views',
+            'group_order': ['PK', 'SIG'],
+            'groups': {
+                'PK': {'tag': 'PK', 'title': 'Peaks', 'type': 'bigBed', 'tracks': tracks[:1]},
+                'SIG': {'tag': 'SIG', 'title': 'Signal', 'type': 'bigWig', 'tracks': tracks[1:]},
+            },
+        },
+        'group_order': ['BS'],
+        'groups': {'BS': {'title': 'Biosample', 'groups': {'b%d' % (i % 3): {'title': 'Biosample %d' % (i % 3)}}}},
+    }
+
+
+class FakeVisCache(object):
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def search(self, accessions, assembly):
+        from copy import deepcopy
+        return {acc + '_hg19': deepcopy(self.blobs[acc]) for acc in accessions if acc in self.blobs}
+
+    def search_chunks(self, accessions, assembly):
+        from collections import OrderedDict
+        from copy import deepcopy
+        for start in range(0, len(accessions), 7):
+            yield OrderedDict((acc + '_hg19', deepcopy(self.blobs.get(acc))) for acc in accessions[start:start + 7])
+
+
+@pytest.fixture
+def vis_collection(mocker):
+    from pyramid.request import Request
+    import encoded.visualization as visualization
+    blobs = {}
+    for i in range(150):
+        if i % 13 == 0 and i:
+            continue  # Not in the cache
+        blobs['ENCSR%03dAAA' % i] = {} if i % 11 == 0 else vis_blob(i)
+    mocker.patch.object(visualization, 'VisCache', return_value=FakeVisCache(blobs))
+
+    def make(page):
+        return visualization.VisCollections(Request.blank('/batch_hub/type=Experiment/hg19/' + page))
+    return make
+
+
+@pytest.mark.parametrize('page', ['trackDb.txt', 'trackDb.json', 'vis_blob.json'])
+@pytest.mark.parametrize('prepend_label', [None, 'ENCSR999ZZZ'])
+def test_vis_collections_chunked_matches_stringify(vis_collection, page, prepend_label):
+    accessions = ['ENCSR%03dAAA' % i for i in reversed(range(150))]
+    expected = vis_collection(page)
+    expected.find_or_build(accessions, 'hg19')
+    expected = expected.stringify(prepend_label)
+    collection = vis_collection(page)
+    assert collection.stringify_found_or_built(accessions, 'hg19', prepend_label=prepend_label) == expected
+    assert collection.built == 0
+    assert 'ENCSR139AAA' in expected and 'ENCSR130AAA' not in expected
+
+
+def test_vis_collections_builds_misses_on_request_thread(vis_collection, mocker):
+    import threading
+    import encoded.visualization as visualization
+    visualization.VisCache.return_value.blobs = {}
+    threads = set()
+
+    def build_one(self, acc, assembly, hide=False):
+        threads.add(threading.current_thread())
+        return (acc, vis_blob(int(acc[5:8])), True)
+
+    build_one = mocker.patch.object(visualization.VisCollections, 'build_one', autospec=True, side_effect=build_one)
+    collection = vis_collection('trackDb.txt')
+    accessions = ['ENCSR%03dAAA' % i for i in range(20)]
+    text = collection.stringify_found_or_built(accessions, 'hg19')
+    assert build_one.call_count == 20 and collection.built == 20
+    assert threads == {threading.current_thread()}
+    assert text.index('ENCSR000AAA_pk') < text.index('ENCSR003AAA_pk')
+
+
+def test_vis_collections_builds_nothing_when_any_found(vis_collection, mocker):
+    import encoded.visualization as visualization
+    # Only the last chunk has a cached vis_blob
+    visualization.VisCache.return_value.blobs = {'ENCSR019AAA': vis_blob(19)}
+    build_one = mocker.patch.object(visualization.VisCollections, 'build_one', autospec=True)
+    collection = vis_collection('trackDb.txt')
+    text = collection.stringify_found_or_built(['ENCSR%03dAAA' % i for i in range(20)], 'hg19')
+    assert not build_one.called
+    assert (collection.found, collection.built) == (1, 0)
+    assert 'ENCSR019AAA_pk' in text and 'ENCSR000AAA_pk' not in text
+
+
+@pytest.mark.parametrize('prepend_label', [None, 'ENCSR999ZZZ'])
+def test_vis_collections_same_hub_twice_through_lru(mocker, prepend_label):
+    from pyramid.registry import Registry
+    from pyramid.request import Request
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    import encoded.vis_defines as vis_defines
+    import encoded.visualization as visualization
+    mocker.patch.object(vis_defines, 'VIS_BLOB_LRU', None)
+    es = mocker.Mock()
+    es.get.side_effect = lambda index, doc_type, id: {'_source': {'status': 'done', 'xmin': 100}}
+    es.mget.side_effect = lambda body, **kw: {'docs': [
+        {'_id': vis_id, 'found': True, '_source': vis_blob(int(vis_id[5:8]))} for vis_id in body['ids']]}
+    registry = Registry()
+    registry.settings = {'snovault.elasticsearch.index': 'snovault'}
+    registry[ELASTIC_SEARCH] = es
+
+    def render():
+        request = Request.blank('/batch_hub/type=Experiment/hg19/trackDb.txt')
+        request.registry = registry
+        collection = visualization.VisCollections(request)
+        return collection.stringify_found_or_built(
+            ['ENCSR%03dAAA' % i for i in range(12)], 'hg19', prepend_label=prepend_label)
+
+    first = render()
+    second = render()
+    # The second hub came from the LRU, which the first one's remodelling left alone
+    assert es.mget.call_count == 1
+    assert second == first
@@ -0,0 +1,172 @@
+import pytest
+
+
+def reference_convert_mask(vis_defines, mask, dataset=None, a_file=None):
+    # VisDefines.convert_mask before masks were compiled
+    working_on = mask
+    if dataset is None:
+        dataset = vis_defines.dataset
+    chars = len(working_on)
+    while chars > 0:
+        beg_ix = working_on.find('{')
+        if beg_ix == -1:
+            break
+        end_ix = working_on.find('}')
+        if end_ix == -1:
+            break
+        term = vis_defines.lookup_token(working_on[beg_ix:end_ix+1], dataset, a_file=a_file)
+        new_mask = []
+        if beg_ix > 0:
+            new_mask = working_on[0:beg_ix]
+        new_mask += "%s%s" % (term, working_on[end_ix+1:])
+        chars = len(working_on[end_ix+1:])
+        working_on = ''.join(new_mask)
+    return working_on
+
+
+def reference_vis_type_by_rule(vis_defines):
+    # The rule loop of VisDefines.get_vis_type before rules were compiled
+    assay = vis_defines.dataset.get("assay_term_name", 'none')
+    for vis_type in sorted(vis_defines.vis_defs.keys(), reverse=True):
+        if "rule" in vis_defines.vis_defs[vis_type]:
+            rule = vis_defines.vis_defs[vis_type]["rule"].replace('{assay_term_name}', assay)
+            if rule.find('{') != -1:
+                rule = reference_convert_mask(vis_defines, rule)
+            if eval(rule):
+                return vis_type
+    return None
+
+
+def reference_sanitize(s, exceptions=['_'], htmlize=False, numeralize=False):
+    from encoded.vis_defines import Sanitize
+    return ''.join(Sanitize().escape_char(c, exceptions, htmlize, numeralize) for c in s)
+
+
+ASSAYS = [
+    'ChIP-seq', 'DNase-seq', 'ATAC-seq', 'RNA-seq', 'eCLIP', 'HiC', 'ChIA-PET', 'RAMPAGE',
+    'microRNA-seq', 'single cell RNA-seq', 'whole-genome shotgun bisulfite sequencing', 'Mint-ChIP-seq',
+]
+
+
+def vis_dataset(i, assay):
+    return {
+        '@id': '/experiments/ENCSR%03dAAA/' % i,
+        '@type': ['Experiment', 'Dataset', 'Item'],
+        'accession': 'ENCSR%03dAAA' % i,
+        'assay_term_name': assay,
+        'assay_title': assay,
+        'target': {
+            'label': 'H3K27ac' if i % 2 else 'CTCF',
+            'investigated_as': ['histone'] if i % 2 else ['transcription factor'],
+            'title': 'CTCF (Homo sapiens)',
+            'name': 'CTCF-human',
+        },
+        'biosample_ontology': {'term_name': "K562 'cell' line"},
+        'replicates': [{'library': {'biosample': {'summary': 'Homo sapiens K562', 'accession': 'ENCBS001AAA'}}}],
+        'award': {'rfa': 'GGR' if i % 3 == 0 else 'ENCODE3'},
+        'lab': {'title': 'Lab (Stanford)'},
+        'assembly': ['GRCh38'],
+    }
+
+
+def vis_file(i):
+    return {
+        'accession': 'ENCFF%03dAAA' % i,
+        'output_type': ['signal p-value', 'conservative IDR thresholded peaks', 'fold change over control'][i % 3],
+        'replicate': {'biological_replicate_number': 1 + i % 2, 'technical_replicate_number': 1},
+        'file_format_type': 'narrowPeak',
+        'assembly': 'GRCh38',
+    }
+
+
+@pytest.fixture
+def vis_defines():
+    from encoded.vis_defines import VisDefines
+    return VisDefines(None)
+
+
+@pytest.fixture
+def shipped_masks(vis_defines):
+    from encoded.vis_defines import vis_def_masks
+    return sorted(set(vis_def_masks(vis_defines.vis_defs)))
+
+
+def test_vis_defines_masks_found(shipped_masks):
+    assert len(shipped_masks) > 10
+    assert all('{' in mask for mask in shipped_masks)
+
+
+def test_vis_defines_convert_mask_matches_reference(vis_defines, shipped_masks):
+    masks = shipped_masks + ['no tokens', '{accession}', 'dangling {accession', '{lab.title} - {accession}']
+    for i, assay in enumerate(ASSAYS):
+        vis_defines.dataset = vis_dataset(i, assay)
+        a_file = vis_file(i)
+        for mask in masks:
+            assert vis_defines.convert_mask(mask) == reference_convert_mask(vis_defines, mask)
+            assert (vis_defines.convert_mask(mask, a_file=a_file) ==
+                    reference_convert_mask(vis_defines, mask, a_file=a_file))
+
+
+def test_vis_defines_convert_mask_values_not_rescanned(vis_defines):
+    dataset = vis_dataset(1, 'ChIP-seq')
+    dataset['biosample_ontology']['term_name'] = 'K562 {treated}'
+    vis_defines.dataset = dataset
+    assert vis_defines.convert_mask('{biosample_term_name} {accession}') == 'K562 {treated} ENCSR001AAA'
+
+
+def test_vis_defines_rules_match_reference(vis_defines):
+    for i, assay in enumerate(ASSAYS):
+        vis_defines.dataset = vis_dataset(i, assay)
+        expected = reference_vis_type_by_rule(vis_defines)
+        vis_type = vis_defines.get_vis_type()
+        if expected is not None:
+            assert vis_type == expected
+
+
+def test_vis_defines_rule_values_are_not_code(vis_defines):
+    from encoded.vis_defines import compile_rule
+    assert compile_rule("'{assay_term_name}' == 'ChIP-seq' and 'histone' in '{target.investigated_as}'")
+    vis_defines.dataset = vis_dataset(1, "ChIP-seq' or '1")
+    assert not vis_defines.rule_matches("'{assay_term_name}' == 'ChIP-seq'", "ChIP-seq' or '1")
+
+
+@pytest.mark.parametrize('s', [
+    'K562 treated with 100 nM estradiol (1 hour)', 'H3K27ac/rep1', '3prime-seq', '#1 tag', u'café + bar', '',
+])
+def test_vis_defines_sanitize_matches_reference(s):
+    from encoded.vis_defines import sanitize
+    assert sanitize.label(s) == reference_sanitize(s, [' ', '_', '.', '-', '(', ')', '+'])
+    assert sanitize.title(s) == reference_sanitize(s, ['_', '.', '-', '(', ')', '+'], htmlize=True)
+    assert sanitize.name(s) == reference_sanitize(s)
+    tag = reference_sanitize(s, numeralize=True)
+    if s and reference_sanitize(s[0], numeralize=True).isdigit():
+        tag = 'z' + tag
+    assert sanitize.tag(s) == tag
+
+
+
+@pytest.mark.slow
+def test_vis_defines_masks_benchmark(vis_defines, shipped_masks):
+    # Reports timings only; a timing assert would fail at random on a loaded machine
+    import time
+    datasets = [vis_dataset(i, ASSAYS[i % len(ASSAYS)]) for i in range(1000)]
+    files = [vis_file(i) for i in range(1000)]
+
+    start = time.time()
+    for dataset, a_file in zip(datasets, files):
+        vis_defines.dataset = dataset
+        reference_vis_type_by_rule(vis_defines)
+        for mask in shipped_masks:
+            reference_convert_mask(vis_defines, mask, a_file=a_file)
+    reference_time = time.time() - start
+
+    start = time.time()
+    for dataset, a_file in zip(datasets, files):
+        vis_defines.dataset = dataset
+        vis_defines.get_vis_type()
+        for mask in shipped_masks:
+            vis_defines.convert_mask(mask, a_file=a_file)
+    compiled_time = time.time() - start
+
+    print('1000 datasets x %d shipped masks: eval/scan %.2fs, compiled %.2fs' %
+          (len(shipped_masks), reference_time, compiled_time))
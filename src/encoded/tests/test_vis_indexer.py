@@ -0,0 +1,74 @@
+import pytest
+
+
+def embedded(i):
+    return {'uuid': 'uuid-%d' % i, 'accession': 'ENCSR%03dAAA' % i, 'assembly': ['GRCh38']}
+
+
+@pytest.fixture
+def vis_indexer(mocker):
+    import encoded.vis_indexer as vis_indexer
+    indexer = vis_indexer.VisIndexer.__new__(vis_indexer.VisIndexer)
+    indexer.es = mocker.Mock()
+    indexer.es.search.side_effect = lambda index, body, **kw: {'hits': {'hits': [
+        {'_source': {'uuid': uuid, 'embedded': embedded(int(uuid.split('-')[1]))}}
+        for uuid in body['query']['terms']['uuid'] if uuid != 'uuid-3']}}
+    indexer.esstorage = mocker.Mock()
+    indexer.esstorage.get_by_uuid.return_value.source = {'embedded': embedded(3)}
+    indexer.state = mocker.Mock()
+    indexer.processes = 1
+    vis_cache = mocker.Mock()
+    vis_cache.flush.return_value = []
+    mocker.patch.object(vis_indexer, 'VisCache', return_value=vis_cache)
+    mocker.patch.object(vis_indexer, 'VIS_PREFETCH_SIZE', 4)
+    return indexer
+
+
+def test_vis_indexer_prefetches_and_batches_accounting(vis_indexer, mocker):
+    import encoded.vis_indexer as vis_indexer_module
+    vis_cache_add = mocker.patch.object(vis_indexer_module, 'vis_cache_add', return_value=[{'vis': 1}])
+    uuids = ['uuid-%d' % i for i in range(6)]
+    assert vis_indexer.update_objects(mocker.Mock(), uuids, 100) == []
+    # One search per chunk, uuid-3 fetched on its own
+    assert vis_indexer.es.search.call_count == 2
+    vis_indexer.esstorage.get_by_uuid.assert_called_once_with('uuid-3')
+    assert [c[0][1]['accession'] for c in vis_cache_add.call_args_list] == [
+        'ENCSR%03dAAA' % i for i in range(6)]
+    assert [c[0][0] for c in vis_indexer.state.viscached_uuids.call_args_list] == [uuids[:4], uuids[4:]]
+    assert not vis_indexer.state.viscached_uuid.called
+
+
+def test_vis_indexer_pool_results_go_to_one_writer(vis_indexer, mocker):
+    import encoded.vis_indexer as vis_indexer_module
+    vis_indexer.processes = 2
+    pool = mocker.Mock()
+    pool.imap_unordered.side_effect = lambda func, tasks, chunksize: [
+        (uuid, [(doc['accession'] + '_GRCh38', {} if uuid == 'uuid-1' else {'doc': doc['accession']})])
+        for (uuid, doc) in reversed(tasks)]
+    vis_indexer.__dict__['pool'] = pool
+    uuids = ['uuid-%d' % i for i in range(4)]
+    assert vis_indexer.update_objects(mocker.Mock(), uuids, 100) == []
+    vis_cache = vis_indexer_module.VisCache.return_value
+    assert sorted(c[0][0] for c in vis_cache.add.call_args_list) == [
+        'ENCSR%03dAAA_GRCh38' % i for i in range(4)]
+    # Empty vis_blobs are written but the dataset isn't counted as vis cached
+    vis_indexer.state.viscached_uuids.assert_called_once_with(['uuid-3', 'uuid-2', 'uuid-0'])
+    assert vis_cache.flush.called
+
+
+def test_vis_indexer_missing_doc_is_an_error(vis_indexer, mocker):
+    import encoded.vis_indexer as vis_indexer_module
+    mocker.patch.object(vis_indexer_module, 'vis_cache_add', return_value=[])
+    vis_indexer.esstorage.get_by_uuid.side_effect = KeyError('uuid-3')
+    errors = vis_indexer.update_objects(mocker.Mock(), ['uuid-2', 'uuid-3'], 100)
+    assert [error['uuid'] for error in errors] == ['uuid-3']
+    vis_indexer.state.viscached_uuids.assert_called_once_with([])
+
+
+def test_vis_indexer_failed_writes_not_counted(vis_indexer, mocker):
+    import encoded.vis_indexer as vis_indexer_module
+    mocker.patch.object(vis_indexer_module, 'vis_cache_add', return_value=[{'vis': 1}])
+    vis_cache = vis_indexer_module.VisCache.return_value
+    vis_cache.flush.return_value = ['ENCSR001AAA_GRCh38']
+    assert vis_indexer.update_objects(mocker.Mock(), ['uuid-0', 'uuid-1', 'uuid-2'], 100) == []
+    vis_indexer.state.viscached_uuids.assert_called_once_with(['uuid-0', 'uuid-2'])
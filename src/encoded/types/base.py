@@ -26,6 +26,7 @@ from snovault import (
     AfterModified,
     BeforeModified
 )
+from ..object_cache import item_properties
 
 
 @lru_cache()
@@ -114,15 +115,17 @@ STATUS_HIERARCHY = {
 
 
 def paths_filtered_by_status(request, paths, exclude=('deleted', 'replaced'), include=None):
+    paths = list(paths)
+    properties = item_properties(request, paths)
     if include is not None:
         return [
             path for path in paths
-            if traverse(request.root, path)['context'].__json__(request).get('status') in include
+            if properties[path].get('status') in include
         ]
     else:
         return [
             path for path in paths
-            if traverse(request.root, path)['context'].__json__(request).get('status') not in exclude
+            if properties[path].get('status') not in exclude
         ]
 
 
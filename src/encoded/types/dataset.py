@@ -8,6 +8,7 @@ from .base import (
     Item,
     paths_filtered_by_status,
 )
+from ..object_cache import item_properties
 
 from urllib.parse import quote_plus
 from urllib.parse import urljoin
@@ -26,22 +27,33 @@ from itertools import chain
 import datetime
 
 
-def item_is_revoked(request, path):
-    return request.embed(path, '@@object?skip_calculated=true').get('status') == 'revoked'
+def paths_revoked(request, paths):
+    paths = list(paths)
+    properties = item_properties(request, paths)
+    return [
+        path for path in paths
+        if properties[path].get('status') == 'revoked'
+    ]
 
 
 def calculate_assembly(request, files_list, status):
     assembly = set()
     viewable_file_status = ['released','in progress']
 
-    for path in files_list:
-        properties = request.embed(path, '@@object?skip_calculated=true')
-        if properties['status'] in viewable_file_status:
+    for properties in item_properties(request, files_list).values():
+        if properties.get('status') in viewable_file_status:
             if 'assembly' in properties:
                 assembly.add(properties['assembly'])
     return list(assembly)
 
 
+def calculate_derived_from(request, files):
+    derived_from = set()
+    for properties in item_properties(request, files).values():
+        derived_from.update(properties.get('derived_from', []))
+    return set(paths_filtered_by_status(request, derived_from))
+
+
 @abstract_collection(
     name='datasets',
     unique_key='accession',
@@ -111,12 +123,7 @@ class Dataset(Item):
         },
     })
     def contributing_files(self, request, original_files, status):
-        derived_from = set()
-        for path in original_files:
-            properties = request.embed(path, '@@object?skip_calculated=true')
-            derived_from.update(
-                paths_filtered_by_status(request, properties.get('derived_from', []))
-            )
+        derived_from = calculate_derived_from(request, original_files)
         outside_files = list(derived_from.difference(original_files))
         if status in ('released'):
             return paths_filtered_by_status(
@@ -158,10 +165,7 @@ class Dataset(Item):
         },
     })
     def revoked_files(self, request, original_files):
-        return [
-            path for path in original_files
-            if item_is_revoked(request, path)
-        ]
+        return paths_revoked(request, original_files)
 
     @calculated_property(define=True, schema={
         "title": "Assembly",
@@ -204,12 +208,7 @@ class FileSet(Dataset):
     })
     def contributing_files(self, request, original_files, related_files, status):
         files = set(original_files + related_files)
-        derived_from = set()
-        for path in files:
-            properties = request.embed(path, '@@object?skip_calculated=true')
-            derived_from.update(
-                paths_filtered_by_status(request, properties.get('derived_from', []))
-            )
+        derived_from = calculate_derived_from(request, files)
         outside_files = list(derived_from.difference(files))
         if status in ('released'):
             return paths_filtered_by_status(
@@ -251,10 +250,7 @@ class FileSet(Dataset):
         },
     })
     def revoked_files(self, request, original_files, related_files):
-        return [
-            path for path in chain(original_files, related_files)
-            if item_is_revoked(request, path)
-        ]
+        return paths_revoked(request, chain(original_files, related_files))
 
     @calculated_property(define=True, schema={
         "title": "Assembly",
@@ -536,10 +532,7 @@ class Series(Dataset, CalculatedSeriesAssay, CalculatedSeriesBiosample, Calculat
         },
     })
     def revoked_datasets(self, request, related_datasets):
-        return [
-            path for path in related_datasets
-            if item_is_revoked(request, path)
-        ]
+        return paths_revoked(request, related_datasets)
 
     @calculated_property(define=True, schema={
         "title": "Assembly",
@@ -229,7 +229,7 @@ class Experiment(Dataset,
                                             if tag.get('promoter_used'):
                                                 tag_dict['promoter'] = request.embed(
                                                     tag.get('promoter_used'),
-                                                            '@@object').get['label']
+                                                            '@@object').get('label')
                                             modification_dict['tags'].append(tag_dict)
 
                                     modifications_list.append((gm_object['method'], modification_dict))
@@ -16,6 +16,7 @@ AuditView<-MatrixView<-BaseView
 """
 import copy
 
+from encoded.aggregation_cache import cached_search
 from encoded.helpers.helper import search_result_actions
 from encoded.viewconfigs.matrix import MatrixView
 
@@ -339,7 +340,11 @@ class AuditView(MatrixView):  #pylint: disable=too-few-public-methods
             self._view_item.tabular_report
         ]
         query, audit_field_list, used_filters = self._construct_query()
-        es_results = self._elastic_search.search(body=query, index=self._es_index)
+        es_results = cached_search(
+            self._request,
+            self._view_name,
+            lambda: self._elastic_search.search(body=query, index=self._es_index)
+        )
         aggregations = es_results['aggregations']
         total = aggregations['matrix']['doc_count']
         self._result['matrix']['doc_count'] = total
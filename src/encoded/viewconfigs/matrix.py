@@ -8,8 +8,11 @@ MatrixView<-BaseView
 ### BaseView function dependencies
 - _format_facets
 """
+import copy
+
 from pyramid.httpexceptions import HTTPBadRequest  # pylint: disable=import-error
 
+from encoded.aggregation_cache import cached_search
 from encoded.helpers.helper import (
     search_result_actions,
     View_Item)
@@ -197,7 +200,8 @@ class MatrixView(BaseView):  #pylint: disable=too-few-public-methods
                 type_info = self._types[self._doc_types[0]]
                 self._schema = type_info.schema
         self._validate_items(type_info)
-        matrix = type_info.factory.matrix.copy()
+        # deepcopy so limits and buckets of this request don't end up in type_info.factory.matrix
+        matrix = copy.deepcopy(type_info.factory.matrix)
         matrix['x']['limit'] = self._request.params.get('x.limit', 20)
         matrix['y']['limit'] = self._request.params.get('y.limit', 5)
         search_route = self._request.route_path('search', slash='/')
@@ -211,9 +215,10 @@ class MatrixView(BaseView):  #pylint: disable=too-few-public-methods
             result_filters,
             matrix_x_y
         )
-        es_results = self._elastic_search.search(
-            body=search_query,
-            index=self._es_index
+        es_results = cached_search(
+            self._request,
+            self._view_name,
+            lambda: self._elastic_search.search(body=search_query, index=self._es_index)
         )
         aggregations = es_results['aggregations']
         aggregations_total = aggregations['matrix']['doc_count']
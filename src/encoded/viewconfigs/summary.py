@@ -10,8 +10,10 @@ SummaryView<-MatrixView<-BaseView
 ### BaseView function dependencies
 - _format_facets
 """
+import copy
 from urllib.parse import urlencode
 
+from encoded.aggregation_cache import cached_search
 from encoded.viewconfigs.matrix import MatrixView
 
 from snovault.helpers.helper import (  # pylint: disable=import-error
@@ -145,7 +147,7 @@ class SummaryView(MatrixView):  #pylint: disable=too-few-public-methods
                 self._schema = type_info.schema
         self._validate_items(type_info)
         self._result['title'] = type_info.name + ' summary'
-        self._result['summary'] = type_info.factory.summary_data.copy()
+        self._result['summary'] = copy.deepcopy(type_info.factory.summary_data)
         self._summary = self._result['summary']
         search_route = self._request.route_path('search', slash='/')
         self._summary['search_base'] = search_route + self._search_base
@@ -161,7 +163,11 @@ class SummaryView(MatrixView):  #pylint: disable=too-few-public-methods
         clear_qs_str = ('?' + clear_qs) if clear_qs else ''
         self._result['clear_filters'] = summary_route + clear_qs_str
         query, used_filters = self._construct_query()
-        es_results = self._elastic_search.search(body=query, index=self._es_index)
+        es_results = cached_search(
+            self._request,
+            self._view_name,
+            lambda: self._elastic_search.search(body=query, index=self._es_index)
+        )
         aggregations = es_results['aggregations']
         total = aggregations['summary']['doc_count']
         self._result['summary']['doc_count'] = total
@@ -47,6 +47,7 @@ def includeme(config):
     config.add_route('news', '/news/')
     config.add_route('audit', '/audit/')
     config.add_route('summary', '/summary{slash:/?}')
+    config.include('encoded.aggregation_cache')
     config.scan(__name__)
 
 
@@ -2,15 +2,24 @@ from pyramid.response import Response
 from pyramid.view import view_config
 from pyramid.compat import bytes_
 from snovault import Item
-from collections import OrderedDict
+from collections import (
+    OrderedDict,
+    deque,
+)
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from itertools import islice
 import json
 import os
+import re
 from urllib.parse import (
     parse_qs,
     urlencode,
 )
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import bulk
 from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+import threading
 import time
 from pkg_resources import resource_filename
 
@@ -190,6 +199,15 @@ SIMPLE_DATASET_TOKENS = ["{accession}", "{assay_title}",
 VIS_DEFS_FOLDER = "static/vis_defs/"
 VIS_DEFS_BY_TYPE = {}
 VIS_DEFS_DEFAULT = {}
+VIS_DEF_RULES = []     # (vis_type, rule) in the order get_vis_type tries them
+COMPILED_RULES = {}    # rule => (code, tokens), or None if it has to be masked and eval'd as text
+COMPILED_MASKS = {}    # mask => tuple of (is_token, text) segments
+EMBEDDED_TOKEN_TERMS = {}  # token => list of terms for lookup_embedded_token
+
+# A rule token inside quotes, e.g. '{assay_term_name}' == 'ATAC-seq'
+RULE_TOKEN = re.compile(r"'(\{[^{}']*\})'")
+# A mask token runs from a '{' to the next '}'
+MASK_TOKEN = re.compile(r'\{[^}]*\}')
 
 
 # vis_defs may not have the default experiment group defined
@@ -397,11 +415,34 @@ BIOSAMPLE_COLOR = {
     }
 
 VIS_CACHE_INDEX = "vis_cache"
+VIS_CACHE_EXISTS = False    # Once the vis_cache index is known to exist, it isn't checked again
+VIS_BLOB_LRU = None         # Per-process VisBlobLRU in front of the vis_cache index
+VIS_BLOB_LRU_SIZE = 2000    # vis_blobs, override with the visualization.vis_blob_cache_size setting
+VIS_XMIN_CHECK_SECONDS = 10
+VIS_CACHE_MGET_SIZE = 500   # vis_blobs fetched per mget
+VIS_CACHE_MGET_WORKERS = 4  # mgets in flight at once
+
+
+class _Escapes(dict):
+    # str.translate table for one kind of escaping, filled in as characters are first seen
+    def __init__(self, escape_char, exceptions, htmlize=False, numeralize=False):
+        super(_Escapes, self).__init__()
+        self.escape = lambda c: escape_char(c, exceptions, htmlize=htmlize, numeralize=numeralize)
+
+    def __missing__(self, n):
+        escaped = self[n] = self.escape(chr(n))
+        return escaped
 
 
 class Sanitize(object):
     # Tools for sanitizing labels
 
+    def __init__(self):
+        self._label = _Escapes(self.escape_char, [' ', '_', '.', '-', '(', ')', '+'], htmlize=False)
+        self._title = _Escapes(self.escape_char, ['_', '.', '-', '(', ')', '+'], htmlize=True)
+        self._tag = _Escapes(self.escape_char, ['_'], numeralize=True)
+        self._name = _Escapes(self.escape_char, ['_'])
+
     def escape_char(self, c, exceptions=['_'], htmlize=False, numeralize=False):
         '''Pass through for 0-9,A-Z.a-z,_, but then either html encodes, numeralizes or removes special
         characters.'''
@@ -425,40 +466,84 @@ class Sanitize(object):
 
     def label(self, s):
         '''Encodes the string to swap special characters and leaves spaces alone.'''
-        new_s = ""      # longLabel and shorLabel can have spaces and some special characters
-        for c in s:
-            new_s += self.escape_char(c, [' ', '_', '.', '-', '(', ')', '+'], htmlize=False)
-        return new_s
+        # longLabel and shorLabel can have spaces and some special characters
+        return s.translate(self._label)
 
     def title(self, s):
         '''Encodes the string to swap special characters and replace spaces with '_'.'''
-        new_s = ""      # Titles appear in tag=title pairs and cannot have spaces
-        for c in s:
-            new_s += self.escape_char(c, ['_', '.', '-', '(', ')', '+'], htmlize=True)
-        return new_s
+        # Titles appear in tag=title pairs and cannot have spaces
+        return s.translate(self._title)
 
     def tag(self, s):
         '''Encodes the string to swap special characters and remove spaces.'''
-        new_s = ""
-        first = True
-        for c in s:
-            new_s += self.escape_char(c, numeralize=True)
-            if first:
-                if new_s.isdigit():  # tags cannot start with digit.
-                    new_s = 'z' + new_s
-                first = False
-        return new_s
+        if not s:
+            return ""
+        first = s[0].translate(self._tag)
+        if first.isdigit():  # tags cannot start with digit.
+            first = 'z' + first
+        return first + s[1:].translate(self._tag)
 
     def name(self, s):
         '''Encodes the string to remove special characters swap spaces for underscores.'''
-        new_s = ""
-        for c in s:
-            new_s += self.escape_char(c)
-        return new_s
+        return s.translate(self._name)
 
 sanitize = Sanitize()
 
 
+def compile_rule(rule):
+    '''Compiles a vis_def rule once.  Quoted {token}s become variables, so looked up values
+       are never parsed as code.  Returns (code, tokens), or None if the rule can only be masked
+       and eval'd as text.'''
+    if rule in COMPILED_RULES:
+        return COMPILED_RULES[rule]
+    tokens = []
+
+    def variable(match):
+        tokens.append(match.group(1))
+        return '_token%d' % (len(tokens) - 1)
+
+    source = RULE_TOKEN.sub(variable, rule)
+    compiled = None
+    if source.find('{') == -1:
+        try:
+            compiled = (compile(source, '<vis_def rule>', 'eval'), tuple(tokens))
+        except SyntaxError:
+            log.warn("vis_def rule could not be compiled: %s" % rule)
+    COMPILED_RULES[rule] = compiled
+    return compiled
+
+
+def compile_mask(mask):
+    '''Splits a mask into (is_token, text) segments of literal text and {token}s, once.'''
+    template = COMPILED_MASKS.get(mask)
+    if template is None:
+        template = []
+        pos = 0
+        for match in MASK_TOKEN.finditer(mask):
+            if match.start() > pos:
+                template.append((False, mask[pos:match.start()]))
+            template.append((True, match.group()))
+            pos = match.end()
+        if pos < len(mask):
+            template.append((False, mask[pos:]))
+        template = COMPILED_MASKS[mask] = tuple(template)
+    return template
+
+
+def vis_def_masks(obj):
+    '''Yields every *_mask and *Label string with {tokens} in vis_defs.'''
+    if isinstance(obj, dict):
+        for (key, val) in obj.items():
+            if isinstance(val, str):
+                if (key.endswith('_mask') or key.endswith('Label')) and val.find('{') != -1:
+                    yield val
+            else:
+                yield from vis_def_masks(val)
+    elif isinstance(obj, list):
+        for val in obj:
+            yield from vis_def_masks(val)
+
+
 class VisDefines(object):
     # Loads vis_def static files and other defines for vis formatting
     # This class is also a swiss army knife of vis formatting conversions
@@ -496,6 +581,16 @@ class VisDefines(object):
         VIS_DEFS_DEFAULT = self.vis_defs.get("opaque",{})
         self.vis_def_default = VIS_DEFS_DEFAULT
 
+        # Compile rules and masks now rather than for each dataset
+        del VIS_DEF_RULES[:]
+        for vis_type in sorted(self.vis_defs.keys(), reverse=True):  # Reverse pushes anno to bottom
+            rule = self.vis_defs[vis_type].get("rule")
+            if rule is not None:
+                compile_rule(rule)
+                VIS_DEF_RULES.append((vis_type, rule))
+        for mask in vis_def_masks(self.vis_defs):
+            compile_mask(mask)
+
     def get_vis_type(self):
         '''returns the best visualization definition type, based upon dataset.'''
         assert(self.dataset is not None)
@@ -510,14 +605,10 @@ class VisDefines(object):
                 return "opaque"
 
         # simple rule defined in most vis_defs
-        for vis_type in sorted(self.vis_defs.keys(), reverse=True):  # Reverse pushes anno to bottom
-            if "rule" in self.vis_defs[vis_type]:
-                rule = self.vis_defs[vis_type]["rule"].replace('{assay_term_name}', assay)
-                if rule.find('{') != -1:
-                    rule = self.convert_mask(rule)
-                if eval(rule):
-                    self.vis_type = vis_type
-                    return self.vis_type
+        for (vis_type, rule) in VIS_DEF_RULES:
+            if self.rule_matches(rule, assay):
+                self.vis_type = vis_type
+                return self.vis_type
 
         # Ugly rules:
         vis_type = None
@@ -578,6 +669,23 @@ class VisDefines(object):
         self.vis_type = vis_type
         return self.vis_type
 
+    def rule_matches(self, rule, assay):
+        '''Evaluates a vis_def rule for this dataset.'''
+        compiled = compile_rule(rule)
+        if compiled is None:
+            rule = rule.replace('{assay_term_name}', assay)
+            if rule.find('{') != -1:
+                rule = self.convert_mask(rule)
+            return eval(rule)
+        (code, tokens) = compiled
+        values = {}
+        for (ix, token) in enumerate(tokens):
+            if token == '{assay_term_name}':
+                values['_token%d' % ix] = assay
+            else:
+                values['_token%d' % ix] = '%s' % (self.lookup_token(token, self.dataset),)
+        return eval(code, {}, values)
+
     def get_vis_def(self, vis_type=None):
         '''returns the visualization definition set, based upon dataset.'''
         if vis_type is None:
@@ -703,15 +811,17 @@ class VisDefines(object):
 
     def lookup_embedded_token(self, name, obj):
         '''Encodes the string to swap special characters and remove spaces.'''
-        token = ENCODED_DATASET_EMBEDDED_TERMS.get(name, name)
-        if token[0] == '{' and token[-1] == '}':
-            token = token[1:-1]
-        terms = token.split('.')
+        terms = EMBEDDED_TOKEN_TERMS.get(name)
+        if terms is None:
+            token = ENCODED_DATASET_EMBEDDED_TERMS.get(name, name)
+            if token[0] == '{' and token[-1] == '}':
+                token = token[1:-1]
+            terms = EMBEDDED_TOKEN_TERMS[name] = token.split('.')
         cur_obj = obj
-        while len(terms) > 0:
-            term = terms.pop(0)
+        last = len(terms) - 1
+        for (ix, term) in enumerate(terms):
             cur_obj = cur_obj.get(term)
-            if len(terms) == 0 or cur_obj is None:
+            if ix == last or cur_obj is None:
                 return cur_obj
             if isinstance(cur_obj,list):
                 if len(cur_obj) == 0:
@@ -857,27 +967,15 @@ class VisDefines(object):
 
     def convert_mask(self, mask, dataset=None, a_file=None):
         '''Given a mask with one or more known {term_name}s, replaces with values.'''
-        working_on = mask
         # dataset might not be self.dataset
         if dataset is None:
             dataset = self.dataset
-        chars = len(working_on)
-        while chars > 0:
-            beg_ix = working_on.find('{')
-            if beg_ix == -1:
-                break
-            end_ix = working_on.find('}')
-            if end_ix == -1:
-                break
-            term = self.lookup_token(working_on[beg_ix:end_ix+1], dataset, a_file=a_file)
-            new_mask = []
-            if beg_ix > 0:
-                new_mask = working_on[0:beg_ix]
-            new_mask += "%s%s" % (term, working_on[end_ix+1:])
-            chars = len(working_on[end_ix+1:])
-            working_on = ''.join(new_mask)
-
-        return working_on
+        converted = []
+        for (is_token, text) in compile_mask(mask):
+            if is_token:
+                text = '%s' % (self.lookup_token(text, dataset, a_file=a_file),)
+            converted.append(text)
+        return ''.join(converted)
 
     def ucsc_single_composite_trackDb(self, vis_format, title):
         '''Given a single vis_format (vis_dataset or vis_by_type dict, returns single UCSC trackDb composite text'''
@@ -1443,13 +1541,96 @@ class IhecDefines(object):
 
 
 # TODO: move to separate vis_cache module?
+def vis_indexer_xmin(es, index):
+    '''Returns the xmin of the vis indexer's last completed cycle, or None if there isn't one.'''
+    try:
+        state = es.get(index=index, doc_type='meta', id='vis_indexer')['_source']
+    except Exception:
+        return None
+    xmin = state.get('xmin') if state.get('status') == 'done' else state.get('last_xmin')
+    if xmin is None or int(xmin) <= 0:
+        return None
+    return xmin
+
+
+class VisBlobLRU(object):
+    # Per-process LRU of vis_blobs (or None for known misses) by vis_id.  Everything is dropped
+    # when the vis indexer completes another cycle, checked at most every VIS_XMIN_CHECK_SECONDS.
+    # vis_blobs are kept as json, so callers remodelling them in place never change the cache.
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.xmin = None
+        self.checked = 0
+
+    def current(self, es, index):
+        '''Returns True if entries are valid for the vis indexer's latest cycle.'''
+        now = time.time()
+        if now - self.checked >= VIS_XMIN_CHECK_SECONDS:
+            xmin = vis_indexer_xmin(es, index)
+            with self.lock:
+                self.checked = now
+                if xmin != self.xmin:
+                    self.entries.clear()
+                    self.xmin = xmin
+        # Without a completed vis indexer cycle there is nothing to invalidate on
+        return self.xmin is not None
+
+    def get(self, vis_id):
+        '''Returns (found, vis_blob), with a fresh copy of the vis_blob.'''
+        with self.lock:
+            if vis_id not in self.entries:
+                return (False, None)
+            self.entries.move_to_end(vis_id)
+            body = self.entries[vis_id]
+        if body is None:
+            return (True, None)
+        return (True, json.loads(body))
+
+    def put(self, vis_id, vis_blob):
+        body = None if vis_blob is None else json.dumps(vis_blob)
+        with self.lock:
+            self.entries[vis_id] = body
+            self.entries.move_to_end(vis_id)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def discard(self, vis_ids):
+        with self.lock:
+            for vis_id in vis_ids:
+                self.entries.pop(vis_id, None)
+
+
+def vis_blob_lru(registry):
+    '''Returns this process's VisBlobLRU, or None if it is turned off.'''
+    global VIS_BLOB_LRU
+    if VIS_BLOB_LRU is None:
+        settings = getattr(registry, 'settings', {})
+        VIS_BLOB_LRU = VisBlobLRU(int(settings.get('visualization.vis_blob_cache_size', VIS_BLOB_LRU_SIZE)))
+    if VIS_BLOB_LRU.capacity <= 0:
+        return None
+    return VIS_BLOB_LRU
+
+
 class VisCache(object):
     # Stores and recalls vis_dataset formatted json to/from es vis_cache
+    # With a batch_size, add() buffers vis_blobs for bulk writes until flush()
 
-    def __init__(self, request):
+    def __init__(self, request, batch_size=None):
         self.request = request
         self.es = self.request.registry.get(ELASTIC_SEARCH, None)
         self.index = VIS_CACHE_INDEX
+        self.batch_size = batch_size
+        self.pending = []
+        self.failed = []  # vis_ids that failed in writes add() set off, reported by the next flush()
+        self.lru = None
+        if self.es:
+            lru = vis_blob_lru(self.request.registry)
+            state_index = getattr(self.request.registry, 'settings', {}).get('snovault.elasticsearch.index')
+            if lru is not None and state_index and lru.current(self.es, state_index):
+                self.lru = lru
 
     def create_cache(self):
         if not self.es:
@@ -1461,44 +1642,141 @@ class VisCache(object):
             self.es.indices.put_mapping(index=self.index, doc_type='default', body=mapping)
             log.debug("created %s index" % self.index)
 
+    def ensure_cache(self):
+        global VIS_CACHE_EXISTS
+        if not VIS_CACHE_EXISTS:
+            self.create_cache()  # Only bother creating on add
+            VIS_CACHE_EXISTS = True
+
     def add(self, vis_id, vis_dataset):
         '''Adds a vis_dataset (aka vis_blob) json object to elastic-search'''
         if not self.es:
             return
-        if not self.es.indices.exists(self.index):
-            self.create_cache()  # Only bother creating on add
+        if self.lru is not None:
+            self.lru.put(vis_id, vis_dataset)
+        if self.batch_size:
+            self.pending.append({
+                '_index': self.index,
+                '_type': 'default',
+                '_id': vis_id,
+                '_source': vis_dataset,
+            })
+            if len(self.pending) >= self.batch_size:
+                self.failed.extend(self.write_pending())
+            return
+        self.ensure_cache()
 
         self.es.index(index=self.index, doc_type='default', body=vis_dataset, id=vis_id)
 
+    def flush(self):
+        '''Writes buffered vis_blobs to elastic-search in one bulk request.  Returns vis_ids that failed,
+           including any from writes since the last flush.'''
+        failed = self.failed + self.write_pending()
+        self.failed = []
+        return failed
+
+    def write_pending(self):
+        '''Bulk writes the buffered vis_blobs.  Failures are logged, dropped from the LRU and returned.'''
+        global VIS_CACHE_EXISTS
+        if not self.pending:
+            return []
+        self.ensure_cache()
+        (actions, self.pending) = (self.pending, [])
+        try:
+            (_, errors) = bulk(self.es, actions, raise_on_error=False, request_timeout=60)
+        except Exception as e:
+            log.error("Failed to write %d vis_blobs" % len(actions), exc_info=True)
+            if isinstance(e, NotFoundError):
+                VIS_CACHE_EXISTS = False  # Dropped: create it again, with its mapping
+            failed = [action['_id'] for action in actions]
+        else:
+            failed = []
+            for error in errors:
+                info = list(error.values())[0]
+                failed.append(info.get('_id'))
+                if 'index_not_found' in str(info.get('error')):
+                    VIS_CACHE_EXISTS = False
+            if failed:
+                log.error("Failed to write %d vis_blobs: %s" % (len(failed), ', '.join(failed[:10])))
+        if failed and self.lru is not None:
+            self.lru.discard(failed)  # es never stored them
+        return failed
+
     def get(self, vis_id=None, accession=None, assembly=None):
         '''Returns the vis_dataset json object from elastic-search, or None if not found.'''
         if vis_id is None and accession is not None and assembly is not None:
             vis_id = accession + '_' + ASSEMBLY_TO_UCSC_ID.get(assembly, assembly)
+        if self.lru is not None:
+            (found, vis_blob) = self.lru.get(vis_id)
+            if found:
+                return vis_blob
         if self.es:
             try:
                 result = self.es.get(index=self.index, doc_type='default', id=vis_id)
-                return result['_source']
+                vis_blob = result['_source']
             except:
-                pass  # Missing index will return None
+                vis_blob = None  # Missing index will return None
+            if self.lru is not None:
+                self.lru.put(vis_id, vis_blob)
+            return vis_blob
         return None
 
     def search(self, accessions, assembly):
-        '''Returns a list of composites from elastic-search, or None if not found.'''
-        if self.es:
-            ucsc_assembly = ASSEMBLY_TO_UCSC_ID.get(assembly, assembly)  # Normalized accession
-            vis_ids = [accession + "_" + ucsc_assembly for accession in accessions]
+        '''Returns a dict of composites from elastic-search (any not found are left out).'''
+        results = {}
+        for chunk in self.search_chunks(accessions, assembly):
+            results.update((vis_id, vis_blob) for (vis_id, vis_blob) in chunk.items() if vis_blob is not None)
+        log.debug("ids found: %d" % (len(results)))
+        return results
+
+    def fetch_chunk(self, vis_ids):
+        '''Returns {vis_id: composite or None} for vis_ids, from the LRU or one mget.
+           Only touches es and the LRU, so it may run off the request's thread.'''
+        chunk = OrderedDict.fromkeys(vis_ids)
+        missing = vis_ids
+        if self.lru is not None:
+            missing = []
+            for vis_id in vis_ids:
+                (found, vis_blob) = self.lru.get(vis_id)
+                if found:
+                    chunk[vis_id] = vis_blob
+                else:
+                    missing.append(vis_id)
+        if missing:
             try:
-                query = {"query": {"ids": {"values": vis_ids}}}
-                res = self.es.search(body=query, index=self.index, doc_type='default', size=99999)  # size=200?
-                hits = res.get("hits", {}).get("hits", [])
-                results = {}
-                for hit in hits:
-                    results[hit["_id"]] = hit["_source"]  # make this a generator? No... len(results)
-                log.debug("ids found: %d" % (len(results)))
-                return results
-            except:
-                pass
-        return {}
+                res = self.es.mget(index=self.index, doc_type='default', body={'ids': missing})
+                for doc in res.get('docs', []):
+                    if doc.get('found'):
+                        chunk[doc['_id']] = doc['_source']
+            except Exception:
+                return chunk  # Missing index: nothing is cached, don't remember the misses
+            if self.lru is not None:
+                for vis_id in missing:
+                    self.lru.put(vis_id, chunk[vis_id])
+        return chunk
+
+    def search_chunks(self, accessions, assembly, chunk_size=VIS_CACHE_MGET_SIZE):
+        '''Yields {vis_id: composite or None} for chunk_size accessions at a time, in the order given.
+           Up to VIS_CACHE_MGET_WORKERS mgets are in flight at once.'''
+        if not self.es:
+            return
+        ucsc_assembly = ASSEMBLY_TO_UCSC_ID.get(assembly, assembly)  # Normalized accession
+        chunks = iter([
+            [accession + "_" + ucsc_assembly for accession in accessions[start:start + chunk_size]]
+            for start in range(0, len(accessions), chunk_size)
+        ])
+        with ThreadPoolExecutor(max_workers=VIS_CACHE_MGET_WORKERS) as pool:
+            pending = deque(pool.submit(self.fetch_chunk, vis_ids)
+                            for vis_ids in islice(chunks, VIS_CACHE_MGET_WORKERS))
+            try:
+                while pending:
+                    chunk = pending.popleft().result()
+                    for vis_ids in islice(chunks, 1):
+                        pending.append(pool.submit(self.fetch_chunk, vis_ids))
+                    yield chunk
+            finally:
+                for future in pending:
+                    future.cancel()
 
 
 # Not referenced in any other module
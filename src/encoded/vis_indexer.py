@@ -4,13 +4,20 @@ from elasticsearch.exceptions import (
     NotFoundError,
     TransportError,
 )
+from multiprocessing import get_context
+from multiprocessing.pool import Pool
+from pyramid.decorator import reify
+from pyramid.request import apply_request_extensions
+from pyramid.threadlocal import manager
 from pyramid.view import view_config
 from sqlalchemy.exc import StatementError
 
 from urllib3.exceptions import ReadTimeoutError
 from snovault.elasticsearch.interfaces import (
+    APP_FACTORY,
     ELASTIC_SEARCH,
     INDEXER,
+    RESOURCES_INDEX,
 )
 import datetime
 import logging
@@ -34,13 +41,18 @@ from snovault.elasticsearch.indexer_state import (
 
 from .vis_defines import (
     VISIBLE_DATASET_TYPES_LC,
-    VIS_CACHE_INDEX
+    VIS_CACHE_INDEX,
+    VisCache,
 )
 from .visualization import vis_cache_add
 
 
 log = logging.getLogger(__name__)
 
+VIS_BLOBS_BATCH_SIZE = 500  # vis_blobs buffered per bulk write
+VIS_PREFETCH_SIZE = 500     # uuids whose es documents are fetched per search
+VIS_POOL_CHUNKSIZE = 10     # datasets handed to a pool worker at a time
+
 
 def includeme(config):
     config.add_route('index_vis', '/index_vis')
@@ -48,7 +60,7 @@ def includeme(config):
     config.scan(__name__)
     registry = config.registry
     is_vis_indexer = registry.settings.get('visindexer')
-    if is_vis_indexer:
+    if is_vis_indexer and not registry.settings.get('indexer_worker'):
         registry['vis'+INDEXER] = VisIndexer(registry)
 
 class VisIndexerState(IndexerState):
@@ -69,6 +81,10 @@ class VisIndexerState(IndexerState):
     def viscached_uuid(self, uuid):
         self.list_extend(self.viscached_set, [uuid])
 
+    def viscached_uuids(self, uuids):
+        if uuids:
+            self.list_extend(self.viscached_set, uuids)
+
     def get_one_cycle(self, xmin, request):
         uuids = []
         next_xmin = None
@@ -245,6 +261,58 @@ def all_visualizable_uuids(registry):
     return list(all_uuids(registry, types=VISIBLE_DATASET_TYPES_LC))
 
 
+# Running in subprocess
+
+vis_app = None
+
+
+def vis_initializer(app_factory, settings):
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    global vis_app
+    vis_app = app_factory(settings, indexer_worker=True, create_tables=False)
+
+
+class VisBlobCollector(object):
+    # Stands in for VisCache in pool workers: vis_blobs go back to the single writer in the main process
+
+    def __init__(self):
+        self.vis_blobs = []
+
+    def get(self, vis_id=None, accession=None, assembly=None):
+        return None
+
+    def add(self, vis_id, vis_dataset):
+        self.vis_blobs.append((vis_id, vis_dataset))
+
+
+def build_vis_blobs(args):
+    '''Builds the vis_blobs of one embedded dataset.  Returns (uuid, [(vis_id, vis_blob),...]).'''
+    uuid, embedded = args
+    registry = vis_app.registry
+    request = vis_app.request_factory.blank('/_vis_indexing_pool')
+    request.registry = registry
+    request.datastore = 'elasticsearch'
+    apply_request_extensions(request)
+    request.invoke_subrequest = vis_app.invoke_subrequest
+    request.root = vis_app.root_factory(request)
+    request._stats = {}
+    collector = VisBlobCollector()
+    manager.push({'request': request, 'registry': registry})
+    try:
+        vis_cache_add(request, embedded, is_vis_indexer=True, vis_cache=collector)
+    except Exception:
+        log.error('Error indexing %s', uuid, exc_info=True)
+        pass  # It's only a vis_blob.
+    finally:
+        manager.pop()
+    return (uuid, collector.vis_blobs)
+
+
+# Running in main process
+
+
 class VisIndexer(Indexer):
     def __init__(self, registry):
         super(VisIndexer, self).__init__(registry)
@@ -252,55 +320,122 @@ class VisIndexer(Indexer):
         self.esstorage = registry[STORAGE]
         self.index = registry.settings['snovault.elasticsearch.index']
         self.state = VisIndexerState(self.es, self.index)  # WARNING, race condition is avoided because there is only one worker
+        # With more than one process, vis_blobs are built by a pool while this process fetches and writes
+        self.processes = int(registry.settings.get('visindexer.processes', 1))
+        self.initargs = (registry.get(APP_FACTORY), registry.settings,)
+
+    @reify
+    def pool(self):
+        return Pool(
+            processes=self.processes,
+            initializer=vis_initializer,
+            initargs=self.initargs,
+            context=get_context('forkserver'),
+        )
 
     def get_from_es(request, comp_id):
         '''Returns composite json blob from elastic-search, or None if not found.'''
         return None
 
-    def update_objects(self, request, uuids, xmin):
-        # pylint: disable=too-many-arguments, unused-argument
-        '''Run indexing process on uuids'''
-        errors = []
-        for i, uuid in enumerate(uuids):
-            error = self.update_object(request, uuid, xmin)
-            if error is not None:
-                errors.append(error)
-            if (i + 1) % 1000 == 0:
-                log.info('Indexing %d', i + 1)
-        return errors
-
-    def update_object(self, request, uuid, xmin, restart=False):
-
-        last_exc = None
-        # First get the object currently in es
+    def prefetch(self, uuids):
+        '''Returns {uuid: embedded} for those uuids found in es, with one search.'''
+        query = {
+            'query': {'terms': {'uuid': [str(uuid) for uuid in uuids]}},
+            '_source': ['uuid', 'embedded'],
+        }
+        try:
+            res = self.es.search(index=RESOURCES_INDEX, body=query, size=len(uuids), request_timeout=60)
+        except Exception:
+            log.warning('Prefetch of %d uuids failed', len(uuids), exc_info=True)
+            return {}
+        return {hit['_source']['uuid']: hit['_source']['embedded'] for hit in res['hits']['hits']}
+
+    def embedded_doc(self, uuid):
+        '''Returns (embedded, error) for a uuid not prefetched.'''
         try:
             result = self.esstorage.get_by_uuid(uuid)  # No reason to restrict by version and that could interfere with reindex all signal.
             #result = self.es.get(index=self.index, id=str(uuid), version=xmin, version_type='external_gte')
-            doc = result.source
+            return (result.source['embedded'], None)
         except StatementError:
             # Can't reconnect until invalid transaction is rolled back
             raise
         except Exception as e:
             log.error("Error can't find %s in %s", uuid, ELASTIC_SEARCH)
-            last_exc = repr(e)
+            timestamp = datetime.datetime.now().isoformat()
+            return (None, {'error_message': repr(e), 'timestamp': timestamp, 'uuid': str(uuid)})
+
+    def update_objects(self, request, uuids, xmin):
+        # pylint: disable=too-many-arguments, unused-argument
+        '''Run indexing process on uuids'''
+        errors = []
+        vis_cache = VisCache(request, batch_size=VIS_BLOBS_BATCH_SIZE)
+        try:
+            for start in range(0, len(uuids), VIS_PREFETCH_SIZE):
+                chunk = uuids[start:start + VIS_PREFETCH_SIZE]
+                docs = self.prefetch(chunk)
+                viscached = []
+                if self.processes > 1:
+                    errors.extend(self.build_in_pool(chunk, docs, vis_cache, viscached))
+                else:
+                    for uuid in chunk:
+                        error = self.update_object(
+                            request, uuid, xmin, vis_cache=vis_cache, doc=docs.get(str(uuid)), viscached=viscached
+                        )
+                        if error is not None:
+                            errors.append(error)
+                # A dataset whose vis_blobs es didn't store isn't vis cached, and is tried again next cycle
+                failed = set(vis_id.split('_')[0] for vis_id in vis_cache.flush())
+                self.state.viscached_uuids([uuid for (uuid, accession) in viscached if accession not in failed])
+                log.info('Indexing %d', start + len(chunk))
+        finally:
+            vis_cache.flush()
+        return errors
+
+    def build_in_pool(self, uuids, docs, vis_cache, viscached):
+        '''Has the pool build vis_blobs for uuids, writing them as they come back.  Returns errors.'''
+        errors = []
+        tasks = []
+        accessions = {}
+        for uuid in uuids:
+            embedded = docs.get(str(uuid))
+            if embedded is None:
+                (embedded, error) = self.embedded_doc(uuid)
+                if error is not None:
+                    errors.append(error)
+                    continue
+            tasks.append((str(uuid), embedded))
+            accessions[str(uuid)] = embedded['accession']
+        for (uuid, vis_blobs) in self.pool.imap_unordered(build_vis_blobs, tasks, chunksize=VIS_POOL_CHUNKSIZE):
+            for (vis_id, vis_blob) in vis_blobs:
+                vis_cache.add(vis_id, vis_blob)
+            if any(vis_blob for (_, vis_blob) in vis_blobs):
+                viscached.append((uuid, accessions[uuid]))
+        return errors
+
+    def update_object(self, request, uuid, xmin, restart=False, vis_cache=None, doc=None, viscached=None):
+
+        # First get the object currently in es
+        if doc is None:
+            (doc, error) = self.embedded_doc(uuid)
+            if error is not None:
+                return error
 
         ### NOTE: if other work is to be done, this can be renamed "secondary indexer", and work can be added here
 
-        if last_exc is None:
-            try:
-                result = vis_cache_add(
-                    request,
-                    doc['embedded'],
-                    is_vis_indexer=True,
-                )
-                if len(result):
-                    # Warning: potentiallly slow uuid-level accounting, but single process so no concurency issue
+        try:
+            result = vis_cache_add(
+                request,
+                doc,
+                is_vis_indexer=True,
+                vis_cache=vis_cache,
+            )
+            if len(result):
+                if viscached is not None:
+                    # Caller does the accounting for a batch at once, once it knows the writes made it
+                    viscached.append((str(uuid), doc['accession']))
+                else:
                     self.state.viscached_uuid(uuid)
-            except Exception as e:
-                log.error('Error indexing %s', uuid, exc_info=True)
-                #last_exc = repr(e)
-                pass  # It's only a vis_blob.
-
-        if last_exc is not None:
-            timestamp = datetime.datetime.now().isoformat()
-            return {'error_message': last_exc, 'timestamp': timestamp, 'uuid': str(uuid)}
+        except Exception as e:
+            log.error('Error indexing %s', uuid, exc_info=True)
+            #last_exc = repr(e)
+            pass  # It's only a vis_blob.
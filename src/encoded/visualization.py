@@ -1,6 +1,6 @@
+from pyramid.httpexceptions import HTTPNotModified
 from pyramid.response import Response
 from pyramid.view import view_config
-from pyramid.compat import bytes_
 from snovault import Item
 from collections import OrderedDict
 from copy import deepcopy
@@ -19,8 +19,15 @@ from .vis_defines import (
     Sanitize,
     VisDefines,
     IhecDefines,
+    VIS_CACHE_MGET_SIZE,
     VisCache,
-    object_is_visualizable
+    object_is_visualizable,
+    vis_indexer_xmin,
+)
+from .hub_cache import (
+    DEFAULT_MAX_BYTES,
+    HubCache,
+    hub_text,
 )
 import time
 from pkg_resources import resource_filename
@@ -35,6 +42,11 @@ def includeme(config):
     config.add_route('batch_hub', '/batch_hub/{search_params}/{txt}')
     config.add_route('batch_hub:trackdb', '/batch_hub/{search_params}/{assembly}/{txt}')
     config.scan(__name__)
+    max_bytes = int(config.registry.settings.get('visualization.hub_cache_size', DEFAULT_MAX_BYTES))
+    if max_bytes > 0:
+        config.registry[HUB_CACHE] = HubCache(max_bytes)
+
+HUB_CACHE = 'hub_cache'
 
 PROFILE_START_TIME = 0  # For profiling within this module
 
@@ -81,6 +93,7 @@ class VisCollections(object):
         self.vis_by_types = {}   # dict of assay based composites of files from vis_datasets
         self.found = 0
         self.built = 0
+        self.gathered = 0
         self.regen_requested = False
         self.request = request
         self.page_requested = self.request.url.split('/')[-1]
@@ -113,40 +126,68 @@ class VisCollections(object):
 
     def find_or_build(self, accessions, assembly, hide=False, must_build=False):
         self.vis_by_types = {}
+        self.vis_datasets = {}
+        for chunk in self.find_or_build_chunks(accessions, assembly, hide, must_build):
+            self.vis_datasets.update(chunk)
+        return self.vis_datasets
+
+    def find_or_build_chunks(self, accessions, assembly, hide=False, must_build=False):
+        '''Yields {accession: vis_dataset} for accessions (in sorted order) a chunk at a time.
+           As before, those not in the cache are only built when none at all were found.'''
         self.found = 0
         self.built = 0
+        self.gathered = 0
 
         if not must_build:
             (page, suffix, cmd) = urlpage(self.page_requested)
             must_build = (cmd == 'regen')
         self.regen_requested = must_build
 
+        accessions = sorted(set(accessions))
         if not must_build:
-            self.vis_datasets = self.find(accessions, assembly)
-            self.found = self.len()
-            if self.found > 0:
-                accessions = []
+            ucsc_assembly = ASSEMBLY_TO_UCSC_ID.get(assembly, assembly)
+            missing = []
+            for chunk in self.vis_cache.search_chunks(accessions, assembly):
+                vis_datasets = {}
+                for (vis_id, vis_dataset) in chunk.items():
+                    if vis_dataset is None:
+                        missing.append(vis_id[:-(len(ucsc_assembly) + 1)])
+                    else:
+                        vis_datasets[vis_id] = vis_dataset  # As found by vis_cache.search()
+                self.found += len(vis_datasets)
+                if vis_datasets:
+                    self.gathered += len(vis_datasets)
+                    yield vis_datasets
             # Don't bother if cache is primed.
-            # if self.found < (len(accessions) * 3 / 4):  # some heuristic to decide when too few means regenerate
-            #     missing = list(set(accs) - set(self.vis_datasets.keys()))
-
-        if len(accessions) > 0:  # accessions not found in cache... try generating (for pre-primed-cache access)
-            vis_factory = VisDataset(self.request)
-            for accession in accessions:
-                vis_dataset = vis_factory.find_or_build(accession, assembly, dataset=None, hide=hide, must_build=True)
+            if self.found > 0:
+                return
+            accessions = missing
+
+        # accessions not found in cache... try generating (for pre-primed-cache access)
+        for start in range(0, len(accessions), VIS_CACHE_MGET_SIZE):
+            vis_datasets = {}
+            for accession in accessions[start:start + VIS_CACHE_MGET_SIZE]:
+                (accession, vis_dataset, built) = self.build_one(accession, assembly, hide=hide)
                 # vis_dataset could legitimately be {}... no visualizable files.
-                if vis_factory.built:
+                if built:
                     self.built += 1
                 else:
                     self.found += 1  # Not expecting this since find turned up empty!
-                self.add_one(accession, vis_dataset)
-        return self.vis_datasets
+                vis_datasets[accession] = vis_dataset
+            self.gathered += len(vis_datasets)
+            yield vis_datasets
+
+    def build_one(self, accession, assembly, hide=False):
+        '''Builds the vis_dataset for one accession.  Returns (accession, vis_dataset, built).'''
+        vis_factory = VisDataset(self.request, vis_cache=self.vis_cache)
+        vis_dataset = vis_factory.find_or_build(accession, assembly, dataset=None, hide=hide, must_build=True)
+        return (accession, vis_dataset, vis_factory.built)
 
     def found_or_built(self, assays=True):
         if assays:
             return "vis_by_types: %d from %d (%d found, %d built)" % \
-                    (len(self.vis_by_types), len(self.vis_datasets), self.found, self.built)
-        return "%d gathered: %d found, %d built" % (len(self.vis_datasets), self.found, self.built)
+                    (len(self.vis_by_types), self.gathered or len(self.vis_datasets), self.found, self.built)
+        return "%d gathered: %d found, %d built" % (self.gathered or len(self.vis_datasets), self.found, self.built)
 
     def insert_live_group(self, live_groups, new_tag, new_group):
         '''Inserts new group into a set of live groups during remodelling to vis_asset coolections.'''
@@ -185,102 +226,115 @@ class VisCollections(object):
         vis_defines = VisDefines(self.request)
 
         for accession in sorted(self.vis_datasets.keys()):
-            vis_dataset = self.vis_datasets[accession]
-            if vis_dataset is None or len(vis_dataset) == 0:
-                # log.debug("Found empty vis_dataset for %s" % (accession))
-                self.vis_by_types[accession] = {}  # wounded vis_datasets are retained for evidence
-                continue
-
-            # Only show the first n datasets
-            if hide_after is not None:
-                if hide_after <= 0:
-                    for track in vis_dataset.get("tracks", {}):
-                        track["checked"] = "off"
-                else:
-                    hide_after -= 1
-
-            # color must move to tracks because it' i's from biosample and we can mix biosample exps
-            acc_color = vis_dataset.get("color")
-            acc_altColor = vis_dataset.get("altColor")
-            acc_view_groups = vis_dataset.get("view", {}).get("groups", {})
-            for (view_tag, acc_view) in acc_view_groups.items():
-                acc_view_color = acc_view.get("color", acc_color)  # color may be at view level
-                acc_view_altColor = acc_view.get("altColor", acc_altColor)
-                if acc_view_color is None and acc_view_altColor is None:
-                    continue
-                for track in acc_view.get("tracks", []):
-                    if "color" not in track.keys():
-                        if acc_view_color is not None:
-                            track["color"] = acc_view_color
-                        if acc_view_altColor is not None:
-                            track["altColor"] = acc_view_altColor
-
-            # If vis_by_type of this vis_type doesn't exist, create it
-            vis_type = vis_dataset["vis_type"]
-            vis_def = vis_defines.get_vis_def(vis_type)
-
-            assert(vis_type is not None)
-            if vis_type not in self.vis_by_types.keys():  # First one so just drop in place
-                vis_by_type = vis_dataset  # Don't bother with deep copy.
-                set_defs = vis_def.get("assay_composite", {})
-                vis_by_type["name"] = vis_type.lower()  # is there something more elegant?
-                for tag in ["longLabel", "shortLabel", "visibility"]:
-                    if tag in set_defs:
-                        vis_by_type[tag] = set_defs[tag]  # Not expecting any token substitutions!!!
-                vis_by_type['html'] = vis_type
-                self.vis_by_types[vis_type] = vis_by_type
-
-            else:  # Adding an vis_dataset to an existing vis_by_type
-                vis_by_type = self.vis_by_types[vis_type]
-                vis_by_type['composite_type'] = 'set'
-
-                if vis_by_type.get("project", "unknown") != "NHGRI":
-                    acc_pennant = vis_dataset["pennantIcon"]
-                    set_pennant = vis_by_type["pennantIcon"]
-                    if acc_pennant != set_pennant:
-                        vis_by_type["project"] = "NHGRI"
-                        vis_by_type["pennantIcon"] = vis_defines.pennants("NHGRI")
-
-                # combine views
-                set_views = vis_by_type.get("view", [])
-                acc_views = vis_dataset.get("view", {})
-                for view_tag in acc_views["group_order"]:
-                    acc_view = acc_views["groups"][view_tag]
-                    if view_tag not in set_views["groups"].keys():  # Should never happen
-                        # log.debug("Surprise: view %s not found before" % view_tag)
-                        self.insert_live_group(set_views, view_tag, acc_view)
-                    else:  # View is already defined but tracks need to be appended.
-                        set_view = set_views["groups"][view_tag]
-                        if "tracks" not in set_view:
-                            set_view["tracks"] = acc_view.get("tracks", [])
-                        else:
-                            set_view["tracks"].extend(acc_view.get("tracks", []))
-
-                # All tracks in one set: not needed.
-
-                # Combine subgroups:
-                for group_tag in vis_dataset["group_order"]:
-                    acc_group = vis_dataset["groups"][group_tag]
-                    if group_tag not in vis_by_type["groups"].keys():  # Should never happen
-                        # log.debug("Surprise: group %s not found before" % group_tag)
-                        self.insert_live_group(vis_by_type, group_tag, acc_group)
-                    else:  # Need to handle subgroups which definitely may not be there.
-                        set_group = vis_by_type["groups"].get(group_tag, {})
-                        acc_subgroups = acc_group.get("groups", {})
-                        # acc_subgroup_order = acc_group.get("group_order")
-                        for subgroup_tag in acc_subgroups.keys():
-                            if subgroup_tag not in set_group.get("groups", {}).keys():
-                                # Adding biosamples, targets, and reps
-                                self.insert_live_group(set_group, subgroup_tag, acc_subgroups[subgroup_tag])
-
-                # dimensions and filterComposite should not need any extra care:
-                # they get dynamically scaled down during printing
-                # log.debug("       Added.")
+            hide_after = self.remodel_one(vis_defines, accession, self.vis_datasets[accession], hide_after)
 
         if prefix is not None:
             return self.prepend_assay_labels(prefix)
         return self.vis_by_types
 
+    def remodel_chunks(self, chunks, hide_after=None):
+        '''Remodels vis_datasets into vis_by_types as chunks of them arrive, without keeping them.'''
+        self.vis_by_types = {}
+        vis_defines = VisDefines(self.request)
+        for chunk in chunks:
+            for accession in sorted(chunk.keys()):
+                hide_after = self.remodel_one(vis_defines, accession, chunk[accession], hide_after)
+        return self.vis_by_types
+
+    def remodel_one(self, vis_defines, accession, vis_dataset, hide_after=None):
+        '''Remodels one vis_dataset into vis_by_types.  Returns what is left of hide_after.'''
+        if vis_dataset is None or len(vis_dataset) == 0:
+            # log.debug("Found empty vis_dataset for %s" % (accession))
+            self.vis_by_types[accession] = {}  # wounded vis_datasets are retained for evidence
+            return hide_after
+
+        # Only show the first n datasets
+        if hide_after is not None:
+            if hide_after <= 0:
+                for track in vis_dataset.get("tracks", {}):
+                    track["checked"] = "off"
+            else:
+                hide_after -= 1
+
+        # color must move to tracks because it' i's from biosample and we can mix biosample exps
+        acc_color = vis_dataset.get("color")
+        acc_altColor = vis_dataset.get("altColor")
+        acc_view_groups = vis_dataset.get("view", {}).get("groups", {})
+        for (view_tag, acc_view) in acc_view_groups.items():
+            acc_view_color = acc_view.get("color", acc_color)  # color may be at view level
+            acc_view_altColor = acc_view.get("altColor", acc_altColor)
+            if acc_view_color is None and acc_view_altColor is None:
+                continue
+            for track in acc_view.get("tracks", []):
+                if "color" not in track.keys():
+                    if acc_view_color is not None:
+                        track["color"] = acc_view_color
+                    if acc_view_altColor is not None:
+                        track["altColor"] = acc_view_altColor
+
+        # If vis_by_type of this vis_type doesn't exist, create it
+        vis_type = vis_dataset["vis_type"]
+        vis_def = vis_defines.get_vis_def(vis_type)
+
+        assert(vis_type is not None)
+        if vis_type not in self.vis_by_types.keys():  # First one so just drop in place
+            vis_by_type = vis_dataset  # Don't bother with deep copy.
+            set_defs = vis_def.get("assay_composite", {})
+            vis_by_type["name"] = vis_type.lower()  # is there something more elegant?
+            for tag in ["longLabel", "shortLabel", "visibility"]:
+                if tag in set_defs:
+                    vis_by_type[tag] = set_defs[tag]  # Not expecting any token substitutions!!!
+            vis_by_type['html'] = vis_type
+            self.vis_by_types[vis_type] = vis_by_type
+
+        else:  # Adding an vis_dataset to an existing vis_by_type
+            vis_by_type = self.vis_by_types[vis_type]
+            vis_by_type['composite_type'] = 'set'
+
+            if vis_by_type.get("project", "unknown") != "NHGRI":
+                acc_pennant = vis_dataset["pennantIcon"]
+                set_pennant = vis_by_type["pennantIcon"]
+                if acc_pennant != set_pennant:
+                    vis_by_type["project"] = "NHGRI"
+                    vis_by_type["pennantIcon"] = vis_defines.pennants("NHGRI")
+
+            # combine views
+            set_views = vis_by_type.get("view", [])
+            acc_views = vis_dataset.get("view", {})
+            for view_tag in acc_views["group_order"]:
+                acc_view = acc_views["groups"][view_tag]
+                if view_tag not in set_views["groups"].keys():  # Should never happen
+                    # log.debug("Surprise: view %s not found before" % view_tag)
+                    self.insert_live_group(set_views, view_tag, acc_view)
+                else:  # View is already defined but tracks need to be appended.
+                    set_view = set_views["groups"][view_tag]
+                    if "tracks" not in set_view:
+                        set_view["tracks"] = acc_view.get("tracks", [])
+                    else:
+                        set_view["tracks"].extend(acc_view.get("tracks", []))
+
+            # All tracks in one set: not needed.
+
+            # Combine subgroups:
+            for group_tag in vis_dataset["group_order"]:
+                acc_group = vis_dataset["groups"][group_tag]
+                if group_tag not in vis_by_type["groups"].keys():  # Should never happen
+                    # log.debug("Surprise: group %s not found before" % group_tag)
+                    self.insert_live_group(vis_by_type, group_tag, acc_group)
+                else:  # Need to handle subgroups which definitely may not be there.
+                    set_group = vis_by_type["groups"].get(group_tag, {})
+                    acc_subgroups = acc_group.get("groups", {})
+                    # acc_subgroup_order = acc_group.get("group_order")
+                    for subgroup_tag in acc_subgroups.keys():
+                        if subgroup_tag not in set_group.get("groups", {}).keys():
+                            # Adding biosamples, targets, and reps
+                            self.insert_live_group(set_group, subgroup_tag, acc_subgroups[subgroup_tag])
+
+            # dimensions and filterComposite should not need any extra care:
+            # they get dynamically scaled down during printing
+            # log.debug("       Added.")
+        return hide_after
+
     def len(self, count_datasets=False):
         if count_datasets or not self.vis_by_types:
             return len(self.vis_datasets)
@@ -309,17 +363,15 @@ class VisCollections(object):
 
     def ucsc_trackDb(self):
         '''Formats collection into UCSC trackDb.ra text'''
-        trackdb_txt = ""
+        return ''.join(self.ucsc_trackDb_parts())
 
+    def ucsc_trackDb_parts(self):
+        '''Yields UCSC trackDb.ra text a composite at a time'''
         vis_defines = VisDefines(self.request)
 
-        if self.vis_by_types:
-            for tag in sorted(self.vis_by_types.keys()):
-                trackdb_txt += vis_defines.ucsc_single_composite_trackDb(self.vis_by_types[tag], tag)
-        else:
-            for tag in sorted(self.vis_datasets.keys()):
-                trackdb_txt += vis_defines.ucsc_single_composite_trackDb(self.vis_datasets[tag], tag)
-        return trackdb_txt
+        composites = self.vis_by_types if self.vis_by_types else self.vis_datasets
+        for tag in sorted(composites.keys()):
+            yield vis_defines.ucsc_single_composite_trackDb(composites[tag], tag)
 
     def stringify(self, prepend_label=None):
         '''returns string of trakDb.txt or json as appropriate.'''
@@ -345,15 +397,34 @@ class VisCollections(object):
                     return self.ucsc_trackDb()
         return ""
 
+    def stringify_found_or_built(self, accessions, assembly, hide=False, must_build=False, prepend_label=None):
+        '''Returns string of trackDb.txt or json for accessions, as stringify() would after find_or_build().
+           TrackDb output is remodelled a chunk of vis_datasets at a time, which are not kept.'''
+        (page, suffix, cmd) = urlpage(self.page_requested)
+        json_out = (suffix == 'json')
+        if json_out and page in ['vis_blob', 'ihec']:  # Need every vis_dataset at once
+            self.find_or_build(accessions, assembly, hide, must_build)
+            return self.stringify(prepend_label)
+
+        self.remodel_chunks(self.find_or_build_chunks(accessions, assembly, hide, must_build), hide_after=100)
+        if not self.vis_by_types:
+            return ""
+        if prepend_label is not None:
+            self.prepend_assay_labels(prepend_label)
+        if json_out:
+            return json.dumps(self.vis_by_types, indent=4, sort_keys=True)
+        return self.ucsc_trackDb()
+
+
 class VisDataset(object):
     # Finds, builds, stores, remodels vis_blobs
 
-    def __init__(self, request, vis_dataset=None):
+    def __init__(self, request, vis_dataset=None, vis_cache=None):
         self.found = False
         self.built = False
         self.request = request
         self.page_requested = self.request.url.split('/')[-1]
-        self.vis_cache = VisCache(self.request)
+        self.vis_cache = vis_cache if vis_cache is not None else VisCache(self.request)
         self.vis_defines = None
         self.ihec = None
         self.host = self.request.host_url
@@ -1136,8 +1207,9 @@ class VisDataset(object):
         return self.ucsc_trackDb()
 
 
-def vis_cache_add(request, dataset, is_vis_indexer=False):
-    '''For a single embedded dataset, builds and adds vis_dataset to es cache for each relevant assembly.'''
+def vis_cache_add(request, dataset, is_vis_indexer=False, vis_cache=None):
+    '''For a single embedded dataset, builds and adds vis_dataset to es cache for each relevant assembly.
+       A batching vis_cache may be passed in, to be flushed by the caller.'''
     if (
             not is_vis_indexer and
             not object_is_visualizable(dataset, exclude_quickview=True)
@@ -1148,7 +1220,7 @@ def vis_cache_add(request, dataset, is_vis_indexer=False):
     assemblies = dataset['assembly']
 
     vis_datasets = []
-    vis_factory = VisDataset(request)
+    vis_factory = VisDataset(request, vis_cache=vis_cache)
     for assembly in assemblies:
         vis_dataset = vis_factory.find_or_build(accession, assembly, dataset, must_build=True)
         if vis_dataset:  # Don't bother caching empties (e.g. {} == no visualizable files).
@@ -1191,9 +1263,8 @@ def generate_by_accessions(request, accessions, assembly, hide, regen, prepend_l
     '''Actual generation of trackDb for collections (batch and file_sets).'''
 
     vis_collection = VisCollections(request)
-    vis_datasets = vis_collection.find_or_build(accessions, assembly, hide, must_build=regen)
-
-    blob = vis_collection.stringify(prepend_label)
+    blob = vis_collection.stringify_found_or_built(accessions, assembly, hide, must_build=regen,
+                                                   prepend_label=prepend_label)
 
     msg = "%s. len(txt):%s  %.3f secs" % \
                  (vis_collection.found_or_built(), len(blob), (time.time() - PROFILE_START_TIME))
@@ -1469,27 +1540,50 @@ def generate_batch_hubs(context, request):
                        'ENCODE data use policy</p>')
         return generate_html(context, request) + data_policy
 
+def last_vis_xmin(request):
+    '''Returns the xmin of the vis indexer's last completed cycle, or None if there isn't one.'''
+    es = request.registry.get(ELASTIC_SEARCH)
+    if es is None:
+        return None
+    return vis_indexer_xmin(es, request.registry.settings['snovault.elasticsearch.index'])
+
+
+def cached_hub_text(request, key, generate):
+    '''Returns the HubText for key, calling generate() for (text, content_mime) when not cached.
+       Entries are reused until the vis indexer completes another cycle.'''
+    cache = request.registry.get(HUB_CACHE)
+    xmin = last_vis_xmin(request) if cache is not None else None
+    if xmin is None:
+        return hub_text(*generate())
+    # Searches are run as the user, so each set of principals sees its own hub
+    key = key + (xmin, tuple(sorted(request.effective_principals)))
+    (page, suffix, cmd) = urlpage(request.url)
+    if cmd != 'regen':
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+    return cache.set(key, hub_text(*generate()))
+
+
 def respond_with_text(request, text, content_mime):
     '''Resonse that can handle range requests.'''
+    return respond_with_hub_text(request, hub_text(text, content_mime))
+
+
+def respond_with_hub_text(request, entry):
+    '''Response for rendered hub text that handles If-None-Match, If-Range and range requests.'''
     # UCSC broke trackhubs and now we must handle byterange requests on these CGI files
+    if entry.etag in request.if_none_match:
+        raise HTTPNotModified(headers={'ETag': '"%s"' % entry.etag})
     response = request.response
-    response.content_type = content_mime
+    response.content_type = entry.content_type
     response.charset = 'UTF-8'
-    response.body = bytes_(text, 'utf-8')
+    response.body = entry.body
+    response.etag = entry.etag
     response.accept_ranges = "bytes"
-    response.last_modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
-    if 'Range' in request.headers:
-        range_request = True
-        range = request.headers['Range']
-        if range.startswith('bytes'):
-            range = range.split('=')[1]
-        range = range.split('-')
-        # One final present... byterange '0-' with no end in sight
-        if range[1] == '':
-            range[1] = len(response.body) - 1
-        response.content_range = 'bytes %d-%d/%d' % (int(range[0]),int(range[1]),len(response.body))
-        response.app_iter = request.response.app_iter_range(int(range[0]),int(range[1]) + 1)
-        response.status_code = 206
+    response.last_modified = entry.last_modified
+    # webob serves Range requests (when If-Range matches) as slices of the body
+    response.conditional_response = True
     return response
 
 @view_config(name='hub', context=Item, request_method='GET', permission='view')
@@ -1498,37 +1592,40 @@ def hub(context, request):
     global PROFILE_START_TIME
     PROFILE_START_TIME = time.time()
 
-    embedded = request.embed(request.resource_path(context))
-
-    (page,suffix,cmd) = urlpage(request.url)
-    content_mime = 'text/plain'
-    if page == 'hub' and suffix == 'txt':
-        typeof = embedded.get("assay_title")
-        if typeof is None:
-            typeof = embedded["@id"].split('/')[1]
-
-        label = "%s %s" % (typeof, embedded['accession'])
-        name = sanitize.name(label)
-        text = '\n'.join(get_hub(label, request.url, name))
-    elif page == 'genomes' and suffix == 'txt':
-        assemblies = ''
-        if 'assembly' in embedded:
-            assemblies = embedded['assembly']
-
-        text = get_genomes_txt(assemblies)
+    def generate():
+        embedded = request.embed(request.resource_path(context))
 
-    elif (suffix == 'txt' and page == 'trackDb') or \
-         (suffix == 'json' and page in ['trackDb','ihec','vis_blob']):
-        url_ret = (request.url).split('@@hub')
-        url_end = url_ret[1][1:]
-        text = generate_trackDb(request, embedded, url_end.split('/')[0])
-    else:
-        data_policy = ('<br /><a href="http://encodeproject.org/ENCODE/terms.html">'
-                       'ENCODE data use policy</p>')
-        text = generate_html(context, request) + data_policy
-        content_mime = 'text/html'
+        (page,suffix,cmd) = urlpage(request.url)
+        content_mime = 'text/plain'
+        if page == 'hub' and suffix == 'txt':
+            typeof = embedded.get("assay_title")
+            if typeof is None:
+                typeof = embedded["@id"].split('/')[1]
+
+            label = "%s %s" % (typeof, embedded['accession'])
+            name = sanitize.name(label)
+            text = '\n'.join(get_hub(label, request.url, name))
+        elif page == 'genomes' and suffix == 'txt':
+            assemblies = ''
+            if 'assembly' in embedded:
+                assemblies = embedded['assembly']
+
+            text = get_genomes_txt(assemblies)
+
+        elif (suffix == 'txt' and page == 'trackDb') or \
+             (suffix == 'json' and page in ['trackDb','ihec','vis_blob']):
+            url_ret = (request.url).split('@@hub')
+            url_end = url_ret[1][1:]
+            text = generate_trackDb(request, embedded, url_end.split('/')[0])
+        else:
+            data_policy = ('<br /><a href="http://encodeproject.org/ENCODE/terms.html">'
+                           'ENCODE data use policy</p>')
+            text = generate_html(context, request) + data_policy
+            content_mime = 'text/html'
+        return (text, content_mime)
 
-    return respond_with_text(request, text, content_mime)
+    key = ('hub', request.url)
+    return respond_with_hub_text(request, cached_hub_text(request, key, generate))
 
 
 @view_config(route_name='batch_hub')
@@ -1536,5 +1633,11 @@ def hub(context, request):
 def batch_hub(context, request):
     ''' View for batch track hubs '''
 
-    text = generate_batch_hubs(context, request)
-    return respond_with_text(request, text, 'text/plain')
+    def generate():
+        return (generate_batch_hubs(context, request), 'text/plain')
+
+    # Same search in a different order is the same hub
+    search_params = '&'.join(sorted(request.matchdict['search_params'].replace(',,', '&').split('&')))
+    key = ('batch_hub', request.host_url, search_params, request.matchdict.get('assembly'),
+           request.matchdict['txt'])
+    return respond_with_hub_text(request, cached_hub_text(request, key, generate))